@@ -0,0 +1,91 @@
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# like highlight_sender.py, avoid importing anything from calibre here. the rows are read from calibre's annotations
+# table in annotation_aggregates() in button_actions.py.
+
+
+def summarize(rows: Iterable[Tuple[int, int, float, str]]) -> Dict[str, list]:
+    """
+    :param rows: (book id, number of highlights, newest highlight's timestamp, comma separated uuids of the
+     highlights). a book can have more than one row, e.g. one for each user.
+    :return: {book id: [number of highlights, newest timestamp, hash of the uuids]}. book ids are strings so that
+     they can be compared with the ones loaded from json.
+    """
+    books: Dict[str, list] = {}
+    uuids: Dict[str, List[str]] = {}
+    for book_id, count, newest, book_uuids in rows:
+        key = str(book_id)
+        book = books.setdefault(key, [0, newest, ""])
+        book[0] += count
+        book[1] = max(book[1], newest)
+        uuids.setdefault(key, []).extend((book_uuids or "").split(","))
+    for key, book in books.items():
+        book[2] = hashlib.sha1("\n".join(sorted(uuids[key])).encode("utf-8")).hexdigest()
+    return books
+
+
+class AnnotationDigest:
+    """
+    remembers how many highlights each book had, when the newest one was made, and a hash of their uuids, as of the
+    last send that succeeded. when sending new highlights, books whose digest hasn't changed since then can't have
+    new highlights, so their annotations don't need to be loaded from calibre.
+
+    the digest is only used if the send's last send time isn't earlier than the one used when it was recorded, e.g.
+    if the last send time was changed in the config, or if an extra vault failed and is behind the main vault.
+    """
+
+    def __init__(self, path: str, library: str, users: Iterable[Tuple[str, str]]):
+        """
+        :param path: file to load the digests from and save them to
+        :param library: path of the library, since each library has its own digest
+        :param users: (user type, user) of the users whose highlights are sent. a digest of other users isn't used.
+        """
+        self.path = path
+        self.library = library
+        self.users = sorted([f"{user_type}:{user}" for user_type, user in users])
+        # {library: {"users": [...], "since": last send time, "books": {book id: [count, newest, uuid hash]}}}
+        self.libraries: Dict[str, dict] = {}
+        self.pending: Optional[dict] = None  # digest that record() saves, from changed_books()
+        self.load()
+
+    def changed_books(self, books: Dict[str, list], since: str) -> Optional[List[int]]:
+        """
+        :param books: output of summarize() for the library's highlights as they are now
+        :param since: earliest last send time of the vaults being sent to, formatted as "%Y-%m-%d %H:%M:%S"
+        :return: ids of the books whose highlights changed since the last digest, or None if the digest can't be
+         used, so every book has to be loaded
+        """
+        self.pending = {"users": self.users, "since": since, "books": books}
+        old = self.libraries.get(self.library)
+        # this time format can be compared as strings
+        if old is None or old.get("users") != self.users or since < old.get("since", ""):
+            return None
+
+        old_books = old.get("books", {})
+        return [int(book_id) for book_id, digest in books.items() if old_books.get(book_id) != digest]
+
+    def record(self) -> None:
+        """
+        saves the digest given to changed_books(). should only be called after a send succeeded.
+        """
+        if self.pending is None:
+            return
+        self.load()  # another library's digest could have been saved since this one was loaded
+        self.libraries[self.library] = self.pending
+        self.pending = None
+
+        # write to a temporary file first so that a crash while saving can't leave a half-written file
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.libraries, f)
+        os.replace(tmp, self.path)
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.libraries = json.load(f)
+        except (OSError, ValueError):
+            self.libraries = {}  # missing or corrupt. every book is loaded until the next send.
@@ -0,0 +1,59 @@
+import json
+import zipfile
+from typing import Dict, List, Optional, Set, Tuple
+
+# like highlight_sender.py, avoid importing anything from calibre here.
+
+
+class ArchiveWriter:
+    """
+    sends notes by writing them into a single archive file instead of to obsidian, e.g. for backups, or to copy into a
+    vault later. each note is written as soon as it's sent, so the whole archive is never in memory at once.
+
+    if path ends with ".jsonl", each note is written as a line of json with "file", "content", and "uuids". otherwise,
+    path is a zip file with a markdown file for each note, in folders from the slashes in its title. a note whose
+    title is already in the zip (e.g. when sending to more than one vault) is put in a folder named after its vault.
+
+    can be used in place of send_item_to_obsidian().
+    """
+
+    wants_uuids = True  # see HighlightSender.send()
+
+    def __init__(self, path: str):
+        """
+        :param path: file to write the archive to. it's replaced if it already exists.
+        """
+        self.path = path
+        self.jsonl = path.lower().endswith(".jsonl")
+        self.notes = 0  # number of notes written
+        self.names: Set[str] = set()  # files in the zip
+        if self.jsonl:
+            self.file = open(path, "w", encoding="utf-8", newline="\n")
+        else:
+            self.file = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED)
+
+    def __call__(self, obsidian_data: Dict[str, str], uuids: List[Optional[str]] = None) -> None:
+        """
+        :param obsidian_data: output of HighlightSender.make_obsidian_data(). uses the 'vault', 'file', and 'content'
+         keys.
+        :param uuids: uuids of the highlights in the note
+        """
+        if self.jsonl:
+            record = {"file": obsidian_data["file"], "content": obsidian_data["content"], "uuids": uuids or []}
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        else:
+            name = obsidian_data["file"] + ".md"
+            if name in self.names:
+                name = obsidian_data["vault"] + "/" + name
+            self.names.add(name)
+            self.file.writestr(name, obsidian_data["content"])
+        self.notes += 1
+
+    def close(self) -> List[Tuple[str, str]]:
+        """
+        finishes writing the archive
+
+        :return: empty list, since errors are raised when each note is written
+        """
+        self.file.close()
+        return []
@@ -1,8 +1,23 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 from qt.core import QDialog, QVBoxLayout, QPushButton, QMessageBox, QLabel
-from calibre.gui2 import info_dialog
+from calibre.gui2 import choose_save_file, info_dialog, warning_dialog
 from calibre.library import current_library_name
+from calibre.utils.config import config_dir
 from calibre_plugins.highlights_to_obsidian.config import prefs
-from calibre_plugins.highlights_to_obsidian.highlight_sender import HighlightSender
+from calibre_plugins.highlights_to_obsidian.annotation_digest import AnnotationDigest, summarize
+from calibre_plugins.highlights_to_obsidian.archive_writer import ArchiveWriter
+from calibre_plugins.highlights_to_obsidian.checkpoint import SendCheckpoint
+from calibre_plugins.highlights_to_obsidian.note_ledger import NoteLedger
+from calibre_plugins.highlights_to_obsidian.obsidian_probe import NotReadyError, ReadinessProbe
+from calibre_plugins.highlights_to_obsidian.highlight_sender import (HighlightSender, UriLauncher, estimate_send,
+                                                                     NoteTooLongError, ResumeError, VaultTarget)
+from calibre_plugins.highlights_to_obsidian.render_cache import RenderCache
+from calibre_plugins.highlights_to_obsidian.toc_index import ChapterLookup
+from calibre_plugins.highlights_to_obsidian.vault_index import VaultIndex
+from calibre_plugins.highlights_to_obsidian.vault_writer import VaultFileWriter
 from time import strptime, strftime, mktime, gmtime
 
 
@@ -18,6 +33,14 @@ def help_menu(parent):
            "In a note's title, you can include slashes \"/\" to specify what folder the note should be in.\n\n" + \
            "Sometimes, if you send highlights while your obsidian vault is closed, not all highlights will " + \
            "be sent. If this happens, you can use the \"Resend Previously Sent Highlights\" function.\n\n" + \
+           "If a send is interrupted, e.g. by calibre crashing or Obsidian closing, you can use the \"Resume " + \
+           "Interrupted Send\" function to send only the notes that weren't sent yet.\n\n" + \
+           "To send new highlights from several libraries at once, list them in the config's Other Options and " + \
+           "use the \"Sync All Libraries\" function.\n\n" + \
+           "To back up your highlights, or to copy them into a vault yourself, use the \"Export Highlights\" " + \
+           "function to save them to a zip file or a JSON Lines file.\n\n" + \
+           "Other calibre users' highlights can be sent in the same send, each to its own vault or title format. " + \
+           "List them in the config's Other Options.\n\n" + \
            "You can set keyboard shortcuts in calibre's Preferences -> Shortcuts -> H2O.\n\n" + \
            "Due to URI length limits, H2O can only send a few thousand words to a single note at once. Extra text " \
            "will be sent to different notes with increasing numbers added to the end of the title.\n\n" + \
@@ -26,55 +49,288 @@ def help_menu(parent):
     info_dialog(parent, title, body, show=True)
 
 
-def send_highlights(parent, db, condition=lambda x: True, update_send_time=True) -> int:
+def make_sender(db, library_name=None, launcher=None, vault_name=None, book_ids=None, vault_path=None,
+                render_cache=None, note_ledger=None) -> HighlightSender:
+    """
+    :param db: calibre database: Cache().new_api
+    :param library_name: name of db's library. if None, the current library's name is used.
+    :param launcher: UriLauncher to send notes with, so that it can be shared between senders. if None, a new one
+     is made.
+    :param vault_name: vault to send to. if None, prefs["vault_name"] is used.
+    :param vault_path: folder of vault_name. if None, prefs["vault_path"] is used when vault_name is None. otherwise,
+     the vault's folder is unknown, so notes are sent with URIs and the vault isn't checked for highlights.
+    :param book_ids: if not None, only these books' highlights are loaded, see changed_book_ids()
+    :param render_cache: RenderCache to use if the render cache is turned on, so that it can be shared between
+     senders. their changes would overwrite each other if each had its own. if None, a new one is made.
+    :param note_ledger: NoteLedger to use if split notes are continued, shared like render_cache. if None, a new
+     one is made.
+    :return: HighlightSender with settings from prefs and highlights from db
+    """
+    _sender = HighlightSender()
+    # this might not work if the current library name has characters that don't work in urls.
+    # but if do hex encoding when it's not needed, i'll make links hard to read.
+    # todo: add hex encoding, but only when necessary https://manual.calibre-ebook.com/url_scheme.html
+    _sender.set_library(library_name if library_name is not None else current_library_name())
+    if vault_path is None:
+        vault_path = prefs["vault_path"] if vault_name is None else ""
+    vault_name = vault_name if vault_name is not None else prefs["vault_name"]
+    _sender.set_vault(vault_name)
+    _sender.set_title_format(prefs["title_format"])
+    _sender.set_body_format(prefs["body_format"])
+    _sender.set_no_notes_format(prefs["no_notes_format"])
+    _sender.set_header_format(prefs["header_format"] if prefs["use_header"] else "")
+    _sender.set_book_titles_authors(book_ids_to_titles_authors(db))
+    _sender.set_sort_key(prefs["sort_key"])
+    _sender.set_sleep_time(prefs["sleep_secs"])
+    _sender.set_duplicate_policy(prefs["duplicate_policy"])
+    _sender.set_chapter_lookup(ChapterLookup(db))
+    # the program that opens obsidian URIs is found once here, instead of once per note
+    if launcher is None:
+        launcher = UriLauncher(prefs['use_xdg_open'], int(prefs['max_launches']))
+    _sender.set_transport(launcher)
+    if prefs['use_render_cache']:
+        _sender.set_render_cache(render_cache if render_cache is not None else make_render_cache())
+    # in file_update mode, highlights that are already in the vault are sent again to update their sections
+    check_vaults = prefs['skip_highlights_in_vault'] and prefs['delivery_mode'] != "file_update"
+    main_index = make_vault_index(vault_path) if check_vaults and vault_path else None
+    _sender.set_vault_index(main_index)
+    if prefs['delivery_mode'] in ("file_append", "file_update") and vault_path:
+        update = prefs['delivery_mode'] == "file_update"
+        _sender.set_transport(VaultFileWriter(vault_path, update, int(prefs['file_writers'])))
+        _sender.set_section_markers(update)
+        _sender.set_sleep_time(0)  # obsidian doesn't need time to receive notes that are written to files
+    user = send_users()[0]
+    routes = prefs['user_routes']
+    if prefs['extra_vaults'] or routes:
+        # when other users' highlights are sent too, the main and extra vaults only get the main user's highlights
+        main_user = user if routes else None
+        # the main vault is first, so that targets line up with [None] + prefs['extra_vaults'] + prefs['user_routes']
+        targets = [VaultTarget(vault_name, user=main_user, vault_index=main_index)]
+        for vault in prefs['extra_vaults']:
+            # each vault needs its own transport, since the sender's might write to the main vault's folder
+            transport = launcher
+            if prefs['delivery_mode'] in ("file_append", "file_update") and vault.get("vault_path"):
+                transport = VaultFileWriter(vault["vault_path"], prefs['delivery_mode'] == "file_update",
+                                            int(prefs['file_writers']))
+            # each vault is checked for highlights that are already in it. vaults without a folder aren't checked.
+            index = make_vault_index(vault["vault_path"]) if check_vaults and vault.get("vault_path") else None
+            targets.append(VaultTarget(vault["vault_name"], vault.get("title_format") or None, transport,
+                                       user=main_user, vault_index=index))
+        for route in routes:
+            route_vault = route.get("vault_name") or vault_name
+            # the sender's transport is only right for the main vault
+            transport = None if route_vault == vault_name else launcher
+            targets.append(VaultTarget(route_vault, route.get("title_format") or None, transport,
+                                       user=(route["user_type"], route["user"]),
+                                       vault_index=main_index if route_vault == vault_name else None))
+        _sender.set_targets(targets)
+    if prefs['use_max_note_size']:
+        _sender.set_max_file_size(int(prefs['max_note_size']), prefs['copy_header'])
+        # see HighlightSender.send(). file_update mode replaces sections in whichever part already has them.
+        if prefs['continue_split_notes'] and prefs['delivery_mode'] != "file_update":
+            _sender.set_note_ledger(note_ledger if note_ledger is not None else make_note_ledger())
+        _sender.set_oversize_policy("report" if prefs['report_long_highlights'] else "split")
+    _sender.set_checkpoint(make_checkpoint())
+    if int(prefs['memory_budget_mb']) > 0:
+        _sender.set_memory_budget(int(prefs['memory_budget_mb']) * 1024 * 1024)
+    if prefs['pipeline_send']:
+        _sender.set_pipeline(64)
+    _sender.set_delivery_order(prefs['delivery_order'])
+    if prefs['check_obsidian_ready'] and prefs['delivery_mode'] == "uri":
+        vault_paths = {vault_name: vault_path} if vault_path else {}
+        _sender.set_readiness_probe(ReadinessProbe(vault_paths, float(prefs['ready_timeout'])))
+
+    """ all_annotations() and all_annotation_users()
+     https://github.com/kovidgoyal/calibre/blob/master/src/calibre/db/cache.py
+
+    some possible values for restrict_to_user
+     https://github.com/kovidgoyal/calibre/blob/master/src/calibre/gui2/library/annotations.py#L138 """
+    # todo: i could replace some logic (e.g. filtering by book id) by using the parameters of db.all_annotations()
+    if book_ids is not None and not book_ids:
+        _sender.set_annotations_list([])  # no book has new highlights
+    elif routes:
+        # every user's highlights are read in one pass, then each is sent to its user's vault. see VaultTarget.user
+        users = set(send_users())
+        _sender.set_annotations_list([a for a in db.all_annotations(restrict_to_book_ids=book_ids)
+                                      if (a.get("user_type"), a.get("user")) in users])
+    else:
+        _sender.set_annotations_list(db.all_annotations(restrict_to_user=user, restrict_to_book_ids=book_ids))
+    return _sender
+
+
+def send_users() -> List[Tuple[str, str]]:
+    """
+    :return: (user type, user) of each user whose highlights are sent. the first one is the main user.
+    """
+    user = ("web", prefs["web_user_name"]) if prefs["web_user"] else ("local", "viewer")
+    routed = [(r["user_type"], r["user"]) for r in prefs['user_routes']]
+    return [user] + [u for u in routed if u != user]
+
+
+def annotation_aggregates(db, users: Set[Tuple[str, str]]) -> Dict[str, list]:
+    """
+    reads the number of highlights, newest timestamp, and uuids of each book's highlights from calibre's annotations
+    table. this is a lot faster than db.all_annotations(), which has to read every highlight's json.
+
+    :param db: calibre database: Cache().new_api
+    :param users: (user type, user) of the users whose highlights are counted
+    :return: output of annotation_digest.summarize()
+    """
+    rows = db.backend.execute("SELECT book, user_type, user, COUNT(*), MAX(timestamp), group_concat(annot_id) "
+                              "FROM annotations WHERE annot_type = 'highlight' GROUP BY book, user_type, user")
+    return summarize((book, count, newest, uuids) for book, user_type, user, count, newest, uuids in rows
+                     if (user_type, user) in users)
+
+
+def changed_book_ids(db, since: str) -> Tuple[Optional[AnnotationDigest], Optional[List[int]]]:
+    """
+    finds the books whose highlights changed since the last send, so that only their highlights are loaded when
+    sending new highlights. see annotation_digest.py.
+
+    :param db: calibre database: Cache().new_api
+    :param since: earliest last send time of the vaults being sent to, formatted as "%Y-%m-%d %H:%M:%S"
+    :return: (digest, ids of the books to load). the ids are None if every book has to be loaded. call
+     digest.record() after the send succeeds. digest is None if it's turned off or can't be used.
+    """
+    if not prefs['skip_unchanged_books']:
+        return None, None
+
+    users = send_users()
+    try:
+        books = annotation_aggregates(db, set(users))
+    except Exception:
+        return None, None  # e.g. an old version of calibre without an annotations table
+
+    path = os.path.join(config_dir, "plugins", "highlights_to_obsidian_annotation_digest.json")
+    digest = AnnotationDigest(path, os.path.normcase(os.path.abspath(db.backend.library_path)), users)
+    return digest, digest.changed_books(books, since)
+
+
+def make_render_cache() -> RenderCache:
+    return RenderCache(os.path.join(config_dir, "plugins", "highlights_to_obsidian_render_cache.json"),
+                       int(prefs['render_cache_size']))
+
+
+def make_vault_index(vault_path: str) -> VaultIndex:
+    """
+    :param vault_path: folder of an obsidian vault
+    :return: VaultIndex of the vault. each vault has its own index file, so that indexes of different vaults don't
+     overwrite each other.
+    """
+    name = hashlib.sha1(os.path.normcase(os.path.abspath(vault_path)).encode("utf-8")).hexdigest()[:16]
+    index_path = os.path.join(config_dir, "plugins", f"highlights_to_obsidian_vault_index_{name}.json")
+    return VaultIndex(vault_path, index_path)
+
+
+def make_note_ledger() -> NoteLedger:
+    return NoteLedger(os.path.join(config_dir, "plugins", "highlights_to_obsidian_note_ledger.json"))
+
+
+def make_checkpoint() -> SendCheckpoint:
+    """
+    :return: SendCheckpoint that records the progress of sends, so that they can be resumed with resume_send()
+    """
+    return SendCheckpoint(os.path.join(config_dir, "plugins", "highlights_to_obsidian_checkpoint.json"))
+
+
+def send_highlights(parent, db, condition=lambda x: True, update_send_time=True, prev_send=None,
+                    new_since=None) -> int:
     """
     :param parent: QDialog or other window that is the parent of the info dialogs this function makes
     :param db: calibre database: Cache().new_api
     :param condition: condition for sending a highlight
     :param update_send_time: whether or not to update prefs["last_send_time"]
+    :param prev_send: if not None and any highlights are sent, prefs["prev_send"] is set to this
+    :param new_since: if not None, condition is replaced with one that only sends highlights made after this time,
+     or after an extra vault's own last send time for that vault. see target_send_conditions().
     :return: number of highlights that were sent
     """
 
-    def make_sender() -> HighlightSender:
-        _sender = HighlightSender()
-        # this might not work if the current library name has characters that don't work in urls.
-        # but if do hex encoding when it's not needed, i'll make links hard to read.
-        # todo: add hex encoding, but only when necessary https://manual.calibre-ebook.com/url_scheme.html
-        _sender.set_library(current_library_name())
-        _sender.set_vault(prefs["vault_name"])
-        _sender.set_title_format(prefs["title_format"])
-        _sender.set_body_format(prefs["body_format"])
-        _sender.set_no_notes_format(prefs["no_notes_format"])
-        _sender.set_header_format(prefs["header_format"] if prefs["use_header"] else "")
-        _sender.set_book_titles_authors(book_ids_to_titles_authors(db))
-        _sender.set_sort_key(prefs["sort_key"])
-        _sender.set_sleep_time(prefs["sleep_secs"])
-        if prefs['use_max_note_size']:
-            _sender.set_max_file_size(int(prefs['max_note_size']), prefs['copy_header'])
-
-        """ all_annotations() and all_annotation_users()
-         https://github.com/kovidgoyal/calibre/blob/master/src/calibre/db/cache.py
-         
-        some possible values for restrict_to_user
-         https://github.com/kovidgoyal/calibre/blob/master/src/calibre/gui2/library/annotations.py#L138 """
-        # todo: i could replace some logic (e.g. filtering by book id) by using the parameters of db.all_annotations()
-        user = ("web", prefs["web_user_name"]) if prefs["web_user"] else ("local", "viewer")
-        _sender.set_annotations_list(db.all_annotations(restrict_to_user=user))
-        return _sender
-
-    sender = make_sender()
-    amt = sender.send(condition=condition)
+    digest, book_ids = None, None
+    if new_since is not None:
+        digest, book_ids = changed_book_ids(db, earliest_send_time(new_since))
+    sender = make_sender(db, book_ids=book_ids)
+    if new_since is not None:
+        condition = target_send_conditions(sender, new_since)
+    selected = selected_book_ids(parent) if prefs['delivery_order'] == "selected" else []
+    sender.set_delivery_order(prefs['delivery_order'], selected)
+    # saved in case the send is interrupted, so that resume_send() can finish it the same way. each target's last
+    # send time is saved, since the targets' conditions have to be the same when resuming.
+    sender.checkpoint.info = {"library": current_library_name(), "update_send_time": update_send_time,
+                              "prev_send": prev_send, "send_time": strftime("%Y-%m-%d %H:%M:%S", gmtime()),
+                              "selected": selected,
+                              "target_times": target_send_times(new_since) if new_since is not None else None}
+    try:
+        amt = sender.send(condition=condition)
+    except NotReadyError as e:
+        show_not_ready(parent, e)
+        return 0
+    except NoteTooLongError as e:
+        show_too_long(parent, e)
+        return 0
+    if digest is not None and not sender.failures:
+        digest.record()
+    return show_send_results(parent, sender, amt, update_send_time, prev_send)
+
+
+def show_not_ready(parent, error: NotReadyError) -> None:
+    """
+    :param parent: QDialog or other window that is the parent of the dialog this function makes
+    :param error: error raised by HighlightSender.send()'s readiness probe
+    """
+    warning_dialog(parent, "Obsidian Isn't Ready", f"{error} Open Obsidian, then use the \"Resume Interrupted Send\" "
+                                                   f"function to send the highlights.", show=True)
+
+
+def show_too_long(parent, error: NoteTooLongError) -> None:
+    """
+    :param parent: QDialog or other window that is the parent of the dialog this function makes
+    :param error: error raised by HighlightSender.send() when highlights are too long to fit in a note
+    """
+    lines = [f"{title}: {size} characters, \"{text}...\"" for title, size, text in error.notes[:20]]
+    if len(error.notes) > 20:
+        lines.append(f"and {len(error.notes) - 20} more")
+    warning_dialog(parent, "Highlights Too Long", f"Nothing was sent, because {error}. Increase the max note size, "
+                                                  f"or let long highlights be split (not possible when updating "
+                                                  f"notes in the vault folder), then send again.",
+                   det_msg="\n".join(lines), show=True)
+
+
+def show_send_results(parent, sender: HighlightSender, amt: int, update_send_time: bool, prev_send: str = None,
+                      send_time: str = None) -> int:
+    """
+    updates prefs after a send and shows how many highlights were sent
+
+    :param parent: QDialog or other window that is the parent of the info dialogs this function makes
+    :param sender: HighlightSender that did the send
+    :param amt: number of highlights that were sent
+    :param update_send_time: whether or not to update prefs["last_send_time"]
+    :param prev_send: if not None and any highlights were sent, prefs["prev_send"] is set to this
+    :param send_time: value to set prefs["last_send_time"] to. if None, the current time is used.
+    :return: amt
+    """
+    if sender.failures:
+        failed = "\n\n".join(f[1] for f in sender.failures[:10])
+        more = f"\n\n...and {len(sender.failures) - 10} more." if len(sender.failures) > 10 else ""
+        warning_dialog(parent, "Some Notes Failed to Send",
+                       f"{len(sender.failures)} note{' was' if len(sender.failures) == 1 else 's were'} "
+                       f"not sent to Obsidian:\n\n{failed}{more}", show=True)
 
     if amt > 0:
         # don't update send time if no highlights were actually sent. this makes sure you
         # won't mess up your prev_send if you accidentally send new highlights twice in a row.
         if update_send_time:
-            # has to be time.gmtime() so that we use utc. calibre stores highlight time as UTC, and last_send_time
-            # is what we compare to. if you use localtime instead of gmtime, you'll get rare bugs when the computer's
-            # timezone changes.
-            prefs["last_send_time"] = strftime("%Y-%m-%d %H:%M:%S", gmtime())
+            record_send_time(sender, send_time)
+        if prev_send is not None:
+            prefs["prev_send"] = prev_send
 
         info = f"Success: {amt} highlight{' has' if amt == 1 else 's have'} been sent to Obsidian."
+        dupes = sender.stats.get("duplicates", 0)
+        if dupes > 0:
+            info += f" {dupes} duplicate highlight{' was' if dupes == 1 else 's were'} not sent."
+        in_vault = sender.stats.get("in_vault", 0)
+        if in_vault > 0:
+            info += f" {in_vault} highlight{' was' if in_vault == 1 else 's were'} already in the vault."
         if prefs['highlights_sent_dialog']:
             info_dialog(parent, "Highlights Sent", info, show=True)
     else:
@@ -83,12 +339,44 @@ def send_highlights(parent, db, condition=lambda x: True, update_send_time=True)
     return amt
 
 
-def send_new_highlights(parent, db):
+def record_send_time(sender: HighlightSender, send_time: str = None) -> None:
     """
-    :param parent: QDialog or other window that is the parent of the info dialogs this function makes
-    :param db: calibre database: Cache().new_api
+    updates prefs["last_send_time"], and the last send times of the extra vaults and other users, after a send of
+    the current library's new highlights
+
+    :param sender: HighlightSender that did the send
+    :param send_time: time the send started. if None, the current time is used.
     """
-    last_send_time = mktime(strptime(prefs["last_send_time"], "%Y-%m-%d %H:%M:%S"))
+    # has to be time.gmtime() so that we use utc. calibre stores highlight time as UTC, and last_send_time
+    # is what we compare to. if you use localtime instead of gmtime, you'll get rare bugs when the computer's
+    # timezone changes.
+    prefs["last_send_time"] = send_time if send_time is not None else strftime("%Y-%m-%d %H:%M:%S", gmtime())
+    if sender.targets:
+        # extra vaults and other users keep their own send time, so that a vault that failed gets its
+        # highlights next time
+        extra_vaults, routes = prefs['extra_vaults'], prefs['user_routes']
+        for vault, target in zip(extra_vaults + routes, sender.targets[1:]):
+            if not target.failures:
+                vault["last_send_time"] = prefs["last_send_time"]
+        prefs['extra_vaults'] = extra_vaults
+        prefs['user_routes'] = routes
+
+
+def highlight_time(highlight) -> float:
+    """
+    :param highlight: json object containing a calibre highlight's data
+    :return: time the highlight was made, as a unix timestamp
+    """
+    # calibre's time format example: "2022-09-10T20:32:08.820Z"
+    return mktime(strptime(highlight["annotation"]["timestamp"][:19], "%Y-%m-%dT%H:%M:%S"))
+
+
+def new_highlight_condition(last_send_time: str) -> Callable[[Any], bool]:
+    """
+    :param last_send_time: time formatted as "%Y-%m-%d %H:%M:%S"
+    :return: condition that is true for highlights made after last_send_time
+    """
+    send_time = mktime(strptime(last_send_time, "%Y-%m-%d %H:%M:%S"))
 
     def highlight_send_condition(highlight) -> bool:
         """
@@ -97,15 +385,62 @@ def send_new_highlights(parent, db):
         """
         # an alternative method is to save the uuid of each highlight as it's sent,
         # then save that list in prefs, then check if the highlight is in that list
+        return highlight_time(highlight) > send_time
+
+    return highlight_send_condition
+
+
+def target_send_times(last_send_time: str) -> List[str]:
+    """
+    :param last_send_time: the main vault's last send time, formatted as "%Y-%m-%d %H:%M:%S"
+    :return: last send time of each of make_sender()'s targets: the main vault, then the extra vaults and other users
+    """
+    return [last_send_time] + [v.get("last_send_time") or last_send_time
+                               for v in prefs['extra_vaults'] + prefs['user_routes']]
+
+
+def earliest_send_time(last_send_time: str) -> str:
+    """
+    :param last_send_time: the main vault's last send time, formatted as "%Y-%m-%d %H:%M:%S"
+    :return: the earliest of last_send_time and the extra vaults' and other users' last send times, i.e. the time
+     that highlights have to be newer than to be new to any of them. see target_send_conditions().
+    """
+    return min(target_send_times(last_send_time))  # this time format can be compared as strings
+
+
+def target_send_conditions(sender: HighlightSender, last_send_time: str,
+                           times: List[str] = None) -> Callable[[Any], bool]:
+    """
+    gives each of sender's extra vaults and other users a condition for only sending highlights that are new to that
+    vault or user. they can have a different last send time than the main vault, e.g. if sending to one of them
+    failed.
+
+    :param sender: output of make_sender()
+    :param last_send_time: the main vault's last send time, formatted as "%Y-%m-%d %H:%M:%S"
+    :param times: last send time of each of sender's targets, see target_send_times(). if None, they're read from
+     prefs.
+    :return: condition for HighlightSender.send(). true for highlights that are new to any of the vaults.
+    """
+    if times is None:
+        times = target_send_times(last_send_time)
+    if not sender.targets:
+        return new_highlight_condition(times[0])
+
+    earliest = min(times)
+    conditions = {earliest: None}  # {send time: condition}. vaults with the same time share notes.
+    for target, send_time in zip(sender.targets, times):
+        if send_time not in conditions:
+            conditions[send_time] = new_highlight_condition(send_time)
+        target.condition = conditions[send_time]
+    return new_highlight_condition(earliest)
 
-        # calibre's time format example: "2022-09-10T20:32:08.820Z"
-        highlight_time = mktime(strptime(highlight["annotation"]["timestamp"][:19], "%Y-%m-%dT%H:%M:%S"))
-        return highlight_time > last_send_time
 
-    new_prev_send = prefs["last_send_time"]
-    amt_sent = send_highlights(parent, db, highlight_send_condition)
-    if amt_sent > 0:
-        prefs["prev_send"] = new_prev_send
+def send_new_highlights(parent, db):
+    """
+    :param parent: QDialog or other window that is the parent of the info dialogs this function makes
+    :param db: calibre database: Cache().new_api
+    """
+    send_highlights(parent, db, new_since=prefs["last_send_time"], prev_send=prefs["last_send_time"])
 
 
 def send_all_highlights(parent, db):
@@ -126,6 +461,21 @@ def send_all_highlights(parent, db):
     send_highlights(parent, db)
 
 
+def selected_book_ids(parent) -> List[int]:
+    """
+    :param parent: calibre's gui object, or a window that has it as a property ".gui"
+    :return: ids of the books that are selected in the main window
+    """
+    try:
+        parent.library_view  # check if this exists
+        gui = parent
+    except:
+        gui = parent.gui
+
+    rows = gui.library_view.selectionModel().selectedRows()
+    return list(map(gui.library_view.model().id, rows))
+
+
 def send_new_selected_highlights(parent, db):
     """
     sends new highlights in the currently selected books in the main window. does update last_send_time, so
@@ -144,13 +494,10 @@ def send_new_selected_highlights(parent, db):
 
     rows = gui.library_view.selectionModel().selectedRows()
     selected_ids = list(map(gui.library_view.model().id, rows))
-    last_send_time = mktime(strptime(prefs["last_send_time"], "%Y-%m-%d %H:%M:%S"))
+    is_new = new_highlight_condition(prefs["last_send_time"])
 
     def highlight_send_condition(highlight):
-        # todo: probably a good idea to move the last_send_time check to an external function, since the code is
-        #  repeated in 3 places: send_new_selected_highlights, send_new_highlights, resend_highlights
-        highlight_time = mktime(strptime(highlight["annotation"]["timestamp"][:19], "%Y-%m-%dT%H:%M:%S"))
-        return highlight_time > last_send_time and int(highlight["book_id"]) in selected_ids
+        return is_new(highlight) and int(highlight["book_id"]) in selected_ids
 
     send_highlights(parent, db, highlight_send_condition, update_send_time=True)
 
@@ -216,14 +563,204 @@ def resend_highlights(parent, db):
         :return: true if the highlight was made between prev send time and most recent send time
         """
         # alternatively, store the uuids of previously sent highlights in prefs, and only send those
-
-        # calibre's time format example: "2022-09-10T20:32:08.820Z"
-        highlight_time = mktime(strptime(highlight["annotation"]["timestamp"][:19], "%Y-%m-%dT%H:%M:%S"))
-        return prev_send_time < highlight_time < last_send_time
+        return prev_send_time < highlight_time(highlight) < last_send_time
 
     send_highlights(parent, db, condition=highlight_send_condition, update_send_time=False)
 
 
+def resume_send(parent, db):
+    """
+    continues the most recent send that didn't finish, e.g. because calibre crashed or obsidian was closed. notes that
+    were already delivered aren't sent again.
+
+    :param parent: QDialog or other window that is the parent of the info dialogs this function makes
+    :param db: calibre database: Cache().new_api
+    """
+    checkpoint = make_checkpoint()
+    saved = checkpoint.load()
+    if saved is None:
+        info_dialog(parent, "Cannot resume send", "There is no interrupted send to resume.", show=True)
+        return
+
+    info = saved["info"]
+    if info.get("library") != current_library_name():
+        warning_dialog(parent, "Cannot resume send", f"The interrupted send was from the library "
+                                                     f"\"{info.get('library')}\". Switch to that library to resume it.",
+                       show=True)
+        return
+
+    uuids = set(saved["uuids"])
+    sender = make_sender(db)
+    if info.get("target_times") is not None:
+        # each vault only gets the highlights that were new to it when the send started, like it did before
+        target_send_conditions(sender, info["target_times"][0], info["target_times"])
+    sender.set_checkpoint(checkpoint, resume=True)
+    # notes have to be sent in the same order as before, or the ones that were delivered can't be skipped
+    sender.set_delivery_order(prefs['delivery_order'], info.get("selected", []))
+    try:
+        amt = sender.send(condition=lambda highlight: highlight["annotation"]["uuid"] in uuids)
+    except ResumeError as e:
+        checkpoint.clear()
+        warning_dialog(parent, "Cannot resume send", f"{e} Use \"Resend Highlights\" instead.", show=True)
+        return
+    except NotReadyError as e:
+        show_not_ready(parent, e)
+        return
+    except NoteTooLongError as e:
+        show_too_long(parent, e)
+        return
+
+    show_send_results(parent, sender, amt, info.get("update_send_time", False), info.get("prev_send"),
+                      info.get("send_time"))
+
+
+def export_highlights(parent, db):
+    """
+    writes all highlights to a zip file of notes or a JSON Lines file, instead of sending them to obsidian. doesn't
+    change the last send time.
+
+    :param parent: QDialog or other window that is the parent of the dialogs this function makes
+    :param db: calibre database: Cache().new_api
+    """
+    path = choose_save_file(parent, "h2o-export-highlights", "Export Highlights",
+                            filters=[("Zip file of notes", ["zip"]), ("JSON Lines", ["jsonl"])],
+                            all_files=False, initial_filename="highlights.zip")
+    if not path:
+        return
+
+    sender = make_sender(db)
+    # everything is exported, even highlights that are already in the vault
+    sender.set_vault_index(None)
+    sender.set_checkpoint(None)
+    sender.set_readiness_probe(None)
+    sender.set_note_ledger(None)  # the archive's notes aren't in the vault
+    sender.set_sleep_time(0)
+    writer = ArchiveWriter(path)
+    sender.set_transport(writer)
+    for target in sender.targets:
+        target.transport = None  # use the sender's transport, i.e. writer
+        target.vault_index = None
+    try:
+        amt = sender.send()
+    except NoteTooLongError as e:
+        show_too_long(parent, e)
+        return
+    finally:
+        writer.close()
+
+    info_dialog(parent, "Highlights Exported", f"{amt} highlight{' was' if amt == 1 else 's were'} exported to "
+                                               f"{writer.notes} note{'' if writer.notes == 1 else 's'} in {path}.",
+                show=True)
+
+
+def open_library(path: str):
+    """
+    :param path: folder of a calibre library
+    :return: calibre database of the library: Cache().new_api. it should be closed with close() when done.
+    """
+    from calibre.library import db as library_db
+    return library_db(path, read_only=True).new_api
+
+
+def sync_libraries(parent):
+    """
+    sends new highlights from every library in prefs['sync_libraries'], without switching calibre to each library.
+    each library has its own last send time, except for the current library, which uses the same last send times
+    as "Send New Highlights", so that the two don't send each other's highlights again.
+
+    the libraries are opened and their highlights are loaded at the same time, then each library's highlights are
+    sent one library at a time, since they all share the same program for opening obsidian URIs.
+
+    :param parent: QDialog or other window that is the parent of the info dialogs this function makes. should be, or
+    have as a property ".gui", calibre's gui object.
+    """
+    try:
+        parent.library_view  # check if this exists
+        gui = parent
+    except:
+        gui = parent.gui
+
+    libraries = prefs['sync_libraries']
+    if not libraries:
+        info_dialog(parent, "No Libraries to Sync", "Add libraries to sync in the config's Other Options.", show=True)
+        return
+
+    current_path = os.path.normcase(os.path.abspath(gui.current_db.library_path))
+    launcher = UriLauncher(prefs['use_xdg_open'], int(prefs['max_launches']))
+    # libraries are sent one at a time, so they can share these. if each had its own, the last one saved would
+    # overwrite the others.
+    render_cache = make_render_cache() if prefs['use_render_cache'] else None
+    note_ledger = make_note_ledger() if prefs['continue_split_notes'] else None
+
+    def load(library):
+        # the current library is already open, so don't open it again
+        is_current = os.path.normcase(os.path.abspath(library["path"])) == current_path
+        db = gui.current_db.new_api if is_current else open_library(library["path"])
+        name = os.path.basename(os.path.normpath(library["path"]))
+        if is_current:
+            # same as send_new_highlights(), including the extra vaults' and other users' own send times
+            since = prefs["last_send_time"]
+            digest, book_ids = changed_book_ids(db, earliest_send_time(since))
+        else:
+            since = library.get("last_send_time") or prefs["last_send_time"]
+            digest, book_ids = changed_book_ids(db, since)
+        sender = make_sender(db, name, launcher, library.get("vault_name") or None, book_ids,
+                             library.get("vault_path") or None, render_cache, note_ledger)
+        sender.set_checkpoint(None)  # resume_send() only knows about the current library
+        condition = target_send_conditions(sender, since) if is_current else new_highlight_condition(since)
+        return sender, (None if is_current else db), digest, condition, is_current
+
+    with ThreadPoolExecutor(max_workers=min(4, len(libraries))) as executor:
+        loading = [executor.submit(load, library) for library in libraries]
+
+        totals = {}  # stats of all libraries added together
+        results = []  # one line of text per library
+        failures = []
+        for library, future in zip(libraries, loading):
+            name = os.path.basename(os.path.normpath(library["path"]))
+            try:
+                sender, opened_db, digest, condition, is_current = future.result()
+            except Exception as e:
+                results.append(f"{name}: could not be opened ({e})")
+                continue
+
+            try:
+                send_time = strftime("%Y-%m-%d %H:%M:%S", gmtime())
+                prev_send = prefs["last_send_time"]
+                amt = sender.send(condition)
+            except (NotReadyError, NoteTooLongError) as e:
+                results.append(f"{name}: not sent ({e})")
+                continue
+            finally:
+                if opened_db is not None:
+                    opened_db.close()
+
+            for key, value in sender.stats.items():
+                totals[key] = totals.get(key, 0) + value
+            failures += sender.failures
+            results.append(f"{name}: {amt} highlight{'' if amt == 1 else 's'} sent")
+            if amt > 0 and is_current:
+                record_send_time(sender, send_time)
+                prefs["prev_send"] = prev_send
+            if amt > 0 and not sender.failures:
+                library["last_send_time"] = send_time
+            if digest is not None and not sender.failures:
+                digest.record()
+
+    prefs['sync_libraries'] = libraries
+
+    if failures:
+        failed = "\n\n".join(f[1] for f in failures[:10])
+        more = f"\n\n...and {len(failures) - 10} more." if len(failures) > 10 else ""
+        warning_dialog(parent, "Some Notes Failed to Send",
+                       f"{len(failures)} note{' was' if len(failures) == 1 else 's were'} "
+                       f"not sent to Obsidian:\n\n{failed}{more}", show=True)
+
+    if prefs['highlights_sent_dialog'] or totals.get("sent", 0) == 0:
+        info_dialog(parent, "Libraries Synced", f"{totals.get('sent', 0)} highlights were sent from "
+                                                f"{len(libraries)} libraries.\n\n" + "\n".join(results), show=True)
+
+
 def book_ids_to_titles_authors(db):
 
     def format_authors(authors) -> str:
@@ -244,3 +781,33 @@ def book_ids_to_titles_authors(db):
         ret[book_id] = {"title": title, "authors": authors}
 
     return ret
+
+
+def make_preview_sender(db) -> HighlightSender:
+    """
+    :param db: calibre database: Cache().new_api
+    :return: HighlightSender like make_sender(), but that won't save formatted highlights to the render cache,
+     since templates that are being previewed haven't been saved yet
+    """
+    sender = make_sender(db)
+    sender.set_render_cache(None)
+    sender.set_checkpoint(None)
+    return sender
+
+
+def estimate_send_cost(sender: HighlightSender, title_format: str, body_format: str, no_notes_format: str,
+                       header_format: str) -> Dict[str, Dict[str, Any]]:
+    """
+    estimates what sending new highlights and sending all highlights would cost with the given templates. nothing is
+    sent to obsidian.
+
+    :param sender: output of make_preview_sender()
+    :return: {"new": estimate, "all": estimate}, see highlight_sender.estimate_send()
+    """
+    sender.set_title_format(title_format)
+    sender.set_body_format(body_format)
+    sender.set_no_notes_format(no_notes_format)
+    sender.set_header_format(header_format)
+
+    return {"new": estimate_send(sender, new_highlight_condition(prefs["last_send_time"])),
+            "all": estimate_send(sender)}
@@ -0,0 +1,91 @@
+import json
+import os
+import uuid as uuid_module
+from typing import Any, Dict, List, Optional
+
+# like highlight_sender.py, avoid importing anything from calibre here. the checkpoint's file path is decided in
+# make_checkpoint() in button_actions.py.
+
+
+def _write_json(path: str, data: Any) -> None:
+    # write to a temporary file first so that a crash while saving can't leave a half-written file
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+class SendCheckpoint:
+    """
+    records how far a send has gotten, so that a send that was interrupted (e.g. calibre crashed or obsidian was
+    closed) can be resumed from the first note that wasn't delivered, instead of sending everything again.
+
+    when a send starts, the uuids of its highlights are saved once. after each note is delivered, a small progress
+    file is saved with the send's run id, a hash of the titles and highlight uuids of the notes delivered so far, and
+    the number of notes delivered. when the send is resumed, the same highlights are made into notes again, and the
+    hash makes sure that the notes being skipped are the same ones that were delivered.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: file to save the send's highlights to. progress is saved to path + ".progress".
+        """
+        self.path = path
+        self.progress_path = path + ".progress"
+        self.run_id: str = None
+        # data about the send that's needed to resume it, e.g. the library name. saved by start().
+        self.info: Dict[str, Any] = {}
+
+    def start(self, uuids: List[str], in_vault: List[Optional[List[str]]] = None) -> str:
+        """
+        starts recording a new send. any previous send can no longer be resumed.
+
+        :param uuids: uuids of the highlights being sent
+        :param in_vault: for each of the send's targets, uuids of the highlights that weren't sent to it because they
+         were already in its vault, or None if its vault wasn't checked. see HighlightSender.find_in_vault().
+        :return: the send's run id
+        """
+        self.run_id = uuid_module.uuid4().hex
+        _write_json(self.path, {"run_id": self.run_id, "uuids": uuids, "in_vault": in_vault, "info": self.info})
+        self.delivered(0, "")
+        return self.run_id
+
+    def delivered(self, count: int, chunk_hash: str) -> None:
+        """
+        :param count: number of notes that have been delivered
+        :param chunk_hash: hash of the notes that have been delivered, see HighlightSender.send()
+        """
+        _write_json(self.progress_path, {"run_id": self.run_id, "hash": chunk_hash, "delivered": count})
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        """
+        loads the most recent send that didn't finish, and sets self.run_id and self.info to its values.
+
+        :return: {"run_id", "uuids", "in_vault", "info", "hash", "delivered"}, or None if there's no send to resume
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                run = json.load(f)
+            with open(self.progress_path, "r", encoding="utf-8") as f:
+                progress = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if run.get("run_id") != progress.get("run_id"):
+            return None  # crashed between saving the highlights and the progress of a new send
+
+        self.run_id = run["run_id"]
+        self.info = run.get("info", {})
+        run.update(progress)
+        return run
+
+    def clear(self) -> None:
+        """
+        forgets the current send, e.g. because it finished
+        """
+        for path in (self.path, self.progress_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.run_id = None
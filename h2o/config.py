@@ -1,7 +1,7 @@
 import time
 
 from qt.core import (QWidget, QVBoxLayout, QLabel, QLineEdit, QPlainTextEdit,
-                     QPushButton, QDialog, QDialogButtonBox, QCheckBox)
+                     QPushButton, QDialog, QDialogButtonBox, QCheckBox, QComboBox, QTimer)
 from calibre.gui2 import warning_dialog
 from calibre.utils.config import JSONConfig
 from calibre_plugins.highlights_to_obsidian.__init__ import version
@@ -48,7 +48,145 @@ prefs.defaults['web_user_name'] = "*"
 prefs.defaults['web_user'] = False  # whether we should send web user or local user's highlights
 prefs.defaults['use_xdg_open'] = False
 prefs.defaults['sleep_secs'] = 0.1
-
+prefs.defaults['max_launches'] = 4  # max number of obsidian URIs that can be opening at once
+# with a max note size, keep adding to the last part of a split note in later sends, instead of the first part.
+# see note_ledger.py
+prefs.defaults['continue_split_notes'] = True
+# check that no highlight is too long for a note before sending anything, instead of splitting long highlights
+prefs.defaults['report_long_highlights'] = False
+prefs.defaults['file_writers'] = 4  # number of note files that can be written at once when sending to files
+# make sure obsidian is open before sending with obsidian:// links. see obsidian_probe.py
+prefs.defaults['check_obsidian_ready'] = False
+prefs.defaults['ready_timeout'] = 30  # seconds to wait for obsidian to open
+prefs.defaults['duplicate_policy'] = "all"  # "all", "first", or "newest". see highlight_sender.dedupe_highlights
+prefs.defaults['use_render_cache'] = False  # save formatted highlights so they don't need to be formatted again
+# when sending new highlights, only load highlights from books whose highlights changed. see annotation_digest.py
+prefs.defaults['skip_unchanged_books'] = True
+prefs.defaults['render_cache_size'] = 50000000  # max characters of formatted text in the render cache
+# megabytes of highlights to keep in memory while sending before moving them to temporary files. 0 = no limit.
+prefs.defaults['memory_budget_mb'] = 0
+# format notes in the background while earlier notes are being sent. see HighlightSender.set_pipeline(). off by
+# default, since every highlight is still grouped into notes before the first note is sent.
+prefs.defaults['pipeline_send'] = False
+# which notes to send first: "" (in the order they're found), "recent", "smallest", or "selected". see
+# highlight_sender.delivery_orders
+prefs.defaults['delivery_order'] = ""
+prefs.defaults['vault_path'] = ""  # path of the obsidian vault's folder. empty if not set.
+prefs.defaults['skip_highlights_in_vault'] = False  # don't send highlights whose {uuidmarker} is already in the vault
+# "uri" to send notes with obsidian URIs, "file_append" to append to note files in vault_path, or "file_update" to
+# update each highlight's section of the note files in vault_path. see vault_writer.py
+prefs.defaults['delivery_mode'] = "uri"
+# vaults to send to as well as vault_name. list of {"vault_name", "title_format" (empty to use title_format),
+# "vault_path" (empty if not set), "last_send_time" (None to use last_send_time)}. see make_sender()
+prefs.defaults['extra_vaults'] = []
+# libraries synced by "Sync All Libraries". list of {"path", "vault_name" (empty to use vault_name), "vault_path"
+# (empty to use vault_path, or to send with URIs if vault_name is set), "last_send_time" (None to use
+# last_send_time)}. see sync_libraries()
+prefs.defaults['sync_libraries'] = []
+# other users whose highlights are sent in the same send, each to its own vault or title format. list of
+# {"user_type" ("local" or "web"), "user", "vault_name" (empty to use vault_name), "title_format" (empty to use
+# title_format), "last_send_time" (None to use last_send_time)}. see make_sender()
+prefs.defaults['user_routes'] = []
+
+
+def extra_vaults_to_text(extra_vaults) -> str:
+    """
+    :param extra_vaults: value of prefs['extra_vaults']
+    :return: text for the config's extra vaults input, with one "vault name | title format | vault folder" per line
+    """
+    lines = []
+    for vault in extra_vaults:
+        parts = [vault["vault_name"], vault.get("title_format", ""), vault.get("vault_path", "")]
+        while len(parts) > 1 and not parts[-1]:
+            parts.pop()
+        lines.append(" | ".join(parts))
+    return "\n".join(lines)
+
+
+def text_to_extra_vaults(text: str, old_extra_vaults):
+    """
+    :param text: text from the config's extra vaults input, see extra_vaults_to_text()
+    :param old_extra_vaults: current value of prefs['extra_vaults']. vaults that are still in text keep their last
+     send time.
+    :return: new value for prefs['extra_vaults']
+    """
+    old_times = {v["vault_name"]: v.get("last_send_time") for v in old_extra_vaults}
+    ret = []
+    for line in text.splitlines():
+        # "|" can't be in a note's title, so it's safe to use as a separator
+        parts = [p.strip() for p in line.split("|")] + ["", ""]
+        if not parts[0]:
+            continue
+        ret.append({"vault_name": parts[0], "title_format": parts[1], "vault_path": parts[2],
+                    "last_send_time": old_times.get(parts[0])})
+    return ret
+
+
+def sync_libraries_to_text(sync_libraries) -> str:
+    """
+    :param sync_libraries: value of prefs['sync_libraries']
+    :return: text for the config's libraries to sync input, with one "library folder | vault name | vault folder"
+     per line
+    """
+    lines = []
+    for lib in sync_libraries:
+        parts = [lib["path"], lib.get("vault_name", ""), lib.get("vault_path", "")]
+        while len(parts) > 1 and not parts[-1]:
+            parts.pop()
+        lines.append(" | ".join(parts))
+    return "\n".join(lines)
+
+
+def text_to_sync_libraries(text: str, old_sync_libraries):
+    """
+    :param text: text from the config's libraries to sync input, see sync_libraries_to_text()
+    :param old_sync_libraries: current value of prefs['sync_libraries']. libraries that are still in text keep their
+     last send time.
+    :return: new value for prefs['sync_libraries']
+    """
+    old_times = {lib["path"]: lib.get("last_send_time") for lib in old_sync_libraries}
+    ret = []
+    for line in text.splitlines():
+        parts = [p.strip() for p in line.split("|")] + ["", ""]
+        if not parts[0]:
+            continue
+        ret.append({"path": parts[0], "vault_name": parts[1], "vault_path": parts[2],
+                    "last_send_time": old_times.get(parts[0])})
+    return ret
+
+
+def user_routes_to_text(user_routes) -> str:
+    """
+    :param user_routes: value of prefs['user_routes']
+    :return: text for the config's other users input, with one "user type:user | vault name | title format" per line
+    """
+    lines = []
+    for route in user_routes:
+        parts = [route["user_type"] + ":" + route["user"], route.get("vault_name", ""), route.get("title_format", "")]
+        while len(parts) > 1 and not parts[-1]:
+            parts.pop()
+        lines.append(" | ".join(parts))
+    return "\n".join(lines)
+
+
+def text_to_user_routes(text: str, old_user_routes):
+    """
+    :param text: text from the config's other users input, see user_routes_to_text()
+    :param old_user_routes: current value of prefs['user_routes']. users that are still in text keep their last send
+     time.
+    :return: new value for prefs['user_routes']
+    """
+    old_times = {(r["user_type"], r["user"]): r.get("last_send_time") for r in old_user_routes}
+    ret = []
+    for line in text.splitlines():
+        parts = [p.strip() for p in line.split("|")] + ["", ""]
+        user_type, _, user = parts[0].partition(":")
+        user_type, user = user_type.strip().lower(), user.strip()
+        if user_type not in ("local", "web") or not user:
+            continue
+        ret.append({"user_type": user_type, "user": user, "vault_name": parts[1], "title_format": parts[2],
+                    "last_send_time": old_times.get((user_type, user))})
+    return ret
 
 
 class ConfigWidget(QWidget):
@@ -177,6 +315,40 @@ class FormattingDialog(QDialog):
 
         self.l.addSpacing(self.spacing)
 
+        # preview of the formats above, using some of the library's highlights
+        self.preview_label = QLabel('<b>Preview</b> (uses your most recent highlights, nothing is sent):', self)
+        self.l.addWidget(self.preview_label)
+
+        self.preview_output = QPlainTextEdit(self)
+        self.preview_output.setLineWrapMode(QPlainTextEdit.LineWrapMode.NoWrap)
+        self.preview_output.setReadOnly(True)
+        self.l.addWidget(self.preview_output)
+        self.preview_label.setBuddy(self.preview_output)
+
+        self.estimate_button = QPushButton("Estimate cost of sending highlights with these formats", self)
+        self.estimate_button.clicked.connect(self.update_estimate)
+        self.l.addWidget(self.estimate_button)
+
+        self.estimate_label = QLabel("", self)
+        self.l.addWidget(self.estimate_label)
+
+        self.preview_sender = None  # made when the preview is first shown, see get_preview_sender()
+        self.preview_samples = None  # highlights shown in the preview
+
+        # wait until the user stops typing before updating the preview
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(500)
+        self.preview_timer.timeout.connect(self.update_preview)
+        self.title_format_input.textChanged.connect(self.preview_timer.start)
+        self.body_format_input.textChanged.connect(self.preview_timer.start)
+        self.no_notes_format_input.textChanged.connect(self.preview_timer.start)
+        self.header_format_input.textChanged.connect(self.preview_timer.start)
+        self.header_checkbox.stateChanged.connect(self.preview_timer.start)
+        self.preview_timer.start()
+
+        self.l.addSpacing(self.spacing)
+
         # ok and cancel buttons
         self.buttons = QDialogButtonBox()
         self.buttons.setStandardButtons(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
@@ -188,7 +360,7 @@ class FormattingDialog(QDialog):
 
         # list of formatting options
         format_options = [
-            "title", "authors",
+            "title", "authors", "chapter",
             "highlight", "blockquote", "notes",
             "date", "time", "datetime",
             "day", "month", "year",
@@ -197,7 +369,7 @@ class FormattingDialog(QDialog):
             "timezone", "utcoffset",
             "url", "location", "timestamp",
             "totalsent", "booksent", "highlightsent",
-            "bookid", "uuid",
+            "bookid", "uuid", "uuidmarker",
         ]
         f_opt_str = "'" + "', '".join(format_options) + "'"
 
@@ -224,6 +396,95 @@ class FormattingDialog(QDialog):
                            "current time.")
         self.l.addWidget(time_note)
 
+    def pending_formats(self):
+        """
+        :return: (title, body, no notes, header) formats currently in the text boxes, which might not be saved yet
+        """
+        return (self.title_format_input.text(), self.body_format_input.toPlainText(),
+                self.no_notes_format_input.toPlainText(),
+                self.header_format_input.toPlainText() if self.header_checkbox.isChecked() else "")
+
+    def get_preview_sender(self):
+        """
+        :return: HighlightSender for the current library, or None if no library is open
+        """
+        if self.preview_sender is None:
+            # imported here to avoid a circular import, since button_actions imports this module's prefs
+            from calibre.gui2.ui import get_gui
+            from calibre_plugins.highlights_to_obsidian.button_actions import make_preview_sender
+
+            gui = get_gui()
+            if gui is None or gui.current_db is None:
+                return None
+            self.preview_sender = make_preview_sender(gui.current_db.new_api)
+
+            highlights = [h for h in self.preview_sender.annotations_list
+                          if h["annotation"].get("type") == "highlight" and not h["annotation"].get("removed")]
+            highlights.sort(key=lambda h: h["annotation"]["timestamp"], reverse=True)
+            self.preview_samples = highlights[:3]
+        return self.preview_sender
+
+    def update_preview(self):
+        from calibre_plugins.highlights_to_obsidian.highlight_sender import estimate_send
+
+        sender = self.get_preview_sender()
+        if sender is None:
+            self.preview_output.setPlainText("Open a calibre library to see a preview.")
+            return
+        if len(self.preview_samples) == 0:
+            self.preview_output.setPlainText("This library doesn't have any highlights to preview.")
+            return
+
+        title, body, no_notes, header = self.pending_formats()
+        sender.set_title_format(title)
+        sender.set_body_format(body)
+        sender.set_no_notes_format(no_notes)
+        sender.set_header_format(header)
+
+        # show the samples even if they're already in the vault, and don't rescan the vault after every keystroke
+        annotations, vault_index = sender.annotations_list, sender.vault_index
+        target_indexes = [target.vault_index for target in sender.targets]
+        sender.set_annotations_list(self.preview_samples)
+        sender.set_vault_index(None)
+        for target in sender.targets:
+            target.vault_index = None
+        try:
+            estimate = estimate_send(sender, max_samples=len(self.preview_samples))
+        except Exception as e:
+            self.preview_output.setPlainText(f"Could not format highlights: {e}")
+            return
+        finally:
+            sender.set_annotations_list(annotations)
+            sender.set_vault_index(vault_index)
+            for target, target_index in zip(sender.targets, target_indexes):
+                target.vault_index = target_index
+
+        notes = [f"===== {d['file']} =====\n{d['content']}" for d in estimate["samples"]]
+        self.preview_output.setPlainText("\n".join(notes))
+
+    def update_estimate(self):
+        from calibre_plugins.highlights_to_obsidian.button_actions import estimate_send_cost
+
+        sender = self.get_preview_sender()
+        if sender is None:
+            self.estimate_label.setText("Open a calibre library to estimate the cost of sending highlights.")
+            return
+
+        try:
+            estimates = estimate_send_cost(sender, *self.pending_formats())
+        except Exception as e:
+            self.estimate_label.setText(f"Could not format highlights: {e}")
+            return
+
+        lines = []
+        for mode, name in (("new", "Sending new highlights"), ("all", "Sending all highlights")):
+            e = estimates[mode]
+            lines.append(f"<b>{name}:</b> {e['highlights']} highlights to {e['notes']} notes, split into "
+                         f"{e['chunks']} parts ({e['uri_bytes'] / 1000:.1f} KB of obsidian:// links). "
+                         f"Takes about {e['send_secs']:.1f} seconds.")
+        lines.append(f"Formatting takes about {estimates['all']['secs_per_highlight'] * 1000:.2f} ms per highlight.")
+        self.estimate_label.setText("<br/>".join(lines))
+
     def save_settings(self):
         prefs['title_format'] = self.title_format_input.text()
         prefs['body_format'] = self.body_format_input.toPlainText()
@@ -266,6 +527,67 @@ class OtherConfigDialog(QDialog):
         self.l.addWidget(self.vault_input)
         self.vault_label.setBuddy(self.vault_input)
 
+        # obsidian vault folder
+        self.vault_path_label = QLabel('<b>Obsidian vault folder</b> (optional, only needed for some options):', self)
+        self.l.addWidget(self.vault_path_label)
+
+        self.vault_path_input = QLineEdit(self)
+        self.vault_path_input.setText(prefs['vault_path'])
+        self.vault_path_input.setPlaceholderText("Path of the Obsidian vault's folder...")
+        self.l.addWidget(self.vault_path_input)
+        self.vault_path_label.setBuddy(self.vault_path_input)
+
+        self.skip_in_vault_checkbox = QCheckBox("Don't send highlights that are already in the vault "
+                                                "(requires {uuidmarker} in the body format)")
+        self.skip_in_vault_checkbox.setChecked(prefs['skip_highlights_in_vault'])
+        self.l.addWidget(self.skip_in_vault_checkbox)
+
+        # how notes are sent
+        self.delivery_label = QLabel('<b>How to send notes:</b>', self)
+        self.l.addWidget(self.delivery_label)
+
+        self.delivery_modes = [("uri", "Send notes to Obsidian with obsidian:// links"),
+                               ("file_append", "Add notes to the end of files in the vault folder"),
+                               ("file_update", "Update each highlight's section of files in the vault folder")]
+        self.delivery_input = QComboBox(self)
+        for mode, text in self.delivery_modes:
+            self.delivery_input.addItem(text, mode)
+        modes = [m[0] for m in self.delivery_modes]
+        if prefs['delivery_mode'] in modes:
+            self.delivery_input.setCurrentIndex(modes.index(prefs['delivery_mode']))
+        self.l.addWidget(self.delivery_input)
+        self.delivery_label.setBuddy(self.delivery_input)
+
+        # other vaults to send to
+        self.extra_vaults_label = QLabel('<b>Also send to these vaults</b>, one per line, as: vault name | title '
+                                         'format (optional) | vault folder (optional, used instead of obsidian:// '
+                                         'links if sending to files)', self)
+        self.extra_vaults_label.setWordWrap(True)
+        self.l.addWidget(self.extra_vaults_label)
+
+        self.extra_vaults_input = QPlainTextEdit(self)
+        self.extra_vaults_input.setLineWrapMode(QPlainTextEdit.LineWrapMode.NoWrap)
+        self.extra_vaults_input.setPlainText(extra_vaults_to_text(prefs['extra_vaults']))
+        self.extra_vaults_input.setPlaceholderText("Work Vault | Research/{title}")
+        self.extra_vaults_input.setMaximumHeight(80)
+        self.l.addWidget(self.extra_vaults_input)
+        self.extra_vaults_label.setBuddy(self.extra_vaults_input)
+
+        # libraries for sync all libraries
+        self.sync_libraries_label = QLabel('<b>Libraries to sync</b> with "Sync All Libraries", one per line, as: '
+                                           'library folder | vault name (optional) | vault folder (optional, for '
+                                           'sending to a different vault without URIs)', self)
+        self.sync_libraries_label.setWordWrap(True)
+        self.l.addWidget(self.sync_libraries_label)
+
+        self.sync_libraries_input = QPlainTextEdit(self)
+        self.sync_libraries_input.setLineWrapMode(QPlainTextEdit.LineWrapMode.NoWrap)
+        self.sync_libraries_input.setPlainText(sync_libraries_to_text(prefs['sync_libraries']))
+        self.sync_libraries_input.setPlaceholderText("/path/to/Calibre Library | My Vault")
+        self.sync_libraries_input.setMaximumHeight(80)
+        self.l.addWidget(self.sync_libraries_input)
+        self.sync_libraries_label.setBuddy(self.sync_libraries_input)
+
         self.l.addSpacing(self.spacing)
 
         # sort key
@@ -318,6 +640,68 @@ class OtherConfigDialog(QDialog):
         self.copy_header_checkbox.setChecked(prefs['copy_header'])
         self.l.addWidget(self.copy_header_checkbox)
 
+        self.continue_split_checkbox = QCheckBox("When sending more highlights to a note that was split up, add them "
+                                                 "to its last part instead of its first part")
+        self.continue_split_checkbox.setChecked(prefs['continue_split_notes'])
+        self.l.addWidget(self.continue_split_checkbox)
+
+        self.report_long_checkbox = QCheckBox("Don't send anything if a highlight is too long to fit in a note, "
+                                              "instead of splitting the highlight")
+        self.report_long_checkbox.setChecked(prefs['report_long_highlights'])
+        self.l.addWidget(self.report_long_checkbox)
+
+        # checkbox for render cache
+        self.render_cache_checkbox = QCheckBox("Save formatted highlights so that resending them is faster")
+        self.render_cache_checkbox.setChecked(prefs['use_render_cache'])
+        self.l.addWidget(self.render_cache_checkbox)
+
+        # checkbox for skipping books that don't have new highlights
+        self.skip_unchanged_checkbox = QCheckBox("When sending new highlights, skip books whose highlights haven't "
+                                                 "changed since the last send")
+        self.skip_unchanged_checkbox.setChecked(prefs['skip_unchanged_books'])
+        self.l.addWidget(self.skip_unchanged_checkbox)
+
+        # checkbox for formatting notes while sending
+        self.pipeline_checkbox = QCheckBox("Format notes while earlier notes are being sent")
+        self.pipeline_checkbox.setChecked(prefs['pipeline_send'])
+        self.l.addWidget(self.pipeline_checkbox)
+
+        self.l.addSpacing(self.spacing)
+
+        # duplicate highlights policy
+        self.duplicate_label = QLabel("<b>Duplicate highlights</b> (same text and notes in the same book, e.g. "
+                                      "highlighted in both EPUB and AZW3):", self)
+        self.l.addWidget(self.duplicate_label)
+
+        self.duplicate_policies = [("all", "Send all duplicates"),
+                                   ("first", "Only send the first one found"),
+                                   ("newest", "Only send the most recently made one")]
+        self.duplicate_input = QComboBox(self)
+        for policy, text in self.duplicate_policies:
+            self.duplicate_input.addItem(text, policy)
+        policies = [p[0] for p in self.duplicate_policies]
+        if prefs['duplicate_policy'] in policies:
+            self.duplicate_input.setCurrentIndex(policies.index(prefs['duplicate_policy']))
+        self.l.addWidget(self.duplicate_input)
+        self.duplicate_label.setBuddy(self.duplicate_input)
+
+        # order that notes are sent in
+        self.order_label = QLabel("<b>Send first:</b> (useful if a big send is slow or gets interrupted)", self)
+        self.l.addWidget(self.order_label)
+
+        self.delivery_orders = [("", "Books in the order they're found"),
+                                ("recent", "Books with the most recent highlights"),
+                                ("smallest", "Books with the least highlighted text"),
+                                ("selected", "Books that are selected in calibre")]
+        self.order_input = QComboBox(self)
+        for order, text in self.delivery_orders:
+            self.order_input.addItem(text, order)
+        orders = [o[0] for o in self.delivery_orders]
+        if prefs['delivery_order'] in orders:
+            self.order_input.setCurrentIndex(orders.index(prefs['delivery_order']))
+        self.l.addWidget(self.order_input)
+        self.order_label.setBuddy(self.order_input)
+
         self.l.addSpacing(self.spacing)
 
         # checkbox for confirmation dialog
@@ -341,6 +725,41 @@ class OtherConfigDialog(QDialog):
         self.sleep_time_input.setPlaceholderText("Web user name (asterisk if no username is used)...")
         self.l.addWidget(self.sleep_time_input)
 
+        # input for how many URIs can be opened at once
+        self.max_launches_label = QLabel('<b>Max notes opening at once</b> (when sending with obsidian:// links):',
+                                         self)
+        self.l.addWidget(self.max_launches_label)
+
+        self.max_launches_input = QLineEdit()
+        self.max_launches_input.setText(str(prefs['max_launches']))
+        self.max_launches_input.setPlaceholderText("Max notes opening at once...")
+        self.l.addWidget(self.max_launches_input)
+        self.max_launches_label.setBuddy(self.max_launches_input)
+
+        # input for how many files can be written at once
+        self.file_writers_label = QLabel('<b>Max notes writing at once</b> (when sending to files, 0 to write one at a '
+                                         'time):', self)
+        self.l.addWidget(self.file_writers_label)
+
+        self.file_writers_input = QLineEdit()
+        self.file_writers_input.setText(str(prefs['file_writers']))
+        self.file_writers_input.setPlaceholderText("Max notes writing at once...")
+        self.l.addWidget(self.file_writers_input)
+        self.file_writers_label.setBuddy(self.file_writers_input)
+
+        # input for memory budget
+        self.memory_budget_label = QLabel('<b>Memory limit</b> for highlights being sent, in MB (0 for no limit). '
+                                          'Past this, highlights are kept in temporary files until they\'re sent:',
+                                          self)
+        self.memory_budget_label.setWordWrap(True)
+        self.l.addWidget(self.memory_budget_label)
+
+        self.memory_budget_input = QLineEdit()
+        self.memory_budget_input.setText(str(prefs['memory_budget_mb']))
+        self.memory_budget_input.setPlaceholderText("Memory limit in MB...")
+        self.l.addWidget(self.memory_budget_input)
+        self.memory_budget_label.setBuddy(self.memory_budget_input)
+
         self.l.addSpacing(self.spacing)
 
         # input for web user's name
@@ -357,11 +776,31 @@ class OtherConfigDialog(QDialog):
         self.web_user_checkbox.setChecked(prefs['web_user'])
         self.l.addWidget(self.web_user_checkbox)
 
+        # other users to send in the same send
+        self.user_routes_label = QLabel('<b>Also send these users\' highlights</b>, one per line, as: local:viewer '
+                                        'or web:username | vault name (optional) | title format (optional)', self)
+        self.user_routes_label.setWordWrap(True)
+        self.l.addWidget(self.user_routes_label)
+
+        self.user_routes_input = QPlainTextEdit(self)
+        self.user_routes_input.setLineWrapMode(QPlainTextEdit.LineWrapMode.NoWrap)
+        self.user_routes_input.setPlainText(user_routes_to_text(prefs['user_routes']))
+        self.user_routes_input.setPlaceholderText("web:alice | Alice's Vault | Books/{title}")
+        self.user_routes_input.setMaximumHeight(80)
+        self.l.addWidget(self.user_routes_input)
+        self.user_routes_label.setBuddy(self.user_routes_input)
+
         # checkbox for linux xdg-open
         self.linux_xdg_checkbox = QCheckBox("Use Linux xdg-open command instead of Python webbrowser.open()")
         self.linux_xdg_checkbox.setChecked(prefs['use_xdg_open'])
         self.l.addWidget(self.linux_xdg_checkbox)
 
+        # checkbox for checking that obsidian is open
+        self.check_ready_checkbox = QCheckBox("Open Obsidian and wait for it before sending (checks if Obsidian is "
+                                              "running on Linux, and sends a test note if the vault folder is set)")
+        self.check_ready_checkbox.setChecked(prefs['check_obsidian_ready'])
+        self.l.addWidget(self.check_ready_checkbox)
+
         self.l.addSpacing(self.spacing)
 
         # ok and cancel buttons
@@ -377,17 +816,42 @@ class OtherConfigDialog(QDialog):
 
     def save_settings(self):
         prefs['vault_name'] = self.vault_input.text()
+        prefs['vault_path'] = self.vault_path_input.text().strip()
+        prefs['skip_highlights_in_vault'] = self.skip_in_vault_checkbox.isChecked()
+        prefs['delivery_mode'] = self.delivery_input.currentData()
+        prefs['extra_vaults'] = text_to_extra_vaults(self.extra_vaults_input.toPlainText(), prefs['extra_vaults'])
+        prefs['sync_libraries'] = text_to_sync_libraries(self.sync_libraries_input.toPlainText(),
+                                                         prefs['sync_libraries'])
         prefs['sort_key'] = self.sort_input.text()
         max_size = self.max_size_input.text()
         prefs['max_note_size'] = max_size if max_size.isnumeric() else prefs['max_note_size']
         prefs['use_max_note_size'] = self.use_max_size_checkbox.isChecked()
         prefs['copy_header'] = self.copy_header_checkbox.isChecked()
+        prefs['continue_split_notes'] = self.continue_split_checkbox.isChecked()
+        prefs['report_long_highlights'] = self.report_long_checkbox.isChecked()
+        prefs['use_render_cache'] = self.render_cache_checkbox.isChecked()
+        prefs['skip_unchanged_books'] = self.skip_unchanged_checkbox.isChecked()
+        prefs['pipeline_send'] = self.pipeline_checkbox.isChecked()
         prefs['confirm_send_all'] = self.show_confirmation_checkbox.isChecked()
         prefs['highlights_sent_dialog'] = self.show_count_checkbox.isChecked()
+        prefs['duplicate_policy'] = self.duplicate_input.currentData()
+        prefs['delivery_order'] = self.order_input.currentData()
         username = self.web_user_name_input.text()
         prefs['web_user_name'] = "*" if username == "" else username
         prefs['web_user'] = self.web_user_checkbox.isChecked()
+        prefs['user_routes'] = text_to_user_routes(self.user_routes_input.toPlainText(), prefs['user_routes'])
         prefs['use_xdg_open'] = self.linux_xdg_checkbox.isChecked()
+        prefs['check_obsidian_ready'] = self.check_ready_checkbox.isChecked()
+
+        max_launches = self.max_launches_input.text()
+        prefs['max_launches'] = int(max_launches) if max_launches.isnumeric() and int(max_launches) > 0 \
+            else prefs['max_launches']
+
+        file_writers = self.file_writers_input.text()
+        prefs['file_writers'] = int(file_writers) if file_writers.isnumeric() else prefs['file_writers']
+
+        memory_budget = self.memory_budget_input.text()
+        prefs['memory_budget_mb'] = int(memory_budget) if memory_budget.isnumeric() else prefs['memory_budget_mb']
 
         sleep_time = self.sleep_time_input.text()
         try:
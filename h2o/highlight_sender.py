@@ -1,11 +1,21 @@
+import hashlib
+import heapq
+import itertools
+import json
 import os
+import queue
+import shutil
+import string
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import webbrowser
-from typing import Dict, List, Callable, Any, Tuple, Iterable, Union
+from typing import Dict, List, Callable, Any, Tuple, Iterable, Iterator, Union, Set, Optional, FrozenSet
 from urllib.parse import urlencode, quote
 import datetime
+import functools
 from calibre_plugins.highlights_to_obsidian.config import prefs
 
 # avoid importing anything else from calibre or the highlights_to_obsidian plugin here.
@@ -14,6 +24,16 @@ from calibre_plugins.highlights_to_obsidian.config import prefs
 # in make_sender() in button_actions.py.
 
 
+def make_obsidian_uri(obsidian_data: Dict[str, str]) -> str:
+    """
+    :param obsidian_data: should contain keys and values for 'vault', 'file', 'content', and anything
+    else you want to put into the obsidian://new url
+
+    for reference, see https://help.obsidian.md/Advanced+topics/Using+obsidian+URI#Action+new
+    """
+    return "obsidian://new?" + urlencode(obsidian_data, quote_via=quote)
+
+
 def send_item_to_obsidian(obsidian_data: Dict[str, str]) -> None:
     """
     :param obsidian_data: should contain keys and values for 'vault', 'file', 'content', and anything
@@ -21,10 +41,33 @@ def send_item_to_obsidian(obsidian_data: Dict[str, str]) -> None:
 
     for reference, see https://help.obsidian.md/Advanced+topics/Using+obsidian+URI#Action+new
     """
-    encoded_data = urlencode(obsidian_data, quote_via=quote)
-    uri = "obsidian://new?" + encoded_data
-    try:
-        if prefs['use_xdg_open']:
+    launcher = UriLauncher(prefs['use_xdg_open'], max_in_flight=1)
+    launcher(obsidian_data)
+    failures = launcher.close()
+    if failures:
+        raise ValueError(f" send_item_to_obsidian: {failures[0][1]}")
+
+
+class UriLauncher:
+    """
+    opens obsidian URIs without using a shell. the program used to open them is found once, when the launcher is
+    made, and up to max_in_flight programs can be running at once. processes that have finished are cleaned up each
+    time a new URI is opened.
+
+    URIs for the same note are never opened at the same time, so a note that was split into multiple URIs is still
+    received in order.
+
+    can be used in place of send_item_to_obsidian().
+    """
+
+    def __init__(self, use_xdg_open: bool = False, max_in_flight: int = 4):
+        """
+        :param use_xdg_open: use linux's xdg-open command instead of python's webbrowser module
+        :param max_in_flight: max number of URIs that can be opening at once
+        """
+        self.command: Optional[List[str]] = None  # command to open URIs with, URI is added to the end
+        self.browser = None  # webbrowser controller to open URIs with, if command is None
+        if use_xdg_open:
             # this is to avoid a bug on linux, where the uri is opened in web browser instead of Obsidian
             # https://docs.python.org/3/library/sys.html#sys.platform
             if sys.platform.startswith('win32'):
@@ -33,17 +76,200 @@ def send_item_to_obsidian(obsidian_data: Dict[str, str]) -> None:
                 raise NotImplementedError("Can't use xdg-open on Mac, see settings")
             else:
                 # probably a linux or unix os
-                os.system(f'xdg-open \"{uri}\"')
-                # using subprocess.run() doesn't seem to work
+                self.command = [shutil.which("xdg-open") or "xdg-open"]
+        elif sys.platform.startswith('darwin'):
+            self.command = ["open"]
         else:
-            # it might actually be better to do away with webbrowser.open() and only use os.system(). that might fix
-            #  the problem of needing to limit the max file size. would need to add support for each operating system.
-            webbrowser.open(uri)
-    except ValueError as e:
-        raise ValueError(f" send_item_to_obsidian: '{e}' in note '{obsidian_data['file']}'.\n\n"
-                         f"If this error says that the filepath is too long, try reducing the max file size in "
-                         f"the Highlights to Obsidian config (the path length that caused this error is {len(uri)}. "
-                         f"The path size will be larger than the max file size due to URL encoding).")
+            # on windows, this uses os.startfile(), which doesn't give us a process to wait for
+            try:
+                self.browser = webbrowser.get()
+            except webbrowser.Error:
+                pass  # every URI will fail, see __call__
+
+        self.max_in_flight = max(1, max_in_flight)
+        self.in_flight: Dict[subprocess.Popen, str] = {}  # {process: note file}, oldest first
+        self.failures: List[Tuple[str, str]] = []  # (note file, error message) for each URI that failed to open
+
+    def __call__(self, obsidian_data: Dict[str, str]) -> None:
+        """
+        :param obsidian_data: output of HighlightSender.make_obsidian_data()
+        """
+        self.open_uri(make_obsidian_uri(obsidian_data), obsidian_data["file"])
+
+    def open_uri(self, uri: str, note: str) -> None:
+        """
+        :param uri: any obsidian URI, e.g. obsidian://open?vault=...
+        :param note: title of the note that the URI is for. URIs for the same note are opened in order.
+        """
+        self.reap()
+        # wait for this note's previous URI, so that its parts are received in order
+        for proc, proc_note in list(self.in_flight.items()):
+            if proc_note == note:
+                self.wait(proc)
+        while len(self.in_flight) >= self.max_in_flight:
+            self.wait(next(iter(self.in_flight)))
+
+        try:
+            if self.command is None:
+                if self.browser is None or not self.browser.open(uri):
+                    self.failures.append((note, "Could not open obsidian URI."))
+                return
+            # no shell, so quotes, $, etc. in the note can't break the command
+            proc = subprocess.Popen(self.command + [uri], stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self.in_flight[proc] = note
+        except (OSError, ValueError) as e:
+            self.failures.append((note, f"'{e}' in note '{note}'.\n\n"
+                                        f"If this error says that the filepath or argument is too long, try reducing "
+                                        f"the max file size in the Highlights to Obsidian config (the path length "
+                                        f"that caused this error is {len(uri)}. The path size will be larger than "
+                                        f"the max file size due to URL encoding)."))
+
+    def finish(self, proc: subprocess.Popen) -> None:
+        note = self.in_flight.pop(proc)
+        if proc.returncode != 0:
+            self.failures.append((note, f"'{self.command[0]}' exited with code {proc.returncode} "
+                                        f"in note '{note}'."))
+
+    def wait(self, proc: subprocess.Popen) -> None:
+        proc.wait()
+        self.finish(proc)
+
+    def reap(self) -> None:
+        """
+        cleans up processes that have finished, without waiting for the others
+        """
+        for proc in list(self.in_flight):
+            if proc.poll() is not None:
+                self.finish(proc)
+
+    def close(self) -> List[Tuple[str, str]]:
+        """
+        waits for all URIs to finish opening. the launcher can still be used afterwards, e.g. by the next send.
+
+        :return: (note file, error message) for each URI that failed to open since the last time close() was called
+        """
+        for proc in list(self.in_flight):
+            self.wait(proc)
+        failures, self.failures = self.failures, []
+        return failures
+
+
+class NullTransport:
+    """
+    doesn't send anything to obsidian, only records what would have been sent. used for estimating how much a send
+    will cost.
+
+    can be used in place of send_item_to_obsidian().
+    """
+
+    def __init__(self, max_samples: int = 0):
+        """
+        :param max_samples: how many of the notes that would have been sent to keep in self.samples
+        """
+        self.chunks = 0  # number of notes that would have been sent, after splitting notes that are too long
+        self.uri_bytes = 0  # total length of the obsidian URIs that would have been opened
+        self.max_samples = max_samples
+        self.samples: List[Dict[str, str]] = []  # first few obsidian_data dicts that would have been sent
+
+    def __call__(self, obsidian_data: Dict[str, str]) -> None:
+        self.chunks += 1
+        self.uri_bytes += len(make_obsidian_uri(obsidian_data))
+        if len(self.samples) < self.max_samples:
+            self.samples.append(obsidian_data)
+
+
+def estimate_send(sender: "HighlightSender", condition: Callable[[Any], bool] = lambda x: True,
+                  max_samples: int = 0) -> Dict[str, Any]:
+    """
+    runs sender.send() without sending anything to obsidian, and measures how much the send would cost.
+
+    :param sender: HighlightSender to estimate. its transports, sleep time, and note ledger are restored afterwards.
+    :param condition: same as in HighlightSender.send()
+    :param max_samples: how many of the notes that would be sent to include in the estimate
+    :return: dict with "highlights", "notes", "chunks", "uri_bytes", "render_secs", "secs_per_highlight",
+     "send_secs" (estimated total time, including waiting between notes), and "samples" (list of
+     make_obsidian_data() outputs)
+    """
+    transport, sleep_time, note_ledger = sender.transport, sender.sleep_time, sender.note_ledger
+    target_transports = [target.transport for target in sender.targets]
+    null = NullTransport(max_samples)
+    sender.set_transport(null)
+    sender.set_sleep_time(0)
+    sender.set_note_ledger(None)  # nothing is really sent, so the ledger shouldn't change
+    for target in sender.targets:
+        target.transport = None  # use the sender's transport, i.e. null
+    try:
+        start = time.perf_counter()
+        amt = sender.send(condition)
+        render_secs = time.perf_counter() - start
+    finally:
+        sender.set_transport(transport)
+        sender.set_sleep_time(sleep_time)
+        sender.set_note_ledger(note_ledger)
+        for target, target_transport in zip(sender.targets, target_transports):
+            target.transport = target_transport
+
+    return {
+        "highlights": amt,
+        "notes": sender.stats["notes"],
+        "chunks": null.chunks,
+        "uri_bytes": null.uri_bytes,
+        "render_secs": render_secs,
+        "secs_per_highlight": render_secs / amt if amt > 0 else 0,
+        "send_secs": render_secs + null.chunks * sleep_time,
+        "samples": null.samples,
+    }
+
+
+def prefetch(items: Iterable[Any], max_ahead: int) -> Iterator[Any]:
+    """
+    gets items in a background thread, so that the next items can be made while the caller is using the current one.
+    e.g. notes can be formatted while the previous note is being sent to obsidian.
+
+    if getting an item raises an exception, it's raised here instead. if the caller stops early, the background
+    thread stops too.
+
+    :param items: iterable to get items from. it's only used by the background thread.
+    :param max_ahead: max number of items that can be waiting for the caller
+    :return: iterator over items, in the same order
+    """
+    waiting = queue.Queue(max_ahead)
+    stop = threading.Event()
+    done = object()  # put in the queue after the last item
+
+    def put(item) -> bool:
+        # don't block forever if the caller stopped and won't take any more items
+        while not stop.is_set():
+            try:
+                waiting.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+
+    thread = threading.Thread(target=produce, name="h2o-prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = waiting.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
 
 
 def format_data(dat: Dict[str, str], title: str, body: str, no_notes_body: str = None) -> List[str]:
@@ -54,6 +280,14 @@ def format_data(dat: Dict[str, str], title: str, body: str, no_notes_body: str =
 
     :return: list containing two strings: [formatted title, formatted body]
     """
+    return [format_title(dat, title), format_body(dat, body, no_notes_body)]
+
+
+def format_title(dat: Dict[str, str], title: str) -> str:
+    """
+    apply string.format() to title with data values from dat. Also removes slashes from the book's title and
+    characters that can't be used in an obsidian note's title.
+    """
 
     def remove_slashes(text: str) -> str:
         # remove slashes in the note's title, since slashes in obsidian note titles will specify a directory
@@ -75,8 +309,148 @@ def format_data(dat: Dict[str, str], title: str, body: str, no_notes_body: str =
     # brackets, we don't want to replace the part in the highlight (it'll still be replaced if the highlight contains
     # a valid placeholder though).
     pre_format = title.replace("{title}", remove_slashes(dat["title"]))
-    return [remove_illegal_title_chars(pre_format.format_map(dat)),
-            body.format_map(dat) if no_notes_body and len(dat["notes"]) > 0 else no_notes_body.format_map(dat)]
+    return remove_illegal_title_chars(pre_format.format_map(dat))
+
+
+def format_body(dat: Dict[str, str], body: str, no_notes_body: str = None) -> str:
+    """
+    apply string.format() to body with data values from dat. if there are no notes associated with a highlight,
+    then no_notes_body will be used instead of body.
+    """
+    return body.format_map(dat) if no_notes_body and len(dat["notes"]) > 0 else no_notes_body.format_map(dat)
+
+
+def template_fields(template: str) -> Optional[Set[str]]:
+    """
+    :param template: a formatting template, e.g. the body format
+    :return: names of the formatting options used in template, or None if template can't be parsed
+    """
+    try:
+        return {field[1].split(".")[0].split("[")[0] for field in string.Formatter().parse(template) if field[1]}
+    except ValueError:
+        return None
+
+
+# formatting options whose values aren't known until we know which highlights are being sent to which note.
+# compile_template() splits templates at these options, and each one's index in this tuple is used as its slot number.
+sent_format_options = ("totalsent", "booksent", "highlightsent")
+
+# a formatted template. either a string, or if the template used any sent_format_options, a tuple of formatted
+# strings and slot numbers, see compile_template() and fill_slots()
+Rendered = Union[str, Tuple[Union[str, int], ...]]
+
+
+@functools.lru_cache(maxsize=64)
+def compile_template(template: str) -> Tuple[Union[str, int], ...]:
+    """
+    splits template at the sent amount formatting options ({totalsent}, {booksent}, {highlightsent}), so that the
+    rest of it can be formatted before we know how many highlights are being sent.
+
+    results are cached, so templates that are used by many sends, e.g. when syncing several libraries, are only
+    compiled once.
+
+    :param template: a formatting template, e.g. the body format
+    :return: tuple of template pieces (str) and slots (int, the option's index in sent_format_options)
+    """
+    try:
+        parsed = list(string.Formatter().parse(template))
+    except ValueError:
+        return template,  # can't be parsed, so format_map() will raise the same error that it always has
+
+    ret = []
+    piece = ""
+    for literal, field, spec, conversion in parsed:
+        piece += literal.replace("{", "{{").replace("}", "}}")  # parse() un-escapes brackets, so escape them again
+        if field is None:
+            continue
+
+        if field in sent_format_options and not spec and not conversion:
+            if piece:
+                ret.append(piece)
+            piece = ""
+            ret.append(sent_format_options.index(field))
+        else:
+            piece += "{" + field + ("!" + conversion if conversion else "") + (":" + spec if spec else "") + "}"
+
+    if piece or not ret:
+        ret.append(piece)
+    return tuple(ret)
+
+
+def render_compiled(dat: Dict[str, str], compiled: Tuple[Union[str, int], ...],
+                    format_piece: Callable[[Dict[str, str], str], str] = None) -> Rendered:
+    """
+    :param dat: output of make_format_dict. dict containing keys and values for string formatting.
+    :param compiled: output of compile_template()
+    :param format_piece: function used to format each piece of the template, format_single() by default
+    :return: the formatted template. a string if it has no slots, otherwise a tuple of strings and slots.
+    """
+    if format_piece is None:
+        format_piece = format_single
+    if len(compiled) == 1 and isinstance(compiled[0], str):
+        return format_piece(dat, compiled[0])
+    return tuple(format_piece(dat, p) if isinstance(p, str) else p for p in compiled)
+
+
+def fill_slots(rendered: Rendered, sent: Tuple[str, str, str]) -> str:
+    """
+    :param rendered: output of render_compiled()
+    :param sent: values of (totalsent, booksent, highlightsent)
+    :return: rendered as a string, with its slots replaced by the sent amounts
+    """
+    if isinstance(rendered, str):
+        return rendered
+    return "".join(p if isinstance(p, str) else sent[p] for p in rendered)
+
+
+def slots_to_text(rendered: Rendered) -> str:
+    """
+    :return: rendered as a string, with its slots replaced by the formatting options they came from, e.g. {booksent}
+    """
+    return fill_slots(rendered, tuple("{" + o + "}" for o in sent_format_options))
+
+
+def sort_key_text(sort_key: Any) -> str:
+    """
+    :param sort_key: output of HighlightSender.format_sort_key()
+    :return: the sort key as text that sorts in the same order when compared as strings. used in section markers,
+     see vault_writer.merge_sections(), so it can't have "%" or line breaks.
+    """
+    if isinstance(sort_key, tuple):
+        # location sort keys are tuples of numbers. padding them makes them sort the same way as text. zeros at the
+        # end don't change the order, so they're left out to keep notes shorter.
+        parts = list(sort_key)
+        while parts and parts[-1] == 0:
+            parts.pop()
+        return ".".join([f"{p:010d}" if isinstance(p, int) else str(p) for p in parts])
+    return str(sort_key).replace("%", " ").replace("\n", " ")
+
+
+def wrap_rendered(before: str, rendered: Rendered, after: str) -> Rendered:
+    """
+    :return: rendered with before added to the start and after added to the end
+    """
+    if isinstance(rendered, str):
+        return before + rendered + after
+    return (before,) + rendered + (after,)
+
+
+def split_text(text: str, size: int) -> Tuple[str, str]:
+    """
+    splits the start off of a text that's too long to fit in a note, at a paragraph break if there is one, else at a
+    line break, the end of a sentence, or a space. if there are none of those, it's cut at size.
+
+    :param size: max length of the first piece. must be more than 0.
+    :return: (first piece, rest of the text). rest is empty if the whole text fits.
+    """
+    if len(text) <= size:
+        return text, ""
+    for sep in ("\n\n", "\n", ". ", " "):
+        idx = text.rfind(sep, 1, size - len(sep) + 1)
+        if idx > 0:
+            cut = idx + len(sep)
+            return text[:cut], text[cut:]
+    return text[:size], text[size:]
 
 
 def format_single(dat: Dict[str, str], item_format: str) -> str:
@@ -93,69 +467,105 @@ def format_single(dat: Dict[str, str], item_format: str) -> str:
     return item_format.format_map(dat)
 
 
-def make_time_format_dict(data: Dict) -> Dict[str, str]:
+# functions that make each time-related formatting option from the (utc time, local time) that a highlight was made.
+# see make_time_format_dict() and TimeOptions.
+_time_options: Dict[str, Callable[[datetime.datetime, datetime.datetime], str]] = {
+    "date": lambda h_time, h_local: str(h_time.date()),  # utc date highlight was made
+    # local date highlight was made. "local" based on send time, not highlight time
+    "localdate": lambda h_time, h_local: str(h_local.date()),
+    "time": lambda h_time, h_local: str(h_time.time()),  # utc time highlight was made
+    "localtime": lambda h_time, h_local: str(h_local.time()),  # local time highlight was made
+    "datetime": lambda h_time, h_local: str(h_time),
+    "localdatetime": lambda h_time, h_local: str(h_local),
+    # calibre uses local time when making annotations. see function "render_timestamp"
+    # https://github.com/kovidgoyal/calibre/blob/master/src/calibre/gui2/library/annotations.py#L34
+    # todo: timezone currently displays "Coordinated Universal Time" instead of the abbreviation, "UTC"
+    "timezone": lambda h_time, h_local: h_local.tzname(),  # local timezone
+    # so that the config menu's explanation doesn't confuse users
+    "localtimezone": lambda h_time, h_local: h_local.tzname(),
+    "day": lambda h_time, h_local: f"{h_time.day:02}",
+    "localday": lambda h_time, h_local: f"{h_local.day:02}",
+    "month": lambda h_time, h_local: f"{h_time.month:02}",
+    "localmonth": lambda h_time, h_local: f"{h_local.month:02}",
+    "year": lambda h_time, h_local: f"{h_time.year:04}",
+    "localyear": lambda h_time, h_local: f"{h_local.year:04}",
+    "hour": lambda h_time, h_local: f"{h_time.hour:02}",
+    "localhour": lambda h_time, h_local: f"{h_local.hour:02}",
+    "minute": lambda h_time, h_local: f"{h_time.minute:02}",
+    "localminute": lambda h_time, h_local: f"{h_local.minute:02}",
+    "second": lambda h_time, h_local: f"{h_time.second:02}",
+    "localsecond": lambda h_time, h_local: f"{h_local.second:02}",
+    # Unix timestamp of highlight time. uses UTC.
+    "timestamp": lambda h_time, h_local: str(h_time.timestamp()),
+}
+
+
+def make_time_format_dict(data: "HighlightRecord") -> Dict[str, str]:
     """
 
-    :param data: json object of a calibre highlight
+    :param data: HighlightRecord of a calibre highlight
     :return: dict containing all time-related formatting options
     """
+    h_time, h_local = data.times()
+    return {option: make(h_time, h_local) for option, make in _time_options.items()}
+
 
-    annot = data["annotation"]
+class TimeOptions:
+    """
+    the time-related formatting options of a highlight, for use as a layer of a LayeredDict. unlike
+    make_time_format_dict(), options are only made when they're looked up, since templates usually only use a few of
+    them and a highlight is formatted more than once (its title when it's grouped, its body when it's sent).
+    """
+    __slots__ = ("data",)
 
-    # calibre's time format example: "2022-09-10T20:32:08.820Z"
-    # the "Z" at the end means UTC time
-    # "%Y-%m-%dT%H:%M:%S", take [:19] of the timestamp to remove milliseconds
-    # better alternative might be dateutil.parser.parse
-    h_time = datetime.datetime.strptime(annot["timestamp"][:19], "%Y-%m-%dT%H:%M:%S")
-    h_local = h_time + h_time.astimezone(datetime.datetime.now().tzinfo).utcoffset()
+    def __init__(self, data: "HighlightRecord"):
+        self.data = data
+
+    def get(self, key: str, default: Any = None) -> Any:
+        make = _time_options.get(key)
+        if make is None:
+            return default
+        return make(*self.data.times())
+
+
+# formatting options that depend on when highlights are sent rather than on the highlight itself. the utc offset
+# changes with daylight saving time.
+now_format_options = ("utcnow", "datenow", "timenow", "localnow", "localdatenow", "localtimenow",
+                      "utcoffset", "localoffset", "timeoffset")
+
+
+def make_send_format_dict() -> Dict[str, str]:
+    """
+    :return: dict containing formatting options that are the same for every highlight in a send: the current time,
+     the computer's utc offset, and placeholders for the sent amount formatting options
+    """
     local = time.localtime()
     utc = time.gmtime()
     utc_offset = ("" if local.tm_gmtoff < 0 else "+") + str(local.tm_gmtoff // 3600) + ":00"
 
-    time_options = {
-        "date": str(h_time.date()),  # utc date highlight was made
-        "localdate": str(h_local.date()),
-        # local date highlight was made. "local" based on send time, not highlight time
-        "time": str(h_time.time()),  # utc time highlight was made
-        "localtime": str(h_local.time()),  # local time highlight was made
-        "datetime": str(h_time),
-        "localdatetime": str(h_local),
-        # calibre uses local time when making annotations. see function "render_timestamp"
-        # https://github.com/kovidgoyal/calibre/blob/master/src/calibre/gui2/library/annotations.py#L34
-        # todo: timezone currently displays "Coordinated Universal Time" instead of the abbreviation, "UTC"
-        "timezone": h_local.tzname(),  # local timezone
-        "localtimezone": h_local.tzname(),  # so that the config menu's explanation doesn't confuse users
+    send_options = {
         "utcoffset": utc_offset,
         "localoffset": utc_offset,  # so that the config menu's explanation doesn't confuse users
         "timeoffset": utc_offset,  # for backwards compatibility
-        "day": f"{h_time.day:02}",
-        "localday": f"{h_local.day:02}",
-        "month": f"{h_time.month:02}",
-        "localmonth": f"{h_local.month:02}",
-        "year": f"{h_time.year:04}",
-        "localyear": f"{h_local.year:04}",
-        "hour": f"{h_time.hour:02}",
-        "localhour": f"{h_local.hour:02}",
-        "minute": f"{h_time.minute:02}",
-        "localminute": f"{h_local.minute:02}",
-        "second": f"{h_time.second:02}",
-        "localsecond": f"{h_local.second:02}",
         "utcnow": time.strftime("%Y-%m-%d %H:%M:%S", utc),
         "datenow": time.strftime("%Y-%m-%d", utc),
         "timenow": time.strftime("%H:%M:%S", utc),
         "localnow": time.strftime("%Y-%m-%d %H:%M:%S", local),
         "localdatenow": time.strftime("%Y-%m-%d", local),
         "localtimenow": time.strftime("%H:%M:%S", local),
-        "timestamp": str(h_time.timestamp()),  # Unix timestamp of highlight time. uses UTC.
     }
 
-    return time_options
+    # these formatting options can't be calculated until we know which highlights are being sent to which note.
+    # we need to include this so that string.format() doesn't error if it runs into one of these
+    send_options.update(make_sent_format_dict("{totalsent}", "{booksent}", "{highlightsent}"))
+
+    return send_options
 
 
-def make_highlight_format_dict(data: Dict, calibre_library: str) -> Dict[str, str]:
+def make_highlight_format_dict(data: "HighlightRecord", calibre_library: str) -> Dict[str, str]:
     """
 
-    :param data: json object of a calibre highlight
+    :param data: HighlightRecord of a calibre highlight
     :param calibre_library: name of library book is found in. used for making a url to the highlight.
     :return: dict containing all highlight-related formatting options.
     """
@@ -163,8 +573,6 @@ def make_highlight_format_dict(data: Dict, calibre_library: str) -> Dict[str, st
     def format_blockquote(text: str) -> str:
         return "> " + text.replace("\n", "\n> ")
 
-    annot = data["annotation"]
-
     # format is calibre://view-book/<Library_Name>/<book_id>/<book_format>?open_at=<location>
     # for example, calibre://view-book/Calibre_Library/39/EPUB?open_at=epubcfi(/8/2/4/84/1:184)
     # todo: right now, opening two different links from the same book opens two different viewer windows,
@@ -172,45 +580,99 @@ def make_highlight_format_dict(data: Dict, calibre_library: str) -> Dict[str, st
     url_format = "calibre://view-book/{library}/{book_id}/{book_format}?open_at=epubcfi({location})"
     url_args = {
         "library": calibre_library.replace(" ", "_"),
-        "book_id": data["book_id"],
-        "book_format": data["format"],
-        # the algorithm for this, "/{2 * (spine_index + 1)}", is taken from:
-        # read_book.annotations.AnnotationsManager.cfi_for_highlight(uuid, spine_index)
-        # https://github.com/kovidgoyal/calibre/blob/master/src/pyj/read_book/annotations.pyj#L249
-        # i didn't import the algorithm from calibre because it was too inconvenient to figure out how
-        #
-        # unfortunately, this doesn't work without the spine index thing. the location is missing a number.
-        # it should be, for example /8/2/4/84/1:184, but instead, data["start_cfi"] is /2/4/84/1:184.
-        # the first number in the cfi address has to be manually calculated.
-        "location": "/" + str((annot["spine_index"] + 1) * 2) + annot["start_cfi"],
+        "book_id": data.book_id,
+        "book_format": data.format,
+        "location": highlight_location(data),
     }
 
     highlight_format = {
-        "highlight": annot["highlighted_text"],  # highlighted text
-        "blockquote": format_blockquote(annot["highlighted_text"]),  # block-quoted highlight
-        "notes": annot["notes"] if "notes" in annot else "",  # user's notes on this highlight
+        "highlight": data.highlighted_text,  # highlighted text
+        "blockquote": format_blockquote(data.highlighted_text),  # block-quoted highlight
+        "notes": data.notes,  # user's notes on this highlight
         "url": url_format.format(**url_args),  # calibre:// url to open ebook viewer to this highlight
         "location": url_args["location"],  # epub cfi location of this highlight
-        "uuid": annot["uuid"],  # highlight's ID in calibre
+        "uuid": data.uuid,  # highlight's ID in calibre
+        # marks which highlights are already in a note, as an obsidian comment. must match vault_index.py.
+        "uuidmarker": "%%h2o:" + data.uuid + "%%",
     }
 
     return highlight_format
 
 
-def make_book_format_dict(data: Dict, book_titles_authors: Dict[int, Dict[str, str]]) -> Dict[str, str]:
+def parse_location(location: str) -> Tuple[List[int], List[int]]:
+    """
+    :param location: an epub cfi location, like the {location} formatting option, e.g. "/2/8/6/5:192"
+    :return: (steps, end). for "/2/8/6/5:192", steps is [2, 8, 6] and end is [5, 192].
     """
+    locs = location.split("/")  # first element is empty string since location starts with "/"
+    locs, end = locs[1:-1], locs[-1]
+
+    def get_num(x):
+        # x[:x.find("[")] to catch locations with "[pXXX]" in them (XXX is a page number).
+        # these locations seem to show up when there's more than one highlight in the same paragraph.
+        y = x.find("[")
+        if y == -1:
+            return int(x)
+        else:
+            return int(x[:y])
 
-    :param data: json object of a calibre highlight
-    :param book_titles_authors: dictionary mapping book ids to {"title": title, "authors": authors}
-    :return: dict containing all book-related formatting options
+    return [get_num(x) for x in locs], [get_num(x) for x in end.split(":")]
+
+
+def location_key(location: str) -> Tuple[int, ...]:
+    """
+    unlike the location sort key, this isn't padded to a fixed length, so it correctly compares locations that are
+    at different depths in the book, e.g. a highlight and the start of a chapter.
+
+    :param location: an epub cfi location, see parse_location()
+    :return: key for comparing locations by their position in the book
+    """
+    steps, end = parse_location(location)
+    return tuple(steps + end)
+
+
+def highlight_location(data: "HighlightRecord") -> str:
+    """
+    :return: the highlight's epub cfi location in its book, used for the {location} formatting option
     """
-    title_authors = book_titles_authors.get(int(data["book_id"]), {})  # dict with {"title": str, "authors": Tuple[str]}
+    # the algorithm for this, "/{2 * (spine_index + 1)}", is taken from:
+    # read_book.annotations.AnnotationsManager.cfi_for_highlight(uuid, spine_index)
+    # https://github.com/kovidgoyal/calibre/blob/master/src/pyj/read_book/annotations.pyj#L249
+    # i didn't import the algorithm from calibre because it was too inconvenient to figure out how
+    #
+    # unfortunately, this doesn't work without the spine index thing. the location is missing a number.
+    # it should be, for example /8/2/4/84/1:184, but instead, data["start_cfi"] is /2/4/84/1:184.
+    # the first number in the cfi address has to be manually calculated.
+    return "/" + str((data.spine_index + 1) * 2) + data.start_cfi
 
+
+# formatting options that are the same for every highlight in a book, see make_book_format_dict()
+book_format_options = ("title", "authors", "bookid")
+
+
+def is_per_book_template(template: str) -> bool:
+    """
+    :param template: a formatting template, e.g. the title format
+    :return: True if template only uses formatting options that are the same for every highlight in a book during a
+     send, e.g. "Books/{title} by {authors}", so it only needs to be formatted once per book
+    """
+    fields = template_fields(template)
+    if fields is None:
+        return False
+    per_book = set(book_format_options) | set(make_send_format_dict())
+    return fields <= per_book
+
+
+def make_book_format_dict(data: "HighlightRecord") -> Dict[str, str]:
+    """
+
+    :param data: HighlightRecord of a calibre highlight
+    :return: dict containing all book-related formatting options
+    """
     format_options = {
-        "title": title_authors.get("title", "Untitled"),  # title of book
-        # todo: add "chapter" option
-        "authors": title_authors.get("authors", ("Unknown",)),  # authors of book
-        "bookid": data["book_id"],
+        "title": data.title,  # title of book
+        "authors": data.authors,  # authors of book
+        "bookid": data.book_id,
     }
 
     return format_options
@@ -234,11 +696,15 @@ def make_sent_format_dict(total_sent, book_sent, highlight_sent) -> Dict[str, st
     return sent_dict
 
 
-def make_format_dict(data, calibre_library: str, book_titles_authors: Dict[int, Dict[str, str]]) -> Dict[str, str]:
+def make_format_dict(data: "HighlightRecord", calibre_library: str, book_options: Dict[str, str] = None,
+                     send_options: Dict[str, str] = None) -> Dict[str, str]:
     """
-    :param data: json object of a calibre highlight
+    :param data: HighlightRecord of a calibre highlight
     :param calibre_library: name of the calibre library, to make a url to the highlight
-    :param book_titles_authors: dictionary mapping book ids to {"title": title, "authors": authors}
+    :param book_options: output of make_book_format_dict for this highlight's book. since it's the same for every
+     highlight in a book, it can be made once and shared. if None, it will be made here.
+    :param send_options: output of make_send_format_dict. can be shared by every highlight in a send. if None, it
+     will be made here.
     :return: dict[str, str] containing formatting options
     """
 
@@ -248,18 +714,118 @@ def make_format_dict(data, calibre_library: str, book_titles_authors: Dict[int,
     #  only calculating values for those options
 
     # if you add a format option, also update the format_options local variable in config.py and the docs in README.md
-    time_options = make_time_format_dict(data)
+    time_options = TimeOptions(data)
     highlight_options = make_highlight_format_dict(data, calibre_library)
-    book_options = make_book_format_dict(data, book_titles_authors)
+    if book_options is None:
+        book_options = make_book_format_dict(data)
+    if send_options is None:
+        send_options = make_send_format_dict()
 
-    # these formatting options can't be calculated by the time make_format_dict is called.
-    # actually, totalsent probably could be, but let's keep it here with the others.
-    # we need to include this so that string.format() doesn't error if it runs into one of these
-    placeholders = make_sent_format_dict("{totalsent}", "{booksent}", "{highlightsent}")
+    # layers are searched in order, so highlight-specific options come first. none of the layers are copied.
+    return LayeredDict(time_options, highlight_options, book_options, send_options)
+
+
+def dedupe_highlights(highlights: Iterable[Dict], policy: str = "all",
+                      per_user: bool = False) -> Tuple[List[Dict], int]:
+    """
+    removes highlights that have the same text and notes as another highlight in the same book, e.g. when the same
+    passage was highlighted in both the EPUB and the AZW3 of a book, or by both the local user and a web user.
+
+    runs in a single pass over highlights, using a dict keyed on (book_id, normalized highlighted text, notes).
+
+    :param highlights: calibre annotation objects, as returned by all_annotations()
+    :param policy: "all" to keep every highlight, "first" to keep the first copy that was found, or "newest" to keep
+     the copy with the latest timestamp
+    :param per_user: if True, only highlights made by the same user can be duplicates of each other
+    :return: (list of highlights that should be kept, number of duplicates that were dropped)
+    """
+    if policy not in ("first", "newest"):
+        return list(highlights), 0
+
+    kept: List[Dict] = []
+    seen: Dict[tuple, int] = {}  # {dedupe key: index in kept}
+    dropped = 0
+
+    for h in highlights:
+        annot = h["annotation"]
+        # normalize whitespace and case, since different formats of the same book don't always break lines the same way
+        text = " ".join(annot.get("highlighted_text", "").split()).casefold()
+        key = (int(h["book_id"]), text, annot.get("notes") or "")
+        if per_user:
+            key += (h.get("user_type"), h.get("user"))
+
+        idx = seen.get(key)
+        if idx is None:
+            seen[key] = len(kept)
+            kept.append(h)
+            continue
 
-    # the | operator merges dictionaries https://peps.python.org/pep-0584/
-    # could also pass a dict as a param to each make_x_dict, and have them update it in place
-    return SafeDict(**time_options, **highlight_options, **book_options, **placeholders)
+        dropped += 1
+        # calibre's timestamps are all formatted the same way, e.g. "2022-09-10T20:32:08.820Z", so we can
+        # compare them as strings
+        if policy == "newest" and annot["timestamp"] > kept[idx]["annotation"]["timestamp"]:
+            kept[idx] = h
+
+    return kept, dropped
+
+
+class HighlightRecord:
+    """
+    the fields of a calibre highlight that are needed for formatting and sorting it.
+
+    calibre's annotation objects are nested dicts with many fields we never use, and there can be a lot of them, so
+    each highlight is converted to one of these as soon as we know it will be sent. strings that are repeated across
+    many highlights (formats, users, titles, authors) are interned so that every record shares one copy of them.
+    """
+    __slots__ = ("book_id", "format", "user_type", "user", "uuid", "timestamp",
+                 "highlighted_text", "notes", "spine_index", "start_cfi", "title", "authors", "_times")
+
+    def __init__(self, book_id: int, book_format: str, user_type: str, user: str, uuid: str, timestamp: str,
+                 highlighted_text: str, notes: str, spine_index: int, start_cfi: str, title: str, authors: str):
+        self.book_id = book_id
+        self.format = sys.intern(book_format)
+        self.user_type = sys.intern(user_type)
+        self.user = sys.intern(user)
+        self.uuid = uuid
+        self.timestamp = timestamp  # calibre's time format, e.g. "2022-09-10T20:32:08.820Z"
+        self.highlighted_text = highlighted_text
+        self.notes = notes
+        self.spine_index = spine_index
+        self.start_cfi = start_cfi
+        self.title = sys.intern(title)
+        self.authors = sys.intern(authors)
+        self._times: Tuple[datetime.datetime, datetime.datetime] = None  # see times()
+
+    def times(self) -> Tuple[datetime.datetime, datetime.datetime]:
+        """
+        :return: (utc time, local time) that the highlight was made. the timestamp is only parsed the first time,
+         since the highlight is formatted again when it's sent.
+        """
+        if self._times is None:
+            # calibre's time format example: "2022-09-10T20:32:08.820Z"
+            # the "Z" at the end means UTC time
+            # "%Y-%m-%dT%H:%M:%S", take [:19] of the timestamp to remove milliseconds
+            # better alternative might be dateutil.parser.parse
+            h_time = datetime.datetime.strptime(self.timestamp[:19], "%Y-%m-%dT%H:%M:%S")
+            h_local = h_time + h_time.astimezone(datetime.datetime.now().tzinfo).utcoffset()
+            self._times = (h_time, h_local)
+        return self._times
+
+    @classmethod
+    def from_annotation(cls, data: Dict, book_titles_authors: Dict[int, Dict[str, str]]) -> "HighlightRecord":
+        """
+        :param data: json object of a calibre highlight, as returned by all_annotations()
+        :param book_titles_authors: dictionary mapping book ids to {"title": title, "authors": authors}
+        :return: a HighlightRecord with the data of the given highlight
+        """
+        annot = data["annotation"]
+        book_id = int(data["book_id"])
+        title_authors = book_titles_authors.get(book_id, {})  # dict with {"title": str, "authors": str}
+
+        return cls(book_id, data.get("format") or "", data.get("user_type") or "", data.get("user") or "",
+                   annot["uuid"], annot["timestamp"], annot["highlighted_text"], annot.get("notes", ""),
+                   annot["spine_index"], annot["start_cfi"],
+                   title_authors.get("title", "Untitled"), title_authors.get("authors", "Unknown"))
 
 
 class SafeDict(dict):
@@ -273,6 +839,53 @@ class SafeDict(dict):
         return "{" + key + "}"
 
 
+class LayeredDict(SafeDict):
+    def __init__(self, *layers: Dict[str, str], **kwargs):
+        """a SafeDict that looks up keys it doesn't have in each of layers, in order. the layers aren't copied, so
+        they can be shared between many LayeredDicts, e.g. one layer for the whole send and one layer per book.
+
+        if a key isn't found in this dict or any of its layers, will return the key with {curly brackets}."""
+        super().__init__(**kwargs)
+        self.layers = layers
+
+    def __missing__(self, key):
+        for layer in self.layers:
+            # dict.get() doesn't call __missing__, so a SafeDict layer won't hide the layers after it
+            value = layer.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+        return "{" + key + "}"
+
+
+_MISSING = object()  # sentinel for LayeredDict lookups
+
+# rough number of bytes that a note uses in memory, not counting its text. see BookList.spill()
+_note_overhead = 400
+
+
+def _note_text_size(note: Union[Rendered, "HighlightRecord"]) -> int:
+    """
+    :return: length of a note's text. for a HighlightRecord, the length of its highlighted text and notes.
+    """
+    if isinstance(note, HighlightRecord):
+        return len(note.highlighted_text) + len(note.notes)
+    if isinstance(note, str):
+        return len(note)
+    return sum([len(p) for p in note if isinstance(p, str)])
+
+
+def _note_memory(note: Union[Rendered, "HighlightRecord"]) -> int:
+    """
+    :return: rough number of bytes that a note in a BookData uses in memory
+    """
+    return _note_overhead + _note_text_size(note)
+
+
+def _from_json(value: Any) -> Any:
+    # json turns tuples into lists, but sort keys and rendered notes need to be tuples
+    return tuple(value) if isinstance(value, list) else value
+
+
 class BookData:
     # todo: refactor: make a BookData class to store data of book title(s), highlight, length, count, etc
     #  BookData: fields for title, header, list of notes and sort keys or dict of {sort_key: note}?
@@ -280,24 +893,43 @@ class BookData:
     #  BookList: holds a dict of string titles of books with a BookData for each one.
     #            functions for add(title, BookData), split long dataset into multiple books, get base title
     #                of a split book, etc
-    def __init__(self, title: str, header: str = None, notes: List[List[Union[str, Any]]] = None):
+    def __init__(self, title: str, header: Rendered = None,
+                 notes: List[List[Union[Rendered, HighlightRecord, Any]]] = None,
+                 renderer: Callable[[HighlightRecord, Any], Rendered] = None):
         """
 
         :param title: book's title
         :param header: header to be used when notes are sent to Obsidian
-        :param notes: list of [note_content, sort_key]
+        :param notes: list of [note_content, sort_key]. note_content is either formatted text or a HighlightRecord.
+        :param renderer: function that makes a note's text from a HighlightRecord and its sort key. records aren't
+         turned into text until make_sendable_notes() is called, so that we don't keep every formatted note in memory
+         at once.
         """
 
         self._title = title
         self._header = header
+        self.renderer = renderer
+        # formatted title with slots for sent amounts, see render_compiled(). if None, self.title is used as is.
+        self.title_parts: Rendered = None
+        # (totalsent, booksent) to fill slots with when notes are sent, see BookList.apply_sent_amount_format()
+        self.sent_amounts: Tuple[str, str] = ("{totalsent}", "{booksent}")
+        # notes that were moved out of memory, see spill()
+        self.spill_path: str = None
+        self.spilled_runs: List[Tuple[int, int]] = []  # (file position, number of notes) of each sorted run
+        self.spilled = 0  # number of notes in spilled_runs
+        self.unsorted = False  # True if any note was added without a sort key
+        # used for deciding which notes to send first, see delivery_orders
+        self.newest = ""  # timestamp of the most recent highlight in this note
+        self.book_ids: Set[int] = set()  # books whose highlights are in this note
+        self.text_size = 0  # total length of the notes' text, see _note_text_size()
         if notes is not None:
-            self.notes: List[List[Union[str, Any]]] = list(sorted(notes, key=lambda n: n[1]))
+            self.notes: List[List[Union[str, HighlightRecord, Any]]] = list(sorted(notes, key=lambda n: n[1]))
         else:
-            self.notes: List[List[Union[str, Any]]] = []  # List[List[note:str, sort_key:Any]]
+            self.notes: List[List[Union[str, HighlightRecord, Any]]] = []  # List[List[note, sort_key:Any]]
 
     def __len__(self):
         """ number of notes that this book has """
-        return len(self.notes)
+        return len(self.notes) + self.spilled
 
     @property
     def title(self) -> str:
@@ -312,24 +944,112 @@ class BookData:
         self._title = title
 
     @property
-    def header(self) -> str:
+    def header(self) -> Rendered:
         return self._header
 
     @header.setter
-    def header(self, header: str) -> None:
+    def header(self, header: Rendered) -> None:
         self._header = header
 
-    def add_note(self, note: str, sort_key: Any = None) -> None:
+    def sendable_title(self) -> str:
+        """
+        :return: this book's title, with sent amounts filled in
+        """
+        title = self.title_parts if self.title_parts is not None else self.title
+        return fill_slots(title, (self.sent_amounts[0], self.sent_amounts[1], "-1"))
+
+    def sendable_header(self) -> str:
+        """
+        :return: this book's header, with sent amounts filled in
+        """
+        return fill_slots(self.header or "", (self.sent_amounts[0], self.sent_amounts[1], "-1"))
+
+    def add_note(self, note: Union[Rendered, HighlightRecord], sort_key: Any = None) -> None:
         """
-        :param note: text of note to add to this book's notes
+        :param note: text or HighlightRecord of note to add to this book's notes
         :param sort_key: sort key to use when merging book's notes into a single string
         :return: none
         """
+        if isinstance(note, HighlightRecord):
+            # calibre's timestamps all have the same format, so they can be compared as strings
+            self.newest = max(self.newest, note.timestamp)
+            self.book_ids.add(note.book_id)
+        self.text_size += _note_text_size(note)
         self.insort_note([note, sort_key])
 
-    def update_note(self, idx: int, new_note: str) -> None:
+    def update_note(self, idx: int, new_note: Rendered) -> None:
+        """
+        :param idx: index of a note that's in memory, i.e. in self.notes
+        """
         self.notes[idx][0] = new_note
 
+    def render_note(self, note: Union[Rendered, HighlightRecord], sort_key: Any = None) -> Rendered:
+        return self.renderer(note, sort_key) if isinstance(note, HighlightRecord) else note
+
+    @staticmethod
+    def note_uuid(note: Union[Rendered, HighlightRecord]) -> Optional[str]:
+        """
+        :return: uuid of the note's highlight, or None if the note is text that wasn't made from a highlight
+        """
+        return note.uuid if isinstance(note, HighlightRecord) else None
+
+    def spill(self, path: str) -> int:
+        """
+        renders the notes that are in memory and appends them to a file as a sorted run, then removes them from
+        memory. make_sendable_notes() merges the runs back together with the notes that are still in memory.
+
+        :param path: file to append the notes to. every spill of this book must use the same file.
+        :return: number of notes that were spilled
+        """
+        if len(self.notes) == 0:
+            return 0
+
+        self.spill_path = path
+        with open(path, "ab") as f:
+            f.seek(0, os.SEEK_END)
+            start = f.tell()
+            for note, sort_key in self.notes:
+                # json escapes newlines, so each note is one line
+                line = [self.render_note(note, sort_key), sort_key, self.note_uuid(note)]
+                f.write(json.dumps(line, ensure_ascii=False).encode("utf-8") + b"\n")
+
+        spilled = len(self.notes)
+        self.spilled_runs.append((start, spilled))
+        self.spilled += spilled
+        self.notes = []
+        return spilled
+
+    def read_run(self, start: int, count: int) -> Iterable[List[Any]]:
+        """
+        :param start: file position of a run made by spill()
+        :param count: number of notes in the run
+        :return: yields [rendered note, sort_key, uuid] for each note in the run
+        """
+        with open(self.spill_path, "rb") as f:
+            f.seek(start)
+            for _ in range(count):
+                note, sort_key, uuid = json.loads(f.readline())
+                yield [_from_json(note), _from_json(sort_key), uuid]
+
+    def rendered_notes(self) -> Iterable[Tuple[Rendered, Optional[str]]]:
+        """
+        :return: yields (rendered note, uuid) for each of this book's notes, in sorted order. includes notes that
+         were spilled. see note_uuid().
+        """
+        in_memory = ([self.render_note(note, sort_key), sort_key, self.note_uuid(note)]
+                     for note, sort_key in self.notes)
+        if not self.spilled_runs:
+            runs = in_memory
+        elif self.unsorted:
+            runs = itertools.chain(*[self.read_run(*r) for r in self.spilled_runs], in_memory)
+        else:
+            # each run is sorted, and merge() keeps notes with the same sort key in the order they were added, since
+            # runs are in the order they were spilled
+            runs = heapq.merge(*[self.read_run(*r) for r in self.spilled_runs], in_memory, key=lambda n: n[1])
+
+        for note in runs:
+            yield note[0], note[2]
+
     def insort_note(self, note: List[Union[str, Any]]):
         """ copied and modified from bisect.insort_right(...)
 
@@ -339,6 +1059,7 @@ class BookData:
         """
         sort_key = note[1]
         if sort_key is None:
+            self.unsorted = True
             self.notes.append(note)
             return
 
@@ -351,51 +1072,156 @@ class BookData:
                 lo = mid + 1
         self.notes.insert(lo, note)
 
-    def make_sendable_notes(self, max_size: int = -1, copy_header: bool = False) -> Iterable[Tuple[str, str]]:
+    @staticmethod
+    def part_title(base_title: str, part: int) -> str:
+        """
+        :return: title of one part of a note that's split into multiple parts, e.g. "The Book (1)" for part 1
+        """
+        return base_title if part == 0 else base_title + f" ({part})"
+
+    @staticmethod
+    def part_number(base_title: str, title: str) -> int:
+        """
+        :return: which part of a split note title is, e.g. 1 for "The Book (1)". see part_title().
+        """
+        return 0 if title == base_title else int(title[len(base_title) + 2:-1])
+
+    def make_placed_notes(self, max_size: int, copy_header: bool, part_sizes: List[int],
+                          placed: Dict[str, int]) -> Iterable[Tuple[str, str, List[Optional[str]]]]:
+        """
+        like make_sendable_notes(), but for a note whose sections are already in some of its parts, see
+        vault_writer.VaultFileWriter.section_parts(). highlights that are already in a part are sent to that part,
+        so that merge_sections() replaces them instead of adding a second copy to another part. other highlights are
+        added to the last part until it's full, then to new parts. every highlight must fit in a note by itself.
+
+        :param max_size: maximum allowed size of a note. must be more than 0.
+        :param copy_header: see make_sendable_notes()
+        :param part_sizes: length of each part of this note that's already in the vault
+        :param placed: {uuid: part that already has the highlight's section}
+        :return: yields (title, contents, uuids) of each part that gets highlights, in order of their part numbers
+        """
+        base_title = self.sendable_title()
+        base_header = self.sendable_header()
+        parts: Dict[int, Tuple[List[str], List[Optional[str]]]] = {}  # {part: (texts, uuids)}
+
+        def add(part: int, text: str, uuid: Optional[str]) -> None:
+            texts, uuids = parts.setdefault(part, ([], []))
+            texts.append(text)
+            uuids.append(uuid)
+
+        part = max(len(part_sizes) - 1, 0)  # part that new highlights are added to
+        used = part_sizes[part] if part_sizes else len(base_header)  # length of that part, counting what's added
+        for idx, (rendered, uuid) in enumerate(self.rendered_notes()):
+            # since notes are sent in sorted order, idx is the number of notes that are sent before this one
+            text = fill_slots(rendered, (self.sent_amounts[0], self.sent_amounts[1], str(idx + 1)))
+            if uuid in placed:
+                # replacing a section doesn't change its part's length much, so it isn't counted
+                add(placed[uuid], text, uuid)
+                continue
+
+            # a new part that has nothing in it yet always takes the highlight. send() checks that it fits beforehand.
+            empty = part >= len(part_sizes) and part not in parts
+            if used + len(text) > max_size and not empty:
+                part += 1
+                used = len(base_header) if copy_header else 0
+            add(part, text, uuid)
+            used += len(text)
+
+        for part in sorted(parts):
+            texts, uuids = parts[part]
+            # the header is only needed in parts that aren't in the vault yet, since merge_sections() ignores it
+            header = base_header if part >= len(part_sizes) and (copy_header or part == 0) else ""
+            yield self.part_title(base_title, part), header + "".join(texts), uuids
+
+    def make_sendable_notes(self, max_size: int = -1, copy_header: bool = False, part_sizes: List[int] = None,
+                            split_long: bool = True) -> Iterable[Tuple[str, str, List[Optional[str]]]]:
         """
         merges this book's notes into a single string.
 
         This limits the length of merged note contents to max_size. If the length exceeds this, extra
-        highlights will use a different title, e.g. "The Book", "The Book (1)", etc
+        highlights will use a different title, e.g. "The Book", "The Book (1)", etc. A highlight that's too long to
+        fit in a note by itself is split between notes at paragraph or sentence breaks, see split_text().
 
         :param max_size: maximum allowed size of a note (notes might be longer after headers are added)
         :param copy_header: if a single note is split into multiple, should the header be copied into each one,
         or should only the first note have a header?
-        :return: yields an iterable of tuples of (title, contents) pairs
+        :param part_sizes: length of each part of this note that's already in obsidian, see note_ledger.NoteLedger.
+         if given, notes are added to the last part until it's full, and new parts are numbered after it.
+        :param split_long: whether a highlight that's too long for a note by itself can be split. if False, a
+         RuntimeError is raised instead. HighlightSender.send() checks for these highlights before sending when
+         they can't be split.
+        :return: yields an iterable of tuples of (title, contents, uuids). uuids has the uuid of each highlight in
+         contents, see note_uuid().
         """
 
+        base_title = self.sendable_title()
+        base_header = self.sendable_header()
+
+        def fill(idx: int, rendered: Rendered) -> str:
+            # since notes are sent in sorted order, idx is the number of notes that are sent before this one
+            return fill_slots(rendered, (self.sent_amounts[0], self.sent_amounts[1], str(idx + 1)))
+
         if max_size == -1:
-            yield self.title, self.header + "".join([n[0] for n in self.notes])
+            texts, uuids = [], []
+            for idx, (rendered, uuid) in enumerate(self.rendered_notes()):
+                texts.append(fill(idx, rendered))
+                uuids.append(uuid)
+            yield base_title, base_header + "".join(texts), uuids
             return
 
         _accum = ""  # accumulated notes to be sent
+        _uuids = []  # uuids of the notes in _accum
         _sent = 0  # number of notes that have been returned so far
-
-        for idx in range(len(self)):
-            header = self.header if copy_header or _sent == 0 else ""
-            note_size = len(header) + len(_accum)
-
-            if len(self.notes[idx][0]) + len(header) > max_size:
-                # this handles the case of when the header + a single note is bigger than max note size. also catches
-                # cases where the note by itself is too long.
-                raise RuntimeError(f"NOTE EXCEEDS MAX LENGTH OF {max_size} CHARACTERS: "
-                                   f"'{self.title[:30]}', NOTE TEXT: '{self.notes[idx][0][:500]}'")
-
-            if note_size + len(self.notes[idx][0]) > max_size:
-                title = self.title if _sent == 0 else self.title + f" ({_sent})"
-
-                yield title, header + _accum
-
-                _accum = self.notes[idx][0]
-                _sent += 1
+        _part = max(len(part_sizes) - 1, 0) if part_sizes else 0  # part of the note that _accum will be sent to
+        _used = part_sizes[_part] if part_sizes else 0  # length of that part that's already in obsidian
+
+        for idx, (rendered, uuid) in enumerate(self.rendered_notes()):
+            header = base_header if copy_header or _sent == 0 else ""
+            note_size = _used + len(header) + len(_accum)
+            text = fill(idx, rendered)
+
+            if len(text) + len(header) > max_size:
+                if not split_long:
+                    raise RuntimeError(f"NOTE EXCEEDS MAX LENGTH OF {max_size} CHARACTERS: "
+                                       f"'{base_title[:30]}', NOTE TEXT: '{text[:500]}'")
+                # the header + a single note is bigger than max note size, or the note by itself is too long. send
+                # what's before it, then send the note by itself, split into as many parts as it needs.
+                if _accum:
+                    yield self.part_title(base_title, _part), header + _accum, _uuids
+                    _sent += 1
+                if _accum or _used:
+                    _part += 1
+                while text:
+                    header = base_header if copy_header or _sent == 0 else ""
+                    if len(header) >= max_size:
+                        raise RuntimeError(f"NOTE HEADER EXCEEDS MAX LENGTH OF {max_size} CHARACTERS: "
+                                           f"'{base_title[:30]}', HEADER TEXT: '{header[:500]}'")
+                    piece, text = split_text(text, max_size - len(header))
+                    yield self.part_title(base_title, _part), header + piece, [uuid]
+                    _sent += 1
+                    _part += 1
+                _accum, _uuids, _used = "", [], 0
+                continue
+
+            if note_size + len(text) > max_size:
+                # _accum is only empty if the part that's already in obsidian doesn't have room for this note
+                if _accum:
+                    yield self.part_title(base_title, _part), header + _accum, _uuids
+                    _sent += 1
+
+                _accum = text
+                _uuids = [uuid]
+                _part += 1
+                _used = 0
             else:
-                _accum += self.notes[idx][0]
+                _accum += text
+                _uuids.append(uuid)
 
         # since the note is added to _accum after yielding, we end up with extra notes in _accum that haven't been
-        # sent yet. so we send them here.
-        title = self.title if _sent == 0 else self.title + f" ({_sent})"
-        header = self.header if copy_header or _sent == 0 else ""
-        yield title, header + _accum
+        # sent yet. so we send them here. _accum is also empty if the last note was split, which was already sent.
+        if _accum or _sent == 0:
+            header = base_header if copy_header or _sent == 0 else ""
+            yield self.part_title(base_title, _part), header + _accum, _uuids
 
 
 class BookList(dict):
@@ -405,12 +1231,21 @@ class BookList(dict):
     #  BookList: holds a dict of string titles of books with a BookData for each one.
     #            functions for add(title, note), split long dataset into multiple books, get base title
     #                of a split book, create headers when adding new notes, function to apply sent amount formatting
-    def __init__(self):
+    def __init__(self, renderer: Callable[[HighlightRecord, Any], Rendered] = None, memory_budget: int = -1):
         """
         this object is a dict of {book title: BookData object}
+
+        :param renderer: function that makes a note's text from a HighlightRecord. given to each BookData.
+        :param memory_budget: rough number of bytes that notes can use in memory before they're spilled to
+         temporary files, see spill(). -1 = unlimited. call close() when done to remove the files.
         """
         super().__init__()
         self.base_titles: Dict[str, str] = {}  # {full_title: base_title}
+        self.renderer = renderer
+        self.memory_budget = memory_budget
+        self.memory_used = 0  # rough number of bytes used by notes that are in memory
+        self.spill_dir: str = None  # temporary folder for spilled notes. made when it's first needed.
+        self.spill_files = 0  # number of files in spill_dir
 
     def add_book(self, book: BookData):
         """
@@ -421,23 +1256,56 @@ class BookList(dict):
         """
         self[book.title] = book
 
-    def add_note(self, title: str, note: str, sort_key: Any = 0) -> None:
+    def add_note(self, title: str, note: Union[Rendered, HighlightRecord], sort_key: Any = 0) -> None:
         """
         adds a note to this book list. if the title already exists, the note is added to the appropriate BookData.
         otherwise, a new BookData will be created.
 
         :param title: title of the note being added
-        :param note: contents of the note being added
+        :param note: contents of the note being added, or the HighlightRecord to make its contents from
         :param sort_key: used to sort the note within its file when sending to obsidian
         :return: none
         """
         if title in self:
             self[title].add_note(note, sort_key)
         else:
-            b = BookData(title)
+            b = BookData(title, renderer=self.renderer)
             b.add_note(note, sort_key)
             self[title] = b
 
+        if self.memory_budget >= 0:
+            self.memory_used += _note_memory(note)
+            if self.memory_used > self.memory_budget:
+                self.spill()
+
+    def spill(self) -> None:
+        """
+        moves notes out of memory into temporary files, starting with the books that have the most notes in memory,
+        until at most half of the memory budget is used. going down to half means that we don't need to spill again
+        every time a note is added.
+        """
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="h2o-spill-")
+
+        for title in sorted(self, key=lambda t: len(self[t].notes), reverse=True):
+            if self.memory_used <= self.memory_budget // 2:
+                break
+
+            book = self[title]
+            if book.spill_path is None:
+                book.spill_path = os.path.join(self.spill_dir, f"{self.spill_files}.jsonl")
+                self.spill_files += 1
+            self.memory_used -= sum([_note_memory(n[0]) for n in book.notes])
+            book.spill(book.spill_path)
+
+    def close(self) -> None:
+        """
+        removes the temporary files of spilled notes. the spilled notes can't be sent after this.
+        """
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+
     def update_title(self, old_title: str, new_title: str) -> None:
         """
         updates the title of the specified book if the book is in this BookList. If it's not in this BookList,
@@ -449,7 +1317,7 @@ class BookList(dict):
         else:
             raise KeyError(f"Title {old_title} not found in BookList!")
 
-    def update_header(self, book_title: str, header: str) -> None:
+    def update_header(self, book_title: str, header: Rendered) -> None:
         """
         sets the specified book's header to the given value
         :return: none
@@ -459,57 +1327,96 @@ class BookList(dict):
         else:
             raise KeyError(f"Title {book_title} not found in BookList!")
 
-    def make_sendable_notes(self, max_size: int = -1, copy_header: bool = False) -> Iterable[Tuple[str, str]]:
+    def make_sendable_notes(self, max_size: int = -1,
+                            copy_header: bool = False) -> Iterable[Tuple[str, str, List[Optional[str]]]]:
         """
         :param max_size: maximum allowed size of a note (notes might be longer after headers are added)
         :param copy_header: if a single note is split into multiple, should the header be copied into each one,
         or should only the first note have a header?
-        :return: yields an iterable of tuples containing (title, body) of notes to be sent to Obsidian.
+        :return: yields an iterable of tuples containing (title, body, uuids) of notes to be sent to Obsidian. uuids
+         has the uuid of each highlight in the note.
         """
         for b in self:
             for n in self[b].make_sendable_notes(max_size, copy_header):
                 yield n
 
-    def apply_sent_amount_format(self, should_apply: Tuple[bool, bool, bool]) -> None:
+    def apply_sent_amount_format(self) -> None:
         """
-        applies formatting options {totalsent}, {booksent}, {highlightsent}.
-        :return:
+        sets the values of formatting options {totalsent} and {booksent} for each book. they're filled in when
+        make_sendable_notes() is called, along with {highlightsent}.
         """
-        total_highlights = sum([len(self[title]) for title in self])
+        total_highlights = str(sum([len(self[title]) for title in self]))
         for title in self:
-            book_highlights = len(self[title])
+            self[title].sent_amounts = (total_highlights, str(len(self[title])))
+
 
-            if should_apply[0]:  # title
-                self.apply_sent_title(title, book_highlights, total_highlights)
+def _newest_first(book: BookData) -> float:
+    if not book.newest:
+        return 0.0  # no highlights, e.g. a note made from text
+    newest = datetime.datetime.strptime(book.newest[:19], "%Y-%m-%dT%H:%M:%S")
+    return -newest.replace(tzinfo=datetime.timezone.utc).timestamp()
 
-            if should_apply[1]:  # body
-                self.apply_sent_body(title, book_highlights, total_highlights)
 
-            if should_apply[2]:  # header
-                self.apply_sent_headers(title, book_highlights, total_highlights)
+# ways of choosing which notes are sent first, see HighlightSender.set_delivery_order(). each one takes a note's
+# BookData and the ids of the selected books, and returns a sort key. notes with smaller keys are sent first.
+delivery_orders: Dict[str, Callable[[BookData, Set[int]], Any]] = {
+    "recent": lambda book, selected: _newest_first(book),  # notes with the most recent highlights
+    "smallest": lambda book, selected: book.text_size,  # notes with the least text
+    "selected": lambda book, selected: 0 if book.book_ids & selected else 1,  # notes of the selected books
+}
 
-    def apply_sent_title(self, _title: str, _book_highlights: int, _total_highlights: int):
+
+class VaultTarget:
+    """
+    an obsidian vault that notes are sent to. see HighlightSender.set_targets().
+    """
+
+    def __init__(self, vault_name: str, title_format: str = None,
+                 transport: Callable[[Dict[str, str]], None] = None, condition: Callable[[Any], bool] = None,
+                 user: Tuple[str, str] = None, vault_index=None):
         """
-        :param _title: title of the book whose title you want to apply sent amount formats to
-        :param _book_highlights: Dict[title, int] that has the amount of highlights being sent to each book.
-        :param _total_highlights: total number of highlights being sent
-        :return: none
+        :param vault_name: name of the vault
+        :param title_format: title format to use for this vault's notes. None to use the sender's title format.
+        :param transport: function that sends notes to this vault, see HighlightSender.set_transport(). None to use
+         the sender's transport.
+        :param condition: highlights are only sent to this vault if condition is true for them, as well as the
+         condition given to send(). None to send every highlight.
+        :param user: (user type, user), e.g. ("web", "alice"). if not None, only that user's highlights are sent to
+         this vault.
+        :param vault_index: a VaultIndex of this vault's folder. highlights that it finds in the vault aren't sent to
+         this vault again. None to send highlights without checking the vault.
         """
-        fmt = make_sent_format_dict(_total_highlights, _book_highlights, -1)
-        new_title = format_single(fmt, _title)
-        self[_title].title = new_title
-        self[new_title] = self[_title]
-        del self[_title]
+        self.vault_name = vault_name
+        self.title_format = title_format
+        self.transport = transport
+        self.condition = condition
+        self.user = user
+        self.vault_index = vault_index
+        self.sent = 0  # number of highlights delivered to this vault by the most recent send
+        self.failures: List[Tuple[str, str]] = []  # (note file, error message) for notes that failed to send
+
 
-    def apply_sent_body(self, _title: str, _book_highlights: int, _total_highlights: int):
-        for h in range(len(self[_title])):
-            # since BookData keeps its note list sorted, it's easy to know how many have been sent before this
-            fmt = make_sent_format_dict(_total_highlights, _book_highlights, h + 1)
-            self[_title].update_note(h, format_single(fmt, self[_title].notes[h][0]))
+class ResumeError(ValueError):
+    """ raised by HighlightSender.send() when an interrupted send can't be resumed """
 
-    def apply_sent_headers(self, _title: str, _book_highlights: int, _total_highlights: int):
-        fmt = make_sent_format_dict(_total_highlights, _book_highlights, -1)
-        self[_title].header = format_single(fmt, self[_title].header)
+
+class NoteTooLongError(ValueError):
+    """
+    raised by HighlightSender.send(), before any notes are sent, when highlights are too long to fit in a note and
+    the oversize policy is "report". see HighlightSender.set_oversize_policy().
+    """
+
+    def __init__(self, max_size: int, notes: List[Tuple[str, int, str]]):
+        """
+        :param max_size: max note size that the highlights didn't fit in
+        :param notes: (note title, length of the highlight plus its note's header, start of the highlight's text) of
+         each highlight that's too long. for a header that's too long by itself, the length and text are the
+         header's.
+        """
+        self.max_size = max_size
+        self.notes = notes
+        super().__init__(f"{len(notes)} highlight(s) or header(s) don't fit in a note with the max note size of "
+                         f"{max_size} characters")
 
 
 class HighlightSender:
@@ -528,6 +1435,32 @@ class HighlightSender:
         self.copy_header = False
         self.sort_key = prefs.defaults['sort_key']
         self.sleep_time = 0
+        self.duplicate_policy = "all"
+        self.send_format_dict = make_send_format_dict()  # formatting options that are shared by the whole send
+        self.book_format_dicts: Dict[int, Dict[str, str]] = {}  # {book_id: formatting options for that book}
+        self.render_cache = None  # RenderCache or None
+        self.vault_index = None  # VaultIndex or None
+        self.transport: Callable[[Dict[str, str]], None] = send_item_to_obsidian  # takes make_obsidian_data() output
+        self.section_markers = False  # whether to wrap each highlight's body in start and end markers
+        self.failures: List[Tuple[str, str]] = []  # (note file, error message) for notes that failed to send
+        # {"title", "body", "no_notes", "header"}: output of compile_template() for each template
+        self.compiled_formats: Dict[str, Tuple[Union[str, int], ...]] = {}
+        self.use_render_cache = False  # whether render_cache can be used with the current templates
+        self.memory_budget = -1  # bytes that notes can use before being spilled to disk. -1 = unlimited.
+        self.checkpoint = None  # SendCheckpoint or None
+        self.targets: List[VaultTarget] = []  # vaults to send to. if empty, only vault_name is sent to.
+        self.body_memo: Dict[str, Rendered] = None  # {uuid: body}, for sharing bodies between targets in a send
+        self.chapter_lookup: Callable[[HighlightRecord], str] = None  # gives the {chapter} formatting option
+        self.use_chapters = False  # whether the current templates use {chapter}
+        self.profiler = None
+        self.pipeline_size = 0  # see set_pipeline()
+        self.delivery_order = ""  # see set_delivery_order()
+        self.readiness_probe = None
+        self.note_ledger = None
+        self.oversize_policy = "split"  # see set_oversize_policy()
+        self.selected_book_ids: Set[int] = set()
+        self.resume = False  # whether the next send continues the checkpoint's send
+        self.stats: Dict[str, int] = {}  # statistics about the most recent send
 
     def set_library(self, library_name: str):
         self.library_name = library_name
@@ -562,6 +1495,7 @@ class HighlightSender:
         """
 
         self.book_titles_authors = book_titles_authors
+        self.book_format_dicts = {}
 
     def set_annotations_list(self, annotations_list):
         """
@@ -581,6 +1515,18 @@ class HighlightSender:
         self.max_file_size = max_file_size
         self.copy_header = copy_header
 
+    def set_oversize_policy(self, policy: str = "split"):
+        """
+        sets what happens to a highlight that's too long to fit in a note by itself, even after the note is split.
+
+        :param policy: "split" to split the highlight between notes at paragraph or sentence breaks, see
+         split_text(). "report" to check every highlight's length before anything is sent, and raise
+         NoteTooLongError with all the highlights that are too long, so that a send is never left half-done. with
+         section markers, highlights are always checked instead of split, since a section that's split between notes
+         couldn't be found and updated later. see set_section_markers().
+        """
+        self.oversize_policy = policy
+
     def set_sort_key(self, sort_key: str):
         """
         :param sort_key: key to use for sorting highlights. should be one of the formatting options, e.g. "timestamp",
@@ -596,42 +1542,272 @@ class HighlightSender:
         """
         self.sleep_time = sleep_time
 
-    def should_apply_sent_formats(self) -> Tuple[bool, bool, bool]:
+    def set_duplicate_policy(self, policy: str):
+        """
+        :param policy: what to do with highlights that have the same text and notes as another highlight in the same
+         book. "all" keeps every highlight, "first" keeps only the first one found, "newest" keeps only the most
+         recently made one.
+        """
+        self.duplicate_policy = policy
+
+    def set_render_cache(self, render_cache):
         """
-        since formatting options for how many highlights were sent can't be applied until after the other formatting
-        options are applied, they'll end up being applied to formatted strings instead of templates. depending on
-        the content of those highlights, you could end up with very large strings. this function is a small performance
-        boost: it'll only try to apply those formatting options if said formatting options are in templates.
+        :param render_cache: a RenderCache, or None to format every highlight from scratch
+        """
+        self.render_cache = render_cache
 
-        an alternative to this is to only format titles, and then count how many highlights will be sent to each
-        note before you apply formatting to the body.
+    def set_vault_index(self, vault_index):
+        """
+        :param vault_index: a VaultIndex of the folder of the vault set with set_vault(). highlights that it finds in
+         the vault won't be sent again. None to send highlights without checking the vault. targets set with
+         set_targets() have their own, see VaultTarget.
+        """
+        self.vault_index = vault_index
+
+    def set_transport(self, transport: Callable[[Dict[str, str]], None]):
+        """
+        :param transport: function that sends a note to obsidian. takes the output of make_obsidian_data(). the
+         default is send_item_to_obsidian(), which uses obsidian URIs. see UriLauncher for opening many URIs
+         quickly, and vault_writer.VaultFileWriter for writing notes directly to the vault's files.
 
-        :return: Tuple telling you if you need to apply formatting options for how many highlights were sent. Tuple is
-        (title, body, header), where each item is True if that part needs formatting to be applied.
+         if the transport has a close() method, it will be called after all notes are sent. it should return a list
+         of (note file, error message) for notes that failed to send.
         """
-        format_dict = make_sent_format_dict(0, 0, 0)
-        formats = ("{" + k + "}" for k in format_dict.keys())
-        title, body, header = False, False, False
-        for f in formats:
-            title = title or (f in self.title_format)
-            body = body or (f in self.body_format) or (f in self.no_notes_format)
-            header = header or (f in self.header_format)
-        return title, body, header
+        self.transport = transport
 
-    def make_obsidian_data(self, note_file, note_content):
+    def set_memory_budget(self, memory_budget: int):
+        """
+        :param memory_budget: rough number of bytes that notes can use in memory while a send is being prepared.
+         past this, formatted notes are moved to temporary files until they're sent. -1 = unlimited.
+        """
+        self.memory_budget = memory_budget
+
+    def set_chapter_lookup(self, chapter_lookup: Callable[[HighlightRecord], str]):
+        """
+        :param chapter_lookup: function that returns the name of the chapter a highlight is in, for the {chapter}
+         formatting option, e.g. a toc_index.ChapterLookup. it's only called if a template uses {chapter}. None to
+         leave {chapter} unformatted.
+        """
+        self.chapter_lookup = chapter_lookup
+
+    def set_note_ledger(self, note_ledger):
+        """
+        :param note_ledger: note_ledger.NoteLedger that remembers how long each part of each note is, so that split
+         notes are continued from their last part. it's only used if there's a max file size and no section
+         markers, see set_section_markers(). None to always start from a note's first part.
+        """
+        self.note_ledger = note_ledger
+
+    def set_readiness_probe(self, readiness_probe: Callable[[Any, str], None]):
+        """
+        :param readiness_probe: function that's called with a transport and a vault name before the first note is
+         sent to that vault with that transport, e.g. an obsidian_probe.ReadinessProbe. it's only called for
+         transports that open obsidian URIs, i.e. that have an open_uri() method. it should raise an exception if
+         obsidian isn't ready. None to not check.
+        """
+        self.readiness_probe = readiness_probe
+
+    def set_delivery_order(self, delivery_order: str, selected_book_ids: Iterable[int] = ()):
+        """
+        :param delivery_order: which notes to send first, one of delivery_orders' keys. the highlights in each note
+         are still in order, and notes that are split into parts are still sent in order. "" to send notes in the
+         order that their first highlight was found.
+        :param selected_book_ids: books to send first if delivery_order is "selected"
+        """
+        self.delivery_order = delivery_order
+        self.selected_book_ids = set(selected_book_ids)
+
+    def set_pipeline(self, pipeline_size: int):
+        """
+        :param pipeline_size: if more than 0, notes are formatted and split in a background thread while earlier
+         notes are being sent, with up to this many notes formatted ahead of the one being sent. 0 to format each
+         note right before it's sent. either way, every highlight is grouped into its note before the first note is
+         sent, since {totalsent} and {booksent} need to know how many highlights each note has.
+        """
+        self.pipeline_size = pipeline_size
+
+    def set_profiler(self, profiler):
+        """
+        :param profiler: object whose mark(stage) method is called after each stage of a send, e.g. a
+         memory_profile.StageMemory. None to not profile sends.
+        """
+        self.profiler = profiler
+
+    def mark_stage(self, stage: str):
+        if self.profiler is not None:
+            self.profiler.mark(stage)
+
+    def set_targets(self, targets: List[VaultTarget]):
+        """
+        :param targets: vaults to send highlights to. each highlight's body and header are only formatted once, even
+         if it's sent to multiple vaults. targets with the same title format and condition also share their notes.
+         if empty, notes are only sent to the vault set with set_vault().
+        """
+        self.targets = targets
+
+    def set_checkpoint(self, checkpoint, resume: bool = False):
+        """
+        :param checkpoint: a SendCheckpoint that records which notes have been delivered, so that an interrupted send
+         can be resumed. None to not record anything.
+        :param resume: if True, the next send continues the checkpoint's most recent send, skipping the notes that
+         were already delivered. the highlights being sent must be the same ones that the checkpoint's send had.
+        """
+        self.checkpoint = checkpoint
+        self.resume = resume
+
+    def set_section_markers(self, section_markers: bool):
+        """
+        :param section_markers: if True, each highlight's formatted body is wrapped in start and end markers with
+         the highlight's uuid, so that it can be found and replaced later. see vault_writer.wrap_section().
+        """
+        self.section_markers = section_markers
+
+    def can_cache_renders(self) -> bool:
+        """
+        :return: False if the title or body templates use formatting options that change between sends, e.g. the
+         current time or utc offset, since cached titles and bodies would be out of date
+        """
+        for template in (self.title_format, self.body_format, self.no_notes_format):
+            fields = template_fields(template)
+            if fields is None or any(f in fields for f in now_format_options):
+                return False
+        return True
+
+    def send_targets(self) -> List[VaultTarget]:
+        """
+        :return: the targets set with set_targets(), or if there aren't any, a target for the vault set with
+         set_vault()
+        """
+        return self.targets if self.targets else [VaultTarget(self.vault_name, vault_index=self.vault_index)]
+
+    @staticmethod
+    def find_in_vault(targets: List[VaultTarget], uuids: List[str]) -> List[Optional[FrozenSet[str]]]:
+        """
+        :param uuids: uuids of the highlights being sent
+        :return: for each target, the uuids in uuids of the highlights that are already in the target's vault, or
+         None if the target's vault isn't checked. see VaultTarget.vault_index.
+        """
+        found: Dict[int, FrozenSet[str]] = {}  # {id(vault index): uuids}, so that each vault is only scanned once
+        ret = []
+        for target in targets:
+            index = target.vault_index
+            if index is None:
+                ret.append(None)
+                continue
+            if id(index) not in found:
+                index.update()
+                in_index = index.uuids()
+                found[id(index)] = frozenset([u for u in uuids if u in in_index])
+            ret.append(found[id(index)])
+        return ret
+
+    def make_target_groups(self, targets: List[VaultTarget],
+                           in_vault: List[Optional[FrozenSet[str]]]) -> List[Dict[str, Any]]:
+        """
+        groups targets that get the same notes, i.e. that have the same title format, condition, user, and
+        highlights already in their vaults, so that their notes only need to be made once. also resets each target's
+        send results.
+
+        :param targets: output of send_targets()
+        :param in_vault: output of find_in_vault()
+        :return: list of {"title_format": compiled title format, or None for the sender's title format,
+         "condition": condition or None, "user": (user type, user) or None, "in_vault": uuids of highlights that
+         aren't sent to these targets, or None, "targets": list of VaultTarget, "books": BookList, "headers": set of
+         titles that have headers, "book_titles": {book id: formatted title} if the title format only uses per-book
+         formatting options, else None}
+        """
+        groups = []
+        for target, target_in_vault in zip(targets, in_vault):
+            target.sent = 0
+            target.failures = []
+            title_format = target.title_format if target.title_format != self.title_format else None
+            for group in groups:
+                if group["format_text"] == title_format and group["condition"] is target.condition \
+                        and group["user"] == target.user and group["in_vault"] == target_in_vault:
+                    group["targets"].append(target)
+                    break
+            else:
+                groups.append({"format_text": title_format,
+                               "title_format": compile_template(title_format) if title_format is not None else None,
+                               "condition": target.condition, "user": target.user, "in_vault": target_in_vault,
+                               "targets": [target],
+                               "book_titles": {} if is_per_book_template(
+                                   title_format if title_format is not None else self.title_format)
+                               else None,
+                               "books": BookList(self.render_body, self.memory_budget), "headers": set()})
+        return groups
+
+    def target_transport(self, target: VaultTarget) -> Callable[[Dict[str, str]], None]:
+        return target.transport if target.transport is not None else self.transport
+
+    def section_layout(self, target: VaultTarget, base_title: str) -> Optional[Tuple[List[int], Dict[str, int]]]:
+        """
+        :param base_title: title of a note's first part
+        :return: (length of each part of the note that's in the target's vault, {uuid: part that has its section}),
+         see vault_writer.VaultFileWriter.section_parts(). None if the note isn't split or its sections aren't
+         updated, or if the target's transport can't read the vault's notes.
+        """
+        if not self.section_markers or self.max_file_size <= 0:
+            return None
+        section_parts = getattr(self.target_transport(target), "section_parts", None)
+        if section_parts is None:
+            return None
+        # the file names have to be the same as the ones the notes are sent to
+        return section_parts(lambda part: self.make_obsidian_data(BookData.part_title(base_title, part), "")["file"])
+
+    def checkpoint_written(self, unwritten: List[Tuple[int, Any, int]], count: int, transport: Any,
+                           hashes: List[str]) -> None:
+        """
+        records in the checkpoint that notes were delivered. for transports that write notes later (i.e. that have a
+        written() function, like VaultFileWriter), a note only counts once it's been written, so that resuming after
+        a crash doesn't skip notes that were only waiting to be written.
+
+        :param unwritten: notes that haven't been recorded yet, see send(). updated by this function.
+        :param count: number of notes that have been given to transports in this send, including this one
+        :param transport: transport that was given the latest note
+        :param hashes: see send()
+        """
+        unwritten.append((count, transport, getattr(transport, "queued", 0)))
+        delivered = None
+        while unwritten:
+            note_count, note_transport, number = unwritten[0]
+            if hasattr(note_transport, "written") and note_transport.written() < number:
+                break
+            delivered = note_count
+            unwritten.pop(0)
+        if delivered is not None:
+            self.checkpoint.delivered(delivered, hashes[delivered])
+
+    @staticmethod
+    def check_resume_hash(resume_from: Optional[Dict[str, Any]], hashes: List[str]) -> None:
+        """
+        raises ResumeError if the notes being skipped when resuming a send aren't the ones that were delivered
+
+        :param resume_from: output of SendCheckpoint.load(), or None if not resuming
+        :param hashes: hashes[idx] is the hash of the notes before note idx, see send()
+        """
+        if resume_from is None or resume_from["delivered"] == 0:
+            return
+        skip = resume_from["delivered"]
+        if len(hashes) <= skip or hashes[skip] != resume_from["hash"]:
+            raise ResumeError("Can't resume the previous send, since its highlights or formatting have changed "
+                              "since it was interrupted.")
+
+    def make_obsidian_data(self, note_file, note_content, vault_name: str = None):
         """
         limits length of note_file to 180 characters, allowing for an obsidian vault path of up to 80
         characters (Windows max path length is 260 characters).
 
         :param note_file: title of this note, including relative path
         :param note_content: body of this note
+        :param vault_name: vault to send the note to. if None, the vault set with set_vault() is used.
         :return: dictionary which includes vault name, note file/title, note contents.
         return value can be used as input for send_item_to_obsidian(). keys are "vault",
         "file", "content"
         """
 
         obsidian_data: Dict[str, str] = {
-            "vault": self.vault_name,
+            "vault": vault_name if vault_name is not None else self.vault_name,
             # use note_file[-4:] for the (1), (2), etc added to the end when there are a lot of highlights being sent
             "file": note_file if len(note_file) < 180 else note_file[:172] + "... " + note_file[-4:],
             "content": note_content,
@@ -651,21 +1827,7 @@ class HighlightSender:
         if self.sort_key == "location":
             # locations are something like "/int/int/int/int:int", but the ints aren't always the same length.
             # so normal string comparisons end up comparing "/" to numbers, which isn't what we want
-            loc = dat[self.sort_key]
-            locs = loc.split("/")  # first element is empty string since location starts with "/"
-            locs, end = locs[1:-1], locs[-1]
-
-            def get_num(x):
-                # x[:x.find("[")] to catch locations with "[pXXX]" in them (XXX is a page number).
-                # these locations seem to show up when there's more than one highlight in the same paragraph.
-                y = x.find("[")
-                if y == -1:
-                    return int(x)
-                else:
-                    return int(x[:y])
-
-            locs = [get_num(x) for x in locs]
-            end = [get_num(x) for x in end.split(":")]
+            locs, end = parse_location(dat[self.sort_key])
             # standardize list length to 8. i think amount of numbers in a location depends on how the book is
             # organized, but it's very rare to have that many nested sections, so this should work well enough
             # we use 8 because adding end increases length by 2, giving us a total length of 10
@@ -692,46 +1854,370 @@ class HighlightSender:
 
         return True
 
-    def process_highlight(self, _highlight, _headers: List[str]) -> Tuple[str, Tuple[str, Any], str]:
+    def make_format_dict(self, highlight: HighlightRecord) -> Dict[str, str]:
+        """
+        :param highlight: HighlightRecord of a calibre highlight
+        :return: the highlight's formatting options. book and send options are shared with other highlights.
+        """
+        book_options = self.book_format_dicts.get(highlight.book_id)
+        if book_options is None:
+            book_options = make_book_format_dict(highlight)
+            self.book_format_dicts[highlight.book_id] = book_options
+
+        dat = make_format_dict(highlight, self.library_name, book_options, self.send_format_dict)
+        if self.use_chapters:
+            dat["chapter"] = self.chapter_lookup(highlight)
+        return dat
+
+    def uses_option(self, option: str) -> bool:
+        """
+        :return: True if the title, body, no notes, or header format, or the sort key, uses the formatting option
+        """
+        if self.sort_key == option:
+            return True
+        for template in (self.title_format, self.body_format, self.no_notes_format, self.header_format):
+            fields = template_fields(template)
+            if fields is None or option in fields:
+                return True
+        return False
+
+    def compile_formats(self) -> None:
+        """
+        compiles the title, body, no notes, and header formats with compile_template(). must be called after the
+        formats are changed and before highlights are formatted.
         """
-        makes formatted data for a highlight.
+        self.compiled_formats = {
+            "title": compile_template(self.title_format),
+            "body": compile_template(self.body_format),
+            "no_notes": compile_template(self.no_notes_format),
+            "header": compile_template(self.header_format),
+        }
+
+    def format_title(self, dat: Dict[str, str]) -> Rendered:
+        return render_compiled(dat, self.compiled_formats["title"], format_title)
+
+    def format_body(self, dat: Dict[str, str]) -> Rendered:
+        # same as format_body(): if there are no notes, use the no notes format, unless it's empty
+        if self.no_notes_format and len(dat["notes"]) > 0:
+            return render_compiled(dat, self.compiled_formats["body"])
+        return render_compiled(dat, self.compiled_formats["no_notes"])
 
-        :param _highlight: a calibre annotation object
-        :param _headers: list of titles that already have headers
-        :return: (formatted_title, formatted_body, formatted_header)
-        formatted_body is a tuple with (formatted_text, sort_key)
+    def process_highlight(self, _highlight: HighlightRecord, _headers: Iterable[str],
+                          title_format: Tuple[Union[str, int], ...] = None, book_titles: Dict[int, Rendered] = None
+                          ) -> Tuple[Rendered, Tuple[HighlightRecord, Any], Rendered]:
+        """
+        makes formatted data for a highlight. the highlight's body isn't formatted here, see render_body(). if the
+        render cache has this highlight, its cached title and sort key are used.
+
+        :param _highlight: HighlightRecord of a calibre highlight
+        :param _headers: titles that already have headers, as returned by slots_to_text()
+        :param title_format: compiled title format to use instead of the sender's, see compile_template(). the
+         render cache isn't used for these titles.
+        :param book_titles: {book id: formatted title} of the books whose titles have been formatted in this send.
+         only given if the title format only uses per-book formatting options, see is_per_book_template(). the
+         title is formatted once per book, and highlights in the same book share the same title string.
+        :return: (formatted_title, body, formatted_header)
+        body is a tuple with (highlight record, sort_key)
         formatted_header is None if a header is already present in _headers.
         """
-        dat = make_format_dict(_highlight, self.library_name, self.book_titles_authors)
-        formatted = format_data(dat, self.title_format, self.body_format, self.no_notes_format)
+        if title_format is not None:
+            dat = self.make_format_dict(_highlight)
+            title = self.book_title(_highlight, dat, title_format, book_titles)
+            header = None if slots_to_text(title) in _headers else render_compiled(dat, self.compiled_formats["header"])
+            return title, (_highlight, self.format_sort_key(dat)), header
+
+        cached = self.get_cached_render(_highlight)
+        if self.use_render_cache:
+            self.stats["cache_hits" if cached is not None else "cache_misses"] += 1
+        if cached is not None and slots_to_text(cached[0]) in _headers:
+            return cached[0], (_highlight, cached[2]), None
+
+        dat = self.make_format_dict(_highlight)
+        if cached is not None:
+            title, sort_key = cached[0], cached[2]
+        else:
+            title = self.book_title(_highlight, dat, self.compiled_formats["title"], book_titles)
+            sort_key = self.format_sort_key(dat)
+            if self.use_render_cache:
+                body = self.format_body(dat)
+                self.render_cache.put(_highlight.uuid, self.render_cache_stamp(_highlight), title, body, sort_key)
 
         # only make one header per title
-        header = None if formatted[0] in _headers else format_single(dat, self.header_format)
+        header = None if slots_to_text(title) in _headers else render_compiled(dat, self.compiled_formats["header"])
 
-        return formatted[0], (formatted[1], self.format_sort_key(dat)), header
+        return title, (_highlight, sort_key), header
 
-    def send(self, condition: Callable[[Any], bool] = lambda x: True):
+    @staticmethod
+    def book_title(highlight: HighlightRecord, dat: Dict[str, str], title_format: Tuple[Union[str, int], ...],
+                   book_titles: Dict[int, Rendered] = None) -> Rendered:
         """
-        condition takes a highlight's json object and returns true if that highlight should be sent to obsidian.
+        :param title_format: compiled title format
+        :param book_titles: see process_highlight()
+        :return: the highlight's formatted title
         """
+        if book_titles is None:
+            return render_compiled(dat, title_format, format_title)
 
-        highlights = filter(lambda x: self.is_valid_highlight(x, condition), self.annotations_list)
-        headers = []  # formatted headers: dict[note_title:str, header:str]
-        books = BookList()
+        title = book_titles.get(highlight.book_id)
+        if title is None:
+            title = render_compiled(dat, title_format, format_title)
+            book_titles[highlight.book_id] = title
+        return title
 
-        # make formatted titles, bodies, and headers
-        for highlight in highlights:
-            h = self.process_highlight(highlight, headers)
-            books.add_note(h[0], h[1][0], h[1][1])
-            if h[2] is not None:
-                books.update_header(h[0], h[2])
+    def render_body(self, highlight: HighlightRecord, sort_key: Any = None) -> Rendered:
+        """
+        :param highlight: HighlightRecord of a calibre highlight
+        :param sort_key: the highlight's sort key. with section markers, it's put in the section's start marker so
+         that later sends can insert new sections in order, see vault_writer.merge_sections().
+        :return: the highlight's formatted body, with slots for sent amounts
+        """
+        body = self.body_memo.get(highlight.uuid) if self.body_memo is not None else None
+        if body is None:
+            cached = self.get_cached_render(highlight)
+            if cached is not None:
+                body = cached[1]
+            else:
+                body = self.format_body(self.make_format_dict(highlight))
+            if self.body_memo is not None:
+                self.body_memo[highlight.uuid] = body
+
+        if self.section_markers:
+            # must match vault_writer.wrap_section()
+            start = "%%h2o:" + highlight.uuid + "%%"
+            if sort_key is not None:
+                start += "%%h2o-key:" + sort_key_text(sort_key) + "%%"
+            body = wrap_rendered(start, body, "%%/h2o:" + highlight.uuid + "%%\n")
+        return body
+
+    def render_cache_stamp(self, highlight: HighlightRecord) -> str:
+        # a book's chapters can change if its file is replaced, so the chapter is part of the stamp
+        chapter = "\0" + self.chapter_lookup(highlight) if self.use_chapters else ""
+        return self.render_cache.make_stamp(highlight.timestamp, highlight.title, highlight.authors + chapter)
+
+    def get_cached_render(self, highlight: HighlightRecord) -> Optional[Tuple[Rendered, Rendered, Any]]:
+        """
+        :return: (title, body, sort_key) from the render cache, or None if the highlight isn't cached
+        """
+        if not self.use_render_cache:
+            return None
 
-        books.apply_sent_amount_format(self.should_apply_sent_formats())
+        return self.render_cache.get(highlight.uuid, self.render_cache_stamp(highlight))
 
-        # todo: sometimes, if obsidian isn't already open, not all highlights get sent. probably need to send a single
-        #  item then wait for obsidian to open
-        for note in books.make_sendable_notes(self.max_file_size, self.copy_header):
-            send_item_to_obsidian(self.make_obsidian_data(note[0], note[1]))
-            time.sleep(self.sleep_time)
+    def send(self, condition: Callable[[Any], bool] = lambda x: True):
+        """
+        condition takes a highlight's json object and returns true if that highlight should be sent to obsidian.
+        """
 
-        return sum([len(b) for b in books.values()])
+        highlights = filter(lambda x: self.is_valid_highlight(x, condition), self.annotations_list)
+        # when users' highlights go to different places, one user's highlight isn't a duplicate of another's
+        per_user = any([t.user is not None for t in self.targets])
+        highlights, duplicates = dedupe_highlights(highlights, self.duplicate_policy, per_user)
+        self.mark_stage("filtered")
+        self.send_format_dict = make_send_format_dict()
+        self.compile_formats()
+        self.use_chapters = self.chapter_lookup is not None and self.uses_option("chapter")
+        self.stats = {"sent": 0, "notes": 0, "duplicates": duplicates, "cache_hits": 0, "cache_misses": 0,
+                      "in_vault": 0}
+
+        resume_from = self.checkpoint.load() if self.checkpoint is not None and self.resume else None
+        targets = self.send_targets()
+        if resume_from is None:
+            in_vault = self.find_in_vault(targets, [h["annotation"]["uuid"] for h in highlights])
+        else:
+            # the vaults now have the notes that were delivered before the send was interrupted, so use the
+            # highlights that were in them when the send started
+            saved = resume_from.get("in_vault") or []
+            in_vault = [frozenset(saved[idx]) if idx < len(saved) and saved[idx] is not None else None
+                        for idx in range(len(targets))]
+        self.use_render_cache = self.render_cache is not None and self.can_cache_renders()
+        if self.use_render_cache:
+            self.render_cache.set_templates(self.title_format, self.body_format, self.no_notes_format,
+                                            self.header_format, self.library_name, self.sort_key)
+        if self.checkpoint is not None and resume_from is None:
+            self.checkpoint.start([h["annotation"]["uuid"] for h in highlights],
+                                  [sorted(uuids) if uuids is not None else None for uuids in in_vault])
+        groups = self.make_target_groups(targets, in_vault)
+        # check each highlight's length when its title is made, instead of finding out partway through sending
+        check_sizes = (self.oversize_policy == "report" or self.section_markers) and self.max_file_size > 0
+        too_long: List[Tuple[str, int, str]] = []  # see NoteTooLongError
+        # bodies are shared between groups, and kept from when they're checked until they're sent, unless that would
+        # keep more in memory than the memory budget allows
+        self.body_memo = {} if (len(groups) > 1 or check_sizes) and self.memory_budget < 0 else None
+        sent_uuids = set()  # highlights that were delivered to at least one target
+        delivered: List[Tuple[VaultTarget, str]] = []  # (target, file name) of the notes delivered by this send
+
+        # with section markers, a highlight that's sent again has to go to the part that already has its section, not
+        # the last part, or merge_sections() would add a second copy of it. see section_layout().
+        use_ledger = self.note_ledger is not None and self.max_file_size > 0 and not self.section_markers
+        # (target, note file or None if it was delivered before resuming, title of the note's first part, part,
+        # length) of each note delivered by this send, for updating the note ledger
+        ledger_parts: List[Tuple[VaultTarget, Optional[str], str, int, int]] = []
+
+        def deliveries() -> Iterable[Tuple[VaultTarget, Tuple[str, str, List[Optional[str]]], Tuple[str, int]]]:
+            books = [(group, book) for group in groups for book in group["books"].values()]
+            order = delivery_orders.get(self.delivery_order)
+            if order is not None:
+                # sorted() is stable, so notes with the same priority keep their usual order
+                books.sort(key=lambda gb: order(gb[1], self.selected_book_ids))
+            for group, book in books:
+                base_title = book.sendable_title()
+                layouts = [self.section_layout(target, base_title) for target in group["targets"]]
+                if any([layout is not None for layout in layouts]):
+                    # each vault can have the note's sections in different parts, so each target's notes are split
+                    # separately
+                    for target, layout in zip(group["targets"], layouts):
+                        if layout is not None:
+                            target_notes = book.make_placed_notes(self.max_file_size, self.copy_header, *layout)
+                        else:
+                            target_notes = book.make_sendable_notes(self.max_file_size, self.copy_header, None, False)
+                        for note in target_notes:
+                            yield target, note, (base_title, book.part_number(base_title, note[0]))
+                    continue
+
+                # every target in a group gets the same notes, so they're split using the first target's ledger
+                part_sizes = self.note_ledger.parts(group["targets"][0].vault_name, base_title) if use_ledger else None
+                for note in book.make_sendable_notes(self.max_file_size, self.copy_header, part_sizes,
+                                                     not self.section_markers):
+                    part = book.part_number(base_title, note[0])
+                    for target in group["targets"]:
+                        yield target, note, (base_title, part)
+
+        notes = None
+        try:
+            # make formatted titles and headers. bodies are formatted as they're sent, or when they're spilled.
+            for highlight in highlights:
+                record = HighlightRecord.from_annotation(highlight, self.book_titles_authors)
+                body_size = None  # length of the highlight's body, if check_sizes
+                # whether any group took the highlight, and whether any skipped it because it's already in their vaults
+                added, withheld = False, False
+                for group in groups:
+                    if group["user"] is not None and group["user"] != (record.user_type, record.user):
+                        continue
+                    if group["condition"] is not None and not group["condition"](highlight):
+                        continue
+                    if group["in_vault"] is not None and record.uuid in group["in_vault"]:
+                        withheld = True
+                        continue
+                    added = True
+                    books, headers = group["books"], group["headers"]
+                    h = self.process_highlight(record, headers, group["title_format"], group["book_titles"])
+                    # titles can have slots for sent amounts, which aren't known yet. use the unfilled title as the key.
+                    title = slots_to_text(h[0])
+                    books.add_note(title, h[1][0], h[1][1])
+                    if h[2] is not None:
+                        books.update_header(title, h[2])
+                        books[title].title_parts = h[0]
+                        headers.add(title)
+                        header_text = slots_to_text(h[2])
+                        if 0 < self.max_file_size <= len(header_text):
+                            # a note whose header doesn't fit can't be sent, whether or not its highlights are split
+                            too_long.append((title, len(header_text), header_text[:100]))
+                    if check_sizes:
+                        if body_size is None:
+                            body_size = len(slots_to_text(self.render_body(record, h[1][1])))
+                        # the header is counted even without copy_header, since any highlight could end up first
+                        # in its note. this also catches headers that are too long by themselves.
+                        header_size = len(slots_to_text(books[title].header or ""))
+                        if body_size + header_size > self.max_file_size:
+                            too_long.append((title, body_size + header_size, record.highlighted_text[:100]))
+                if withheld and not added:
+                    self.stats["in_vault"] += 1
+
+            if too_long:
+                if self.checkpoint is not None and resume_from is None:
+                    self.checkpoint.clear()  # nothing was sent, so there's nothing to resume
+                raise NoteTooLongError(self.max_file_size, too_long)
+
+            for group in groups:
+                group["books"].apply_sent_amount_format()
+            self.stats["notes"] = sum([len(group["books"]) for group in groups])
+            self.mark_stage("book lists")
+
+            skip = resume_from["delivered"] if resume_from is not None else 0
+            chunk_hash = hashlib.sha1()  # hash of the vaults, titles, and uuids of the notes so far, see SendCheckpoint
+            hashes = [""]  # hashes[idx] is the hash of the notes before note idx
+
+            # if obsidian isn't already open, some of the first notes can get lost while it starts up
+            probed = set()  # (transport id, vault name) that have been checked with the readiness probe
+            # (number of notes delivered, transport, how many notes it had been given) for notes that a transport
+            # hasn't finished with yet, e.g. because VaultFileWriter's threads haven't written them
+            unwritten: List[Tuple[int, Any, int]] = []
+            # sending a note mostly waits, for sleep_time and for obsidian, so the next notes can be made meanwhile
+            notes = prefetch(deliveries(), self.pipeline_size) if self.pipeline_size > 0 else deliveries()
+            for idx, (target, note, part) in enumerate(notes):
+                chunk_hash.update((target.vault_name + "\0" + note[0] + "\0" + "\0".join([u or "" for u in note[2]])
+                                   + "\n").encode("utf-8"))
+                hashes.append(chunk_hash.hexdigest())
+                if idx < skip:
+                    if use_ledger:
+                        ledger_parts.append((target, None, part[0], part[1], len(note[1])))
+                    continue
+                if idx == skip:
+                    self.check_resume_hash(resume_from, hashes)
+
+                obsidian_data = self.make_obsidian_data(note[0], note[1], target.vault_name)
+                transport = self.target_transport(target)
+                if self.readiness_probe is not None and hasattr(transport, "open_uri") \
+                        and (id(transport), target.vault_name) not in probed:
+                    self.readiness_probe(transport, target.vault_name)
+                    probed.add((id(transport), target.vault_name))
+                if getattr(transport, "wants_uuids", False):
+                    transport(obsidian_data, note[2])  # e.g. archive_writer.ArchiveWriter
+                else:
+                    transport(obsidian_data)
+                target.sent += len(note[2])
+                sent_uuids.update(note[2])
+                delivered.append((target, obsidian_data["file"]))
+                if use_ledger:
+                    ledger_parts.append((target, obsidian_data["file"], part[0], part[1], len(note[1])))
+                if self.checkpoint is not None:
+                    self.checkpoint_written(unwritten, idx + 1, transport, hashes)
+                time.sleep(self.sleep_time)
+
+            if len(hashes) - 1 <= skip:
+                self.check_resume_hash(resume_from, hashes)  # every note was already delivered
+            self.mark_stage("notes")
+        finally:
+            if notes is not None:
+                notes.close()  # stops the background thread before its notes' files are removed
+            for group in groups:
+                group["books"].close()
+            self.body_memo = None
+
+        # transports can be shared between targets, so close each one once
+        self.failures = []
+        transport_failures = {}  # {(transport id, note file): error message}
+        transports = [self.target_transport(target) for group in groups for target in group["targets"]]
+        for transport in {id(t): t for t in transports}.values():
+            if hasattr(transport, "close"):
+                for failure in transport.close() or []:
+                    self.failures.append(failure)
+                    transport_failures[(id(transport), failure[0])] = failure[1]
+
+        first_failed = None
+        for idx, (target, file) in enumerate(delivered):
+            error = transport_failures.get((id(self.target_transport(target)), file))
+            if error is not None:
+                target.failures.append((file, error))
+                first_failed = idx if first_failed is None else first_failed
+
+        if self.checkpoint is not None:
+            if first_failed is None:
+                self.checkpoint.clear()
+            else:
+                # notes can fail after they're given to the transport, e.g. if the program opening a URI fails.
+                # resuming should start from the first note that failed.
+                self.checkpoint.delivered(skip + first_failed, hashes[skip + first_failed])
+
+        if self.use_render_cache:
+            self.render_cache.save()
+
+        if use_ledger:
+            for target, file, title, part, size in ledger_parts:
+                if file is None or (id(self.target_transport(target)), file) not in transport_failures:
+                    self.note_ledger.record(target.vault_name, title, part, size)
+            self.note_ledger.save()
+
+        amt = len(sent_uuids)
+        self.stats["sent"] = amt
+        return amt
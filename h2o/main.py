@@ -1,7 +1,8 @@
 from functools import partial
 from qt.core import QDialog, QVBoxLayout, QPushButton, QMessageBox, QLabel
 from calibre_plugins.highlights_to_obsidian.button_actions import (help_menu, send_new_highlights,
-                                                                   send_all_highlights, resend_highlights,
+                                                                   send_all_highlights, resend_highlights, resume_send,
+                                                                   sync_libraries, export_highlights,
                                                                    send_new_selected_highlights, send_all_selected_highlights)
 from calibre_plugins.highlights_to_obsidian.config import prefs
 from calibre_plugins.highlights_to_obsidian.__init__ import version
@@ -48,6 +49,21 @@ class MainDialog(QDialog):
         self.resend_button.clicked.connect(partial(resend_highlights, self, db))
         self.l.addWidget(self.resend_button)
 
+        # resume interrupted send button
+        self.resume_button = QPushButton("Resume interrupted send", self)
+        self.resume_button.clicked.connect(partial(resume_send, self, db))
+        self.l.addWidget(self.resume_button)
+
+        # sync all libraries button
+        self.sync_libraries_button = QPushButton("Sync all libraries", self)
+        self.sync_libraries_button.clicked.connect(partial(sync_libraries, self))
+        self.l.addWidget(self.sync_libraries_button)
+
+        # export highlights button
+        self.export_button = QPushButton("Export highlights", self)
+        self.export_button.clicked.connect(partial(export_highlights, self, db))
+        self.l.addWidget(self.export_button)
+
         # send new highlights of selected books button
         self.send_new_selected_button = QPushButton("Send new highlights of selected books", self)
         self.send_new_selected_button.clicked.connect(partial(send_new_selected_highlights, self, db))
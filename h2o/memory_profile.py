@@ -0,0 +1,193 @@
+import random
+import sys
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+from calibre_plugins.highlights_to_obsidian.highlight_sender import HighlightSender, NullTransport
+
+# measures how much memory a send uses, to catch memory regressions in the formatting and note splitting code before
+# a release. it's meant to be run from calibre's debug shell, so that it uses the same python as calibre, e.g.:
+#
+#   calibre-debug -c "from calibre_plugins.highlights_to_obsidian.memory_profile import soak; soak(1000000)"
+#
+# soak() raises MemoryCeilingError if a stage uses more memory than its ceiling.
+
+# default ceilings for soak(), in bytes per highlight. a stage's ceiling is this times the number of highlights.
+default_ceilings = {
+    "annotations": 2500,  # calibre's annotation objects
+    "filtered": 200,  # the list of highlights that will be sent
+    # HighlightRecords, titles, and headers. format dicts are made while titles are formatted, so they're counted here
+    # and in "notes", not in a stage of their own.
+    "book lists": 1500,
+    "notes": 2000,  # peak while notes are formatted, split, and sent
+    "rss": 8000,  # peak resident memory of the whole process, plus base_rss
+}
+base_rss = 500 * 1024 * 1024  # memory used by calibre itself, before any highlights are made
+
+
+class MemoryCeilingError(RuntimeError):
+    """ raised by StageMemory.check() when a stage used more memory than it's allowed to """
+
+
+def peak_rss() -> Optional[int]:
+    """
+    :return: largest amount of memory the process has had resident, in bytes, or None if it can't be measured (e.g.
+     on windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux gives kilobytes, macos gives bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class StageMemory:
+    """
+    records the memory used by each stage of a send with tracemalloc, see HighlightSender.set_profiler().
+
+    tracemalloc makes python's memory allocation a lot slower, so this shouldn't be used for normal sends.
+    """
+
+    def __init__(self):
+        # (stage, bytes allocated when the stage ended, most bytes allocated at once during the stage)
+        self.stages: List[tuple] = []
+        self.started_tracing = False
+        self.last_time = 0.0
+        self.times: Dict[str, float] = {}  # {stage: seconds it took}
+
+    def start(self) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        self.stages = []
+        self.times = {}
+        self.mark("start")
+
+    def mark(self, stage: str) -> None:
+        """
+        records that a stage of the send has ended
+
+        :param stage: name of the stage, e.g. "book lists"
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        if hasattr(tracemalloc, "reset_peak"):  # python 3.9+
+            tracemalloc.reset_peak()
+        now = time.perf_counter()
+        if self.stages:
+            self.times[stage] = now - self.last_time
+        self.last_time = now
+        self.stages.append((stage, current, peak))
+
+    def stop(self) -> None:
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def usage(self) -> Dict[str, int]:
+        """
+        :return: {stage: bytes}. for stages whose memory is kept until the send ends (e.g. "book lists"), this is how
+         much the stage added. for "notes", which are sent and freed one at a time, it's the peak during the stage.
+         also has "rss", the process' peak resident memory, if it can be measured.
+        """
+        ret = {}
+        for (_, prev_current, _), (stage, current, peak) in zip(self.stages, self.stages[1:]):
+            ret[stage] = peak - prev_current if stage == "notes" else current - prev_current
+        rss = peak_rss()
+        if rss is not None:
+            ret["rss"] = rss
+        return ret
+
+    def report(self) -> str:
+        """
+        :return: one line of text per stage, with its memory use and time
+        """
+        lines = []
+        for stage, amount in self.usage().items():
+            secs = f", {self.times[stage]:.2f}s" if stage in self.times else ""
+            lines.append(f"{stage}: {amount / (1024 * 1024):.1f} MB{secs}")
+        return "\n".join(lines)
+
+    def check(self, ceilings: Dict[str, int]) -> None:
+        """
+        :param ceilings: {stage: max bytes}. stages without a ceiling aren't checked.
+        :raises MemoryCeilingError: if any stage used more memory than its ceiling
+        """
+        over = [f"{stage} used {amount} bytes, more than its ceiling of {ceilings[stage]}"
+                for stage, amount in self.usage().items() if stage in ceilings and amount > ceilings[stage]]
+        if over:
+            raise MemoryCeilingError("\n".join(over))
+
+
+def make_annotations(amount: int, books: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """
+    :param amount: number of highlights to make
+    :param books: number of books to spread the highlights between
+    :param seed: random seed, so that the same highlights are made each time
+    :return: made up highlights in the same form as calibre's all_annotations()
+    """
+    rand = random.Random(seed)
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit", "sed", "do"]
+    ret = []
+    for idx in range(amount):
+        annot = {
+            "type": "highlight",
+            "uuid": f"soak{idx:010d}",
+            "timestamp": f"2023-{rand.randint(1, 12):02d}-{rand.randint(1, 28):02d}T{rand.randint(0, 23):02d}:"
+                         f"{rand.randint(0, 59):02d}:{rand.randint(0, 59):02d}.{rand.randint(0, 999):03d}Z",
+            "highlighted_text": " ".join(rand.choices(words, k=rand.randint(5, 80))),
+            "spine_index": rand.randint(0, 40),
+            "start_cfi": f"/{rand.randint(1, 20) * 2}/{rand.randint(1, 100) * 2}/1:{rand.randint(0, 500)}",
+            "end_cfi": "/2/2/1:0",
+        }
+        if rand.random() < 0.3:
+            annot["notes"] = " ".join(rand.choices(words, k=rand.randint(1, 30)))
+        ret.append({"book_id": rand.randint(1, books), "format": "EPUB", "user_type": "local", "user": "viewer",
+                    "annotation": annot})
+    return ret
+
+
+def soak(amount: int = 100000, books: int = 1000, ceilings: Dict[str, int] = None, max_file_size: int = 20000,
+         memory_budget: int = -1) -> StageMemory:
+    """
+    sends made up highlights to a NullTransport with the default formatting options, and measures how much memory
+    each stage of the send uses. prints a report of each stage.
+
+    :param amount: number of highlights to send, e.g. 100000 or 1000000
+    :param books: number of books to spread the highlights between
+    :param ceilings: {stage: max bytes}, see StageMemory.check(). if None, default_ceilings times amount is used.
+    :param max_file_size: see HighlightSender.set_max_file_size(). -1 to not split notes.
+    :param memory_budget: see HighlightSender.set_memory_budget()
+    :raises MemoryCeilingError: if any stage used more memory than its ceiling
+    :return: the send's StageMemory
+    """
+    if ceilings is None:
+        ceilings = {stage: per_highlight * amount for stage, per_highlight in default_ceilings.items()}
+        ceilings["rss"] += base_rss
+
+    profiler = StageMemory()
+    profiler.start()
+    try:
+        annotations = make_annotations(amount, books)
+        profiler.mark("annotations")
+
+        sender = HighlightSender()
+        sender.set_library("Soak Test")
+        sender.set_book_titles_authors({i: {"title": f"Book {i}", "authors": f"Author {i % 97}"}
+                                        for i in range(1, books + 1)})
+        sender.set_annotations_list(annotations)
+        sender.set_max_file_size(max_file_size)
+        sender.set_memory_budget(memory_budget)
+        sender.set_sleep_time(0)
+        sender.set_transport(NullTransport())
+        sender.set_profiler(profiler)
+        sent = sender.send()
+    finally:
+        profiler.stop()
+
+    print(f"{sent} highlights sent in {sender.stats['notes']} notes")
+    print(profiler.report())
+    profiler.check(ceilings)
+    return profiler
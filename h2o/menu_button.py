@@ -18,6 +18,9 @@ class MenuButton(InterfaceAction):
         super().__init__(parent, site_customization)
         self.new_highlights_action = None
         self.resend_highlights_action = None
+        self.resume_send_action = None
+        self.sync_libraries_action = None
+        self.export_action = None
         self.new_selected_action = None
         self.all_highlights_action = None
         self.all_selected_action = None
@@ -60,6 +63,15 @@ class MenuButton(InterfaceAction):
         rh = "Resend Highlights to Obsidian"
         rhd = "Resend last highlights sent to Obsidian"
         self.resend_highlights_action = ma(un + rh, rh, description=rhd, shortcut=None, triggered=self.resend)
+        rs = "Resume Interrupted Send"
+        rsd = "Send the rest of the highlights from a send that didn't finish"
+        self.resume_send_action = ma(un + rs, rs, description=rsd, shortcut=None, triggered=self.resume)
+        sl = "Sync All Libraries"
+        sld = "Send new highlights from every library listed in the config"
+        self.sync_libraries_action = ma(un + sl, sl, description=sld, shortcut=None, triggered=self.sync_libraries)
+        ex = "Export Highlights"
+        exd = "Save all highlights to a zip file of notes or a JSON Lines file"
+        self.export_action = ma(un + ex, ex, description=exd, shortcut=None, triggered=self.export)
         nsh = "Send New Highlights of Selected Books"
         nshd = "Send new highlights of selected books to Obsidian. Will prevent non-selected highlights from being " \
                + "sent by 'Send New Highlights'."
@@ -86,6 +98,15 @@ class MenuButton(InterfaceAction):
     def resend(self):
         b_acts.resend_highlights(self.gui, self.gui.current_db.new_api)
 
+    def resume(self):
+        b_acts.resume_send(self.gui, self.gui.current_db.new_api)
+
+    def sync_libraries(self):
+        b_acts.sync_libraries(self.gui)
+
+    def export(self):
+        b_acts.export_highlights(self.gui, self.gui.current_db.new_api)
+
     def send_new_selected(self):
         b_acts.send_new_selected_highlights(self.gui, self.gui.current_db.new_api)
 
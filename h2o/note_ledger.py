@@ -0,0 +1,76 @@
+import json
+import os
+from typing import Dict, List, Tuple
+
+# like highlight_sender.py, avoid importing anything from calibre here. the ledger's file path is decided in
+# make_sender() in button_actions.py.
+
+
+class NoteLedger:
+    """
+    remembers how long each part of each split note is, so that later sends can keep filling the last part of a
+    note instead of adding to its first part again. see BookData.make_sendable_notes().
+
+    sizes are only what this plugin has sent. if a note is edited in obsidian, its size in the ledger will be off by
+    however much it was changed.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: file to load the ledger from and save it to
+        """
+        self.path = path
+        # {vault name: {note title, without a part number: [length of part 0, length of part 1, ...]}}
+        self.vaults: Dict[str, Dict[str, List[int]]] = {}
+        # [(vault name, title, part, size)] recorded since the ledger was last saved
+        self.added: List[Tuple[str, str, int, int]] = []
+        self.load()
+
+    def parts(self, vault_name: str, title: str) -> List[int]:
+        """
+        :param title: title of the note's first part
+        :return: length of each of the note's parts, in characters. empty if the note hasn't been sent.
+        """
+        return list(self.vaults.get(vault_name, {}).get(title, ()))
+
+    def record(self, vault_name: str, title: str, part: int, size: int) -> None:
+        """
+        :param title: title of the note's first part
+        :param part: which part of the note was sent, e.g. 2 for "Title (2)"
+        :param size: number of characters that were added to the part
+        """
+        self.add(vault_name, title, part, size)
+        self.added.append((vault_name, title, part, size))
+
+    def add(self, vault_name: str, title: str, part: int, size: int) -> None:
+        sizes = self.vaults.setdefault(vault_name, {}).setdefault(title, [])
+        while len(sizes) <= part:
+            sizes.append(0)
+        sizes[part] += size
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.vaults = json.load(f)
+        except (OSError, ValueError):
+            self.vaults = {}  # missing or corrupt. notes will start from their first part again.
+
+    def save(self) -> None:
+        """
+        writes the ledger to its file, if it changed since it was loaded. the file is loaded again first and this
+        ledger's changes are added to it, since another sender (e.g. one for another library in sync_libraries())
+        could have saved the ledger in the meantime.
+        """
+        if not self.added:
+            return
+
+        self.load()
+        for vault_name, title, part, size in self.added:
+            self.add(vault_name, title, part, size)
+
+        # write to a temporary file first so that a crash while saving can't leave a half-written ledger
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.vaults, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+        self.added = []
@@ -0,0 +1,150 @@
+import json
+import os
+import sys
+import time
+import uuid as uuid_module
+from typing import Callable, Dict, List, Optional
+from urllib.parse import quote
+
+# like highlight_sender.py, avoid importing anything from calibre here.
+
+# if obsidian or the vault isn't open when a send starts, the first notes can be lost while obsidian is starting up.
+# ReadinessProbe checks that obsidian is ready before the first note is sent. checking whether obsidian is running
+# only works on linux. on other systems, only the canary note is used.
+
+canary_file = "h2o-canary"  # title of the note sent to check that notes are being received
+
+
+class NotReadyError(RuntimeError):
+    """ raised by ReadinessProbe when obsidian isn't ready to receive notes """
+
+
+def obsidian_running() -> Optional[bool]:
+    """
+    :return: whether an obsidian process is running, or None if it can't be checked (i.e. not on linux)
+    """
+    if not sys.platform.startswith("linux") or not os.path.isdir("/proc"):
+        return None
+
+    own_pid = str(os.getpid())
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit() or pid == own_pid:
+            continue
+        try:
+            with open(f"/proc/{pid}/comm", "r", encoding="utf-8", errors="replace") as f:
+                name = f.read().strip().lower()
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                program = f.read().split(b"\0")[0].decode("utf-8", "replace").lower()
+        except OSError:
+            continue  # the process ended, or belongs to another user
+        # appimage, deb, snap, and flatpak installs all have obsidian in the process or program name
+        if "obsidian" in name or "obsidian" in os.path.basename(program):
+            return True
+    return False
+
+
+def obsidian_config_paths() -> List[str]:
+    """
+    :return: paths that obsidian's list of vaults (obsidian.json) can be at on linux, for each way of installing it
+    """
+    home = os.path.expanduser("~")
+    config = os.environ.get("XDG_CONFIG_HOME") or os.path.join(home, ".config")
+    return [
+        os.path.join(config, "obsidian", "obsidian.json"),
+        os.path.join(home, ".var", "app", "md.obsidian.Obsidian", "config", "obsidian", "obsidian.json"),  # flatpak
+        os.path.join(home, "snap", "obsidian", "current", ".config", "obsidian", "obsidian.json"),  # snap
+    ]
+
+
+def vault_open(vault_name: str, vault_path: str = "") -> Optional[bool]:
+    """
+    :param vault_name: name of the vault, i.e. the name of its folder
+    :param vault_path: path of the vault's folder. if given, it's used to find the vault instead of its name.
+    :return: whether obsidian has the vault open, or None if obsidian.json can't be found or doesn't say
+    """
+    for path in obsidian_config_paths():
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                vaults = json.load(f).get("vaults", {})
+        except (OSError, ValueError, AttributeError):
+            continue
+
+        # obsidian only marks the open vaults. older versions don't mark any, so then we can't tell.
+        marked = any(["open" in vault for vault in vaults.values()])
+        for vault in vaults.values():
+            found = vault.get("path", "")
+            if vault_path:
+                matches = os.path.normcase(os.path.abspath(found)) == os.path.normcase(os.path.abspath(vault_path))
+            else:
+                matches = os.path.basename(os.path.normpath(found)) == vault_name
+            if matches:
+                return bool(vault.get("open")) if marked else None
+    return None
+
+
+class ReadinessProbe:
+    """
+    makes sure obsidian is ready to receive notes before a send starts, see HighlightSender.set_readiness_probe().
+
+    if obsidian isn't running or the vault isn't open, the vault is opened and the probe waits for it. then, if the
+    vault's folder is known, a canary note is sent, and the probe waits until its file is in the vault before the
+    rest of the notes are sent. the canary note is deleted afterwards.
+    """
+
+    def __init__(self, vault_paths: Dict[str, str] = None, timeout: float = 30.0, poll_secs: float = 0.25):
+        """
+        :param vault_paths: {vault name: path of the vault's folder}. vaults that aren't in this don't get a canary
+         note.
+        :param timeout: seconds to wait for obsidian before giving up
+        :param poll_secs: seconds to wait between checks
+        """
+        self.vault_paths = vault_paths if vault_paths is not None else {}
+        self.timeout = timeout
+        self.poll_secs = poll_secs
+
+    def wait_for(self, check: Callable[[], bool], what: str) -> None:
+        """
+        :param check: function that returns True when the thing being waited for has happened
+        :param what: description of what's being waited for, for the error message
+        :raises NotReadyError: if check doesn't return True within the timeout
+        """
+        deadline = time.monotonic() + self.timeout
+        while not check():
+            if time.monotonic() > deadline:
+                raise NotReadyError(f"Gave up after waiting {self.timeout:g} seconds for {what}.")
+            time.sleep(self.poll_secs)
+
+    def __call__(self, launcher, vault_name: str) -> None:
+        """
+        :param launcher: UriLauncher that the notes will be sent with
+        :param vault_name: vault that the notes will be sent to
+        :raises NotReadyError: if obsidian still isn't ready after the timeout
+        """
+        vault_path = self.vault_paths.get(vault_name, "")
+
+        if obsidian_running() is False or vault_open(vault_name, vault_path) is False:
+            launcher.open_uri("obsidian://open?vault=" + quote(vault_name), "")
+            self.wait_for(lambda: obsidian_running() is not False and vault_open(vault_name, vault_path) is not False,
+                          f"Obsidian to open the vault \"{vault_name}\"")
+
+        if not vault_path:
+            return
+
+        token = uuid_module.uuid4().hex
+        path = os.path.join(vault_path, canary_file + ".md")
+
+        def landed() -> bool:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    return token in f.read()
+            except OSError:
+                return False
+
+        launcher({"vault": vault_name, "file": canary_file, "content": token, "overwrite": "true"})
+        try:
+            self.wait_for(landed, f"a test note to arrive in the vault \"{vault_name}\"")
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
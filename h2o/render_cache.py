@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import zlib
+from collections import OrderedDict
+from typing import Any, Optional, Tuple, Union
+
+# like highlight_sender.py, avoid importing anything from calibre here. the cache's file path is decided in
+# make_sender() in button_actions.py.
+
+
+def _text_len(rendered: Union[str, tuple]) -> int:
+    """
+    :param rendered: a string, or a tuple of strings and slot numbers, see highlight_sender.render_compiled()
+    :return: number of characters in rendered
+    """
+    if isinstance(rendered, str):
+        return len(rendered)
+    return sum(len(p) for p in rendered if isinstance(p, str))
+
+
+class RenderCache:
+    """
+    stores the formatted title, body, and sort key of highlights, so that sending a highlight again doesn't require
+    formatting it again. entries are keyed by the highlight's uuid, and are only used if the highlight's timestamp,
+    its book's title and authors, and the templates used to format it are all unchanged.
+
+    the cache is saved as a json file. when it's bigger than its max size, the least recently used entries are
+    removed.
+    """
+
+    def __init__(self, path: str, max_size: int):
+        """
+        :param path: file to load the cache from and save it to
+        :param max_size: maximum total length, in characters, of the titles and bodies stored in the cache
+        """
+        self.path = path
+        self.max_size = max_size
+        self.template_hash = ""
+        self.size = 0  # total length of titles and bodies in self.entries
+        self.changed = False
+        # {uuid: [stamp, title, body, sort_key]}, in order from least to most recently used
+        self.entries: "OrderedDict[str, list]" = OrderedDict()
+        self.load()
+
+    def set_templates(self, *templates: str) -> None:
+        """
+        entries made with different templates won't be used.
+
+        :param templates: everything that affects how a highlight is formatted, e.g. the title, body, no notes,
+         and header formats, the library name, and the sort key
+        """
+        self.template_hash = hashlib.sha1("\0".join(templates).encode("utf-8")).hexdigest()
+
+    def make_stamp(self, timestamp: str, title: str, authors: str) -> str:
+        """
+        :param timestamp: the highlight's timestamp. calibre updates this whenever a highlight is modified.
+        :param title: title of the highlight's book
+        :param authors: authors of the highlight's book
+        :return: string that will be different if the highlight, its book, or the templates change
+        """
+        book = zlib.crc32((title + "\0" + authors).encode("utf-8"))
+        return f"{timestamp}:{book}:{self.template_hash}"
+
+    def get(self, uuid: str, stamp: str) -> Optional[Tuple[Any, Any, Any]]:
+        """
+        :return: (title, body, sort_key) if this highlight is in the cache and stamp matches, else None
+        """
+        entry = self.entries.get(uuid)
+        if entry is None or entry[0] != stamp:
+            return None
+
+        self.entries.move_to_end(uuid)
+        self.changed = True
+        return entry[1], entry[2], entry[3]
+
+    def put(self, uuid: str, stamp: str, title: Any, body: Any, sort_key: Any) -> None:
+        """
+        :param title: formatted title, see highlight_sender.render_compiled()
+        :param body: formatted body, see highlight_sender.render_compiled()
+        """
+        old = self.entries.pop(uuid, None)
+        if old is not None:
+            self.size -= _text_len(old[1]) + _text_len(old[2])
+
+        self.entries[uuid] = [stamp, title, body, sort_key]
+        self.size += _text_len(title) + _text_len(body)
+        self.changed = True
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        removes the least recently used entries until the cache is no bigger than its max size
+        """
+        while self.size > self.max_size and len(self.entries) > 0:
+            _, removed = self.entries.popitem(last=False)
+            self.size -= _text_len(removed[1]) + _text_len(removed[2])
+            self.changed = True
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            # missing or corrupt cache. it'll be remade as highlights are sent.
+            return
+
+        for uuid, entry in entries:
+            # json turns tuples into lists. titles and bodies with slots, and sort keys, need to be tuples again.
+            for idx in (1, 2, 3):
+                if isinstance(entry[idx], list):
+                    entry[idx] = tuple(entry[idx])
+            self.entries[uuid] = entry
+            self.size += _text_len(entry[1]) + _text_len(entry[2])
+
+        # max size might have been lowered since the cache was saved
+        self.evict()
+
+    def save(self) -> None:
+        """
+        writes the cache to its file, if it changed since it was loaded
+        """
+        if not self.changed:
+            return
+
+        # write to a temporary file first so that a crash while saving can't leave a half-written cache
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(list(self.entries.items()), f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+        self.changed = False
@@ -0,0 +1,142 @@
+import os
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+from calibre_plugins.highlights_to_obsidian.highlight_sender import HighlightRecord, highlight_location, location_key
+
+# makes the {chapter} formatting option from each book's table of contents. opening a book to read its table of
+# contents is slow, so each book's index is made once and kept in memory between sends.
+
+max_cached_books = 100  # number of books whose indexes are kept in memory
+# {(library id, book id, format, file modification time): ChapterIndex}, in order from least to most recently used
+_index_cache: "OrderedDict[tuple, ChapterIndex]" = OrderedDict()
+
+
+class ChapterIndex:
+    """
+    finds which table of contents entry a location in a book is in
+    """
+
+    def __init__(self, entries: List[Tuple[Tuple[int, ...], str]]):
+        """
+        :param entries: (location key, title) for each entry in the book's table of contents, see location_key()
+        """
+        # sorted() is stable, so nested entries that start at the same place keep their table of contents order,
+        # and chapter_at() gives the innermost one
+        entries = sorted(entries, key=lambda e: e[0])
+        self.keys = [e[0] for e in entries]
+        self.titles = [e[1] for e in entries]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def chapter_at(self, key: Tuple[int, ...]) -> str:
+        """
+        :param key: location key of a highlight, see location_key()
+        :return: title of the last table of contents entry that starts before key, or "" if there isn't one
+        """
+        idx = bisect_right(self.keys, key) - 1
+        return self.titles[idx] if idx >= 0 else ""
+
+
+def element_steps(elem) -> List[int]:
+    """
+    :param elem: lxml element in a book's html file
+    :return: epub cfi steps to elem, in the same form as a highlight's start_cfi, e.g. [2, 4, 6] for
+     <html><body><p/><p/><h2/> when elem is the <h2>
+    """
+    steps = []
+    parent = elem.getparent()
+    while parent is not None:
+        # comments and processing instructions don't count, and their tags aren't strings
+        siblings = [child for child in parent if isinstance(child.tag, str)]
+        steps.append((siblings.index(elem) + 1) * 2)
+        elem, parent = parent, parent.getparent()
+    steps.append(2)  # the <html> element
+    return steps[::-1]
+
+
+def build_chapter_index(path: str) -> ChapterIndex:
+    """
+    :param path: path of a book's EPUB, AZW3, etc file
+    :return: index of the book's table of contents. empty if the book doesn't have one that calibre can read.
+    """
+    # these are only needed the first time each book is indexed
+    from calibre.ebooks.oeb.polish.container import get_container
+    from calibre.ebooks.oeb.polish.toc import get_toc
+
+    try:
+        container = get_container(path, tweak_mode=True)
+        toc = get_toc(container)
+    except Exception:
+        return ChapterIndex([])  # e.g. a PDF, or a damaged book
+
+    # spine step of each html file, the same as the first step of a highlight's {location}
+    spine = {name: (idx + 1) * 2 for idx, (name, linear) in enumerate(container.spine_names)}
+    entries = []
+    for node in toc.iterdescendants():
+        if node.dest not in spine or not node.title:
+            continue
+
+        key = [spine[node.dest]]
+        if node.frag:
+            try:
+                elems = container.parsed(node.dest).xpath("//*[@id=$frag or @name=$frag]", frag=node.frag)
+            except Exception:
+                elems = []
+            if elems:
+                key += element_steps(elems[0])
+        entries.append((tuple(key), node.title.strip()))
+
+    return ChapterIndex(entries)
+
+
+class ChapterLookup:
+    """
+    gives the {chapter} formatting option, see HighlightSender.set_chapter_lookup(). a new one should be made for each
+    send, so that books whose files changed since the last send are indexed again.
+    """
+
+    def __init__(self, db):
+        """
+        :param db: calibre database: Cache().new_api
+        """
+        self.db = db
+        self.indexes: Dict[Tuple[int, str], ChapterIndex] = {}  # {(book id, format): index} used by this send
+
+    def get_index(self, book_id: int, book_format: str) -> ChapterIndex:
+        index = self.indexes.get((book_id, book_format))
+        if index is not None:
+            return index
+
+        path = self.db.format_abspath(book_id, book_format)
+        try:
+            mtime = os.stat(path).st_mtime_ns if path else None
+        except OSError:
+            mtime = None
+
+        key = (self.db.library_id, book_id, book_format, mtime)
+        index = _index_cache.get(key)
+        if index is None:
+            index = build_chapter_index(path) if mtime is not None else ChapterIndex([])
+            _index_cache[key] = index
+            while len(_index_cache) > max_cached_books:
+                _index_cache.popitem(last=False)
+        else:
+            _index_cache.move_to_end(key)
+
+        self.indexes[(book_id, book_format)] = index
+        return index
+
+    def __call__(self, highlight: HighlightRecord) -> str:
+        """
+        :return: title of the chapter that the highlight is in, or "" if it can't be found
+        """
+        index = self.get_index(highlight.book_id, highlight.format)
+        if len(index) == 0:
+            return ""
+        try:
+            return index.chapter_at(location_key(highlight_location(highlight)))
+        except ValueError:
+            return ""  # location couldn't be parsed
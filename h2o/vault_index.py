@@ -0,0 +1,144 @@
+import json
+import mmap
+import os
+import re
+from typing import Dict, List, Set
+
+# like highlight_sender.py, avoid importing anything from calibre here. the index's file path is decided in
+# make_sender() in button_actions.py.
+
+# text that the {uuidmarker} formatting option puts in a note. it's an obsidian comment, so it isn't shown
+# in reading view.
+uuid_marker_format = "%%h2o:{uuid}%%"
+_marker_prefix = b"%%h2o:"
+# also matches the end markers used by section update mode, e.g. "%%/h2o:uuid%%"
+_marker_regex = re.compile(rb"%%/?h2o:([A-Za-z0-9_\-]+)%%")
+
+
+def make_uuid_marker(uuid: str) -> str:
+    return uuid_marker_format.format(uuid=uuid)
+
+
+def find_uuids(path: str) -> List[str]:
+    """
+    :param path: path of a markdown file
+    :return: uuids of highlight markers in the file, in the order they appear, without duplicates
+    """
+    with open(path, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return []  # empty files can't be memory-mapped
+
+        with mm:
+            # most notes won't have any markers, so check for that before using the slower regex
+            if mm.find(_marker_prefix) == -1:
+                return []
+            uuids = (m.group(1).decode("ascii") for m in _marker_regex.finditer(mm))
+            return list(dict.fromkeys(uuids))
+
+
+class VaultIndex:
+    """
+    keeps track of which highlights are already in each note of an obsidian vault, by finding the uuid markers
+    made by the {uuidmarker} formatting option.
+
+    the index is saved to a json file. when it's updated, only notes whose modification time or size changed
+    since the last update are read again.
+    """
+
+    def __init__(self, vault_path: str, index_path: str):
+        """
+        :param vault_path: path of the obsidian vault's folder
+        :param index_path: file to load the index from and save it to
+        """
+        self.vault_path = os.path.abspath(vault_path)
+        self.index_path = index_path
+        self.notes: Dict[str, list] = {}  # {note path relative to vault: [mtime_ns, size, [uuids]]}
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return  # missing or corrupt index. update() will rebuild it.
+
+        if saved.get("vault") == self.vault_path:
+            self.notes = saved.get("notes", {})
+
+    def save(self) -> None:
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"vault": self.vault_path, "notes": self.notes}, f, ensure_ascii=False)
+        os.replace(tmp, self.index_path)
+
+    def note_paths(self) -> Dict[str, os.stat_result]:
+        """
+        :return: {path relative to vault: stat} for each markdown file in the vault
+        """
+        ret = {}
+        dirs = [self.vault_path]
+        while dirs:
+            with os.scandir(dirs.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        # skip obsidian's settings folder and trash
+                        if entry.name not in (".obsidian", ".trash"):
+                            dirs.append(entry.path)
+                    elif entry.name.endswith(".md"):
+                        ret[os.path.relpath(entry.path, self.vault_path)] = entry.stat()
+        return ret
+
+    def update(self) -> int:
+        """
+        rescans notes that were added or changed since the last update, and forgets notes that were removed.
+        saves the index if anything changed.
+
+        :return: number of notes that were scanned
+        """
+        if not os.path.isdir(self.vault_path):
+            raise FileNotFoundError(f"Obsidian vault folder '{self.vault_path}' does not exist.")
+
+        paths = self.note_paths()
+        scanned = 0
+        changed = False
+
+        for rel in list(self.notes):
+            if rel not in paths:
+                del self.notes[rel]
+                changed = True
+
+        for rel, st in paths.items():
+            old = self.notes.get(rel)
+            if old is not None and old[0] == st.st_mtime_ns and old[1] == st.st_size:
+                continue
+
+            try:
+                uuids = find_uuids(os.path.join(self.vault_path, rel))
+            except OSError:
+                continue  # note was removed or can't be read. try again next time.
+            self.notes[rel] = [st.st_mtime_ns, st.st_size, uuids]
+            scanned += 1
+            changed = True
+
+        if changed:
+            self.save()
+        return scanned
+
+    def uuids(self) -> Set[str]:
+        """
+        :return: uuids of every highlight that is already in the vault
+        """
+        ret = set()
+        for note in self.notes.values():
+            ret.update(note[2])
+        return ret
+
+    def uuids_in(self, note_path: str) -> List[str]:
+        """
+        :param note_path: path of a note, relative to the vault, e.g. "Books/Title.md"
+        :return: uuids of the highlights in that note, in the order they appear
+        """
+        note = self.notes.get(os.path.normpath(note_path))
+        return note[2] if note is not None else []
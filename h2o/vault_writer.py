@@ -0,0 +1,359 @@
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+import zlib
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+# like highlight_sender.py, avoid importing anything from calibre here.
+
+# each highlight's section in a note is wrapped in these markers when using section update mode. they're obsidian
+# comments, so they aren't shown in reading view. the start marker is the same as the {uuidmarker} formatting option.
+# the start marker is followed by the highlight's sort key, so that new sections can be put in order. see
+# highlight_sender.sort_key_text().
+section_start_format = "%%h2o:{uuid}%%"
+section_key_format = "%%h2o-key:{key}%%"
+section_end_format = "%%/h2o:{uuid}%%\n"
+_section_regex = re.compile(r"%%h2o:([A-Za-z0-9_\-]+)%%.*?%%/h2o:\1%%\n?", re.DOTALL)
+_section_key_regex = re.compile(r"%%h2o:[A-Za-z0-9_\-]+%%%%h2o-key:([^%\n]*)%%")
+
+
+def wrap_section(uuid: str, text: str, key: str = None) -> str:
+    """
+    :param key: the highlight's sort key, as text from highlight_sender.sort_key_text(). None for no sort key.
+    :return: text wrapped in start and end markers for the highlight with the given uuid
+    """
+    start = section_start_format.format(uuid=uuid)
+    if key is not None:
+        start += section_key_format.format(key=key)
+    return start + text + section_end_format.format(uuid=uuid)
+
+
+def section_key(section: str) -> Optional[str]:
+    """
+    :param section: a section, as returned by split_sections()
+    :return: the sort key in the section's start marker, or None if it doesn't have one
+    """
+    m = _section_key_regex.match(section)
+    return m.group(1) if m is not None else None
+
+
+def split_sections(text: str) -> List[Tuple[Optional[str], str]]:
+    """
+    :param text: contents of a note
+    :return: list of (uuid, section_text) for each highlight section and each piece of text between sections.
+     uuid is None for text that isn't in a section. joining the section texts gives back the original text.
+    """
+    ret = []
+    pos = 0
+    for m in _section_regex.finditer(text):
+        if m.start() > pos:
+            ret.append((None, text[pos:m.start()]))
+        ret.append((m.group(1), m.group(0)))
+        pos = m.end()
+    if pos < len(text):
+        ret.append((None, text[pos:]))
+    return ret
+
+
+def merge_sections(old: str, new: str) -> str:
+    """
+    updates the sections of a note with new sections. sections that are in both are replaced by the new version,
+    new sections are inserted in order, and everything else in old is left as it is. text in new that isn't in a
+    section (e.g. a header) is ignored.
+
+    if every section has a sort key, see wrap_section(), each new section is put before the first section in old
+    with a bigger sort key. otherwise, new sections are put next to the sections they're next to in new.
+
+    :param old: current contents of the note
+    :param new: sections to put in the note, in order
+    :return: the note's updated contents
+    """
+    old_sections = split_sections(old)
+    new_sections = [s for s in split_sections(new) if s[0] is not None]
+    segments = [s[1] for s in old_sections]
+    positions = {uuid: idx for idx, (uuid, _) in enumerate(old_sections) if uuid is not None}
+    before: Dict[int, List[str]] = {}  # {segment index: new sections to insert before it}
+    after: Dict[int, List[str]] = {}  # {segment index: new sections to insert after it}
+
+    old_keys = [(idx, section_key(segments[idx])) for idx in sorted(positions.values())]
+    new_keys = [section_key(text) for _, text in new_sections]
+    if all([k is not None for _, k in old_keys]) and all([k is not None for k in new_keys]):
+        pending = []  # new sections that go after every section in old
+        for (uuid, text), key in zip(new_sections, new_keys):
+            idx = positions.get(uuid)
+            if idx is not None:
+                segments[idx] = text
+                continue
+            bigger = next((idx for idx, old_key in old_keys if old_key > key), None)
+            if bigger is not None:
+                before.setdefault(bigger, []).append(text)
+            else:
+                pending.append(text)
+        if pending:
+            add_to_end(segments, old_keys[-1][0] if old_keys else None, after, pending)
+        return join_segments(segments, before, after)
+
+    anchor = None  # segment index of the last section in new that was already in old
+    pending = []  # new sections that haven't been given a place yet
+    for uuid, text in new_sections:
+        idx = positions.get(uuid)
+        if idx is None:
+            pending.append(text)
+            continue
+
+        segments[idx] = text
+        if pending:
+            # sections that come before this one in new go right before it, unless there's an earlier section
+            # to put them after
+            (after.setdefault(anchor, []) if anchor is not None else before.setdefault(idx, [])).extend(pending)
+            pending = []
+        anchor = idx
+
+    if pending:
+        add_to_end(segments, anchor, after, pending)
+
+    return join_segments(segments, before, after)
+
+
+def add_to_end(segments: List[str], anchor: Optional[int], after: Dict[int, List[str]], sections: List[str]) -> None:
+    """
+    :param segments: the sections and text of a note, see split_sections()
+    :param anchor: index of the segment to put sections after. if None, they're put at the end of the note.
+    :param after: see join_segments(). sections are added to it.
+    :param sections: sections to add
+    """
+    if anchor is None:
+        if len(segments) > 0 and not segments[-1].endswith("\n"):
+            sections.insert(0, "\n")
+        anchor = len(segments) - 1
+    after.setdefault(anchor, []).extend(sections)
+
+
+def join_segments(segments: List[str], before: Dict[int, List[str]], after: Dict[int, List[str]]) -> str:
+    """
+    :param segments: the sections and text of a note, see split_sections()
+    :param before: {segment index: sections to insert before it}
+    :param after: {segment index: sections to insert after it}. -1 for sections to put in an empty note.
+    :return: the note's contents with the sections inserted
+    """
+    ret = []
+    for idx, seg in enumerate(segments):
+        ret.extend(before.get(idx, ()))
+        ret.append(seg)
+        ret.extend(after.get(idx, ()))
+    ret.extend(after.get(-1, ()))  # old was empty
+    return "".join(ret)
+
+
+def write_atomic(path: str, text: str) -> None:
+    """
+    writes text to a temporary file and then renames it to path, so that path is never left half-written
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".h2o-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class VaultFileWriter:
+    """
+    sends notes by writing them directly to the files in an obsidian vault's folder, instead of using obsidian
+    URIs. obsidian doesn't need to be open for this to work.
+
+    with workers, files are written by a pool of threads, so that different files can be written at the same time,
+    e.g. for a vault on a network drive. every note with the same title goes to the same thread, so each file's
+    notes are still written in order. notes for the same file that are waiting at the same time are written
+    together, with one write per file. errors are returned by close() instead of being raised. the threads are
+    started when the first note is sent, so a writer that's never used doesn't need to be closed.
+
+    can be used in place of send_item_to_obsidian().
+    """
+
+    def __init__(self, vault_path: str, update_sections: bool = False, workers: int = 0):
+        """
+        :param vault_path: path of the obsidian vault's folder
+        :param update_sections: if False, notes are appended to the end of their files. if True, notes must be made
+         of sections wrapped with wrap_section(), and each file is rewritten so that sections that are already in
+         it are replaced and new sections are inserted in order. see merge_sections().
+        :param workers: number of threads that write files. 0 to write each note before __call__() returns.
+        """
+        self.workers = workers
+        self.vault_path = vault_path
+        self.update_sections = update_sections
+        self.failures: List[Tuple[str, str]] = []  # (note file, error message) for each note that couldn't be written
+        # "notes": notes written, "writes": files written, "bytes": characters written, "write_secs": total time
+        # spent writing. with workers, notes that are written together only count as one write.
+        self.stats: Dict[str, float] = {"notes": 0, "writes": 0, "bytes": 0, "write_secs": 0.0}
+        self.lock = threading.Lock()  # for failures, stats, and finished
+        self.queues: List[queue.Queue] = []
+        self.threads: List[threading.Thread] = []
+        self.queued = 0  # number of notes that have been given to this writer
+        self.done = 0  # the first this many notes given to this writer have been written, see written()
+        self.finished: Set[int] = set()  # numbers of notes after self.done that have been written
+
+    def start(self) -> None:
+        """
+        starts the threads that write files
+        """
+        for idx in range(self.workers):
+            self.queues.append(queue.Queue(64))
+            thread = threading.Thread(target=self.work, args=(self.queues[idx],), name=f"h2o-writer-{idx}",
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def written(self) -> int:
+        """
+        :return: n, such that the first n notes given to this writer have been written. notes that failed aren't
+         written, so this stops at the first note that failed. see HighlightSender.send().
+        """
+        with self.lock:
+            return self.done
+
+    def mark_written(self, numbers: List[int]) -> None:
+        """
+        :param numbers: numbers of notes that were written, counting from 1 in the order they were given to this
+         writer
+        """
+        with self.lock:
+            self.finished.update(numbers)
+            while self.done + 1 in self.finished:
+                self.done += 1
+                self.finished.remove(self.done)
+
+    def note_path(self, note_file: str) -> str:
+        """
+        :param note_file: title of a note, including its folders, e.g. "Books/The Book by Someone"
+        :return: path of the note's markdown file
+        """
+        return os.path.join(self.vault_path, *note_file.split("/")) + ".md"
+
+    def section_parts(self, part_file: Callable[[int], str]) -> Optional[Tuple[List[int], Dict[str, int]]]:
+        """
+        finds which part of a split note each highlight's section is in, so that a section that's sent again can go
+        to the part that already has it, instead of being added to another part. see HighlightSender.send().
+
+        :param part_file: function that takes a part number and returns that part's note file, e.g. "Books/The Book
+         (1)" for part 1
+        :return: (length of each part that's in the vault, {uuid: part that has its section}), or None if this
+         writer doesn't update sections. parts are read in order until one is missing.
+        """
+        if not self.update_sections:
+            return None
+
+        sizes: List[int] = []
+        placed: Dict[str, int] = {}
+        while True:
+            try:
+                with open(self.note_path(part_file(len(sizes))), "r", encoding="utf-8", newline="") as f:
+                    text = f.read()
+            except FileNotFoundError:
+                return sizes, placed
+            for uuid, _ in split_sections(text):
+                if uuid is not None:
+                    placed.setdefault(uuid, len(sizes))
+            sizes.append(len(text))
+
+    def __call__(self, obsidian_data: Dict[str, str]) -> None:
+        """
+        :param obsidian_data: output of HighlightSender.make_obsidian_data(). uses the 'file' and 'content' keys.
+        """
+        if not os.path.isdir(self.vault_path):
+            raise FileNotFoundError(f"Obsidian vault folder '{self.vault_path}' does not exist.")
+
+        self.queued += 1
+        if self.workers <= 0:
+            self.write(obsidian_data["file"], [obsidian_data["content"]])
+            self.mark_written([self.queued])
+            return
+
+        if not self.threads:
+            self.start()
+        # crc32 instead of hash(), so that the same file always goes to the same thread
+        worker = zlib.crc32(obsidian_data["file"].encode("utf-8")) % len(self.queues)
+        self.queues[worker].put((obsidian_data["file"], obsidian_data["content"], self.queued))
+
+    def write(self, note_file: str, contents: List[str]) -> None:
+        """
+        :param note_file: title of the note to write
+        :param contents: contents of notes with this title, in the order they were sent
+        """
+        start = time.perf_counter()
+        path = self.note_path(note_file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        if not self.update_sections:
+            with open(path, "a", encoding="utf-8", newline="") as f:
+                f.write("".join(contents))
+        else:
+            try:
+                with open(path, "r", encoding="utf-8", newline="") as f:
+                    old = f.read()
+            except FileNotFoundError:
+                old = None
+
+            new = old
+            for content in contents:
+                new = content if new is None else merge_sections(new, content)
+            if new != old:
+                write_atomic(path, new)
+
+        with self.lock:
+            self.stats["notes"] += len(contents)
+            self.stats["writes"] += 1
+            self.stats["bytes"] += sum([len(c) for c in contents])
+            self.stats["write_secs"] += time.perf_counter() - start
+
+    def work(self, notes: queue.Queue) -> None:
+        """
+        writes notes from a queue until it gets None
+        """
+        stop = False
+        while not stop:
+            waiting = [notes.get()]
+            # take every note that's already waiting, so that notes for the same file can be written together
+            while True:
+                try:
+                    waiting.append(notes.get_nowait())
+                except queue.Empty:
+                    break
+            if waiting[-1] is None:
+                waiting.pop()
+                stop = True
+
+            # {note file: (contents, note numbers)}. dicts keep the order files were sent in.
+            batches: Dict[str, Tuple[List[str], List[int]]] = {}
+            for note_file, content, number in waiting:
+                batch = batches.setdefault(note_file, ([], []))
+                batch[0].append(content)
+                batch[1].append(number)
+            for note_file, (contents, numbers) in batches.items():
+                try:
+                    self.write(note_file, contents)
+                except Exception as e:
+                    with self.lock:
+                        self.failures.extend([(note_file, f"'{e}' when writing note '{note_file}'.")] * len(contents))
+                    continue
+                self.mark_written(numbers)
+
+    def close(self) -> List[Tuple[str, str]]:
+        """
+        waits until every note has been written
+
+        :return: (note file, error message) for each note that couldn't be written
+        """
+        for notes in self.queues:
+            notes.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.queues, self.threads = [], []
+
+        failures, self.failures = self.failures, []
+        return failures
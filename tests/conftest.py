@@ -0,0 +1,42 @@
+import os
+import sys
+import types
+
+# the plugin's modules import each other as calibre_plugins.highlights_to_obsidian.*, which only exists inside
+# calibre. highlight_sender.py only needs prefs from config.py, so the package is set up here with a config module
+# that has prefs' defaults, without importing calibre or qt.
+
+h2o_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "h2o")
+
+
+class Prefs(dict):
+    def __init__(self, defaults):
+        super().__init__()
+        self.defaults = defaults
+
+    def __missing__(self, key):
+        return self.defaults[key]
+
+
+if "calibre_plugins.highlights_to_obsidian.config" not in sys.modules:
+    plugins = types.ModuleType("calibre_plugins")
+    plugins.__path__ = []
+    package = types.ModuleType("calibre_plugins.highlights_to_obsidian")
+    package.__path__ = [h2o_dir]
+    config = types.ModuleType("calibre_plugins.highlights_to_obsidian.config")
+    # same as the defaults in config.py
+    config.prefs = Prefs({
+        "library_name": "Calibre Library",
+        "vault_name": "My Vault",
+        "title_format": "Books/{title} by {authors}",
+        "body_format": "\n[Highlighted]({url}) on {date} at {time} UTC:\n{blockquote}\n\n{notes}\n\n---\n",
+        "no_notes_format": "\n[Highlighted]({url}) on {date} at {time} UTC:\n{blockquote}\n\n---\n",
+        "header_format": "\n{booksent} highlights from \"{title}\" sent on {datenow} at {timenow} UTC.\n\n---\n",
+        "sort_key": "location",
+        "use_xdg_open": False,
+    })
+    plugins.highlights_to_obsidian = package
+    package.config = config
+    sys.modules["calibre_plugins"] = plugins
+    sys.modules["calibre_plugins.highlights_to_obsidian"] = package
+    sys.modules["calibre_plugins.highlights_to_obsidian.config"] = config
@@ -0,0 +1,80 @@
+import pytest
+
+from calibre_plugins.highlights_to_obsidian.checkpoint import SendCheckpoint
+from calibre_plugins.highlights_to_obsidian.highlight_sender import HighlightSender, ResumeError, VaultTarget
+from calibre_plugins.highlights_to_obsidian.memory_profile import make_annotations
+
+
+class Interrupted(Exception):
+    pass
+
+
+def new_since(timestamp):
+    """
+    :return: condition that's true for highlights made after timestamp, like button_actions.new_highlight_condition()
+    """
+    return lambda highlight: highlight["annotation"]["timestamp"] > timestamp
+
+
+def make_sender(annotations, sent, checkpoint, conditions, stop_after=None):
+    """
+    :param sent: list that (vault, note file, note content) of each delivered note is added to
+    :param conditions: condition of each of the two targets
+    :param stop_after: number of notes to deliver before the send is interrupted, or None to not interrupt it
+    """
+    def transport(data):
+        if stop_after is not None and len(sent) >= stop_after:
+            raise Interrupted()
+        sent.append((data["vault"], data["file"], data["content"]))
+
+    sender = HighlightSender()
+    sender.set_book_titles_authors({i: {"title": f"Book {i}", "authors": "A"} for i in range(1, 11)})
+    sender.set_header_format("")
+    sender.set_annotations_list(annotations)
+    sender.set_max_file_size(2000)
+    sender.set_sleep_time(0)
+    sender.set_transport(transport)
+    sender.set_targets([VaultTarget("Main", condition=conditions[0]), VaultTarget("Extra", condition=conditions[1])])
+    sender.set_checkpoint(checkpoint)
+    return sender
+
+
+def test_resumed_send_with_two_targets_matches_uninterrupted_send(tmp_path):
+    annotations = make_annotations(200, 10)
+    # the extra vault was last sent to later than the main vault, so it only gets some of the highlights
+    conditions = [None, new_since("2023-07-01")]
+
+    expected = []
+    make_sender(annotations, expected, None, conditions).send()
+    assert {note[0] for note in expected} == {"Main", "Extra"}
+
+    checkpoint = SendCheckpoint(str(tmp_path / "checkpoint.json"))
+    sent = []
+    with pytest.raises(Interrupted):
+        make_sender(annotations, sent, checkpoint, conditions, stop_after=len(expected) // 2).send()
+
+    saved = checkpoint.load()
+    assert saved["delivered"] == len(sent)
+    uuids = set(saved["uuids"])
+    sender = make_sender(annotations, sent, SendCheckpoint(str(tmp_path / "checkpoint.json")), conditions)
+    sender.set_checkpoint(sender.checkpoint, resume=True)
+    sender.send(lambda highlight: highlight["annotation"]["uuid"] in uuids)
+
+    assert sent == expected
+    assert SendCheckpoint(str(tmp_path / "checkpoint.json")).load() is None
+
+
+def test_resume_is_refused_if_targets_get_different_highlights(tmp_path):
+    annotations = make_annotations(200, 10)
+    conditions = [None, new_since("2023-07-01")]
+    checkpoint = SendCheckpoint(str(tmp_path / "checkpoint.json"))
+    sent = []
+    with pytest.raises(Interrupted):
+        make_sender(annotations, sent, checkpoint, conditions, stop_after=15).send()
+
+    # without the extra vault's condition, it would get highlights that the interrupted send didn't give it
+    uuids = set(checkpoint.load()["uuids"])
+    sender = make_sender(annotations, sent, SendCheckpoint(str(tmp_path / "checkpoint.json")), [None, None])
+    sender.set_checkpoint(sender.checkpoint, resume=True)
+    with pytest.raises(ResumeError):
+        sender.send(lambda highlight: highlight["annotation"]["uuid"] in uuids)
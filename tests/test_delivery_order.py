@@ -0,0 +1,23 @@
+from calibre_plugins.highlights_to_obsidian.highlight_sender import HighlightSender
+
+
+def highlight(book_id, idx, text):
+    return {"book_id": book_id, "format": "EPUB", "user_type": "local", "user": "viewer",
+            "annotation": {"type": "highlight", "uuid": f"order{book_id}x{idx}",
+                           "timestamp": "2023-01-01T00:00:00.000Z", "highlighted_text": text, "spine_index": 0,
+                           "start_cfi": f"/2/{idx * 2 + 2}/1:0"}}
+
+
+def test_smallest_sends_notes_with_the_least_text_first():
+    # book 1 has fewer highlights, but they're much longer
+    annotations = [highlight(1, idx, "long " * 1000) for idx in range(2)]
+    annotations += [highlight(2, idx, "short") for idx in range(5)]
+    sent = []
+    sender = HighlightSender()
+    sender.set_book_titles_authors({1: {"title": "Long", "authors": "A"}, 2: {"title": "Short", "authors": "A"}})
+    sender.set_annotations_list(annotations)
+    sender.set_sleep_time(0)
+    sender.set_transport(lambda data: sent.append(data["file"]))
+    sender.set_delivery_order("smallest")
+    sender.send()
+    assert sent == ["Books/Short by A", "Books/Long by A"]
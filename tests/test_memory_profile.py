@@ -0,0 +1,16 @@
+from calibre_plugins.highlights_to_obsidian.memory_profile import soak
+
+# bytes per highlight. tighter than memory_profile.default_ceilings, which leave room for calibre's own memory and
+# for sends that are much bigger than this one. rss isn't checked, since it depends on everything pytest loaded.
+ceilings = {
+    "annotations": 1300,
+    "filtered": 100,
+    "book lists": 600,
+    "notes": 700,
+}
+
+
+def test_soak_stays_under_ceilings():
+    amount = 2000
+    profiler = soak(amount, 20, {stage: per_highlight * amount for stage, per_highlight in ceilings.items()})
+    assert set(profiler.usage()) >= set(ceilings)
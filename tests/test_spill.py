@@ -0,0 +1,44 @@
+import pytest
+
+from calibre_plugins.highlights_to_obsidian.highlight_sender import BookData, HighlightSender
+from calibre_plugins.highlights_to_obsidian.memory_profile import make_annotations
+
+
+def send(annotations, memory_budget=None, max_file_size=3000):
+    """
+    :return: (number of highlights sent, [(note file, note content)] in the order they were sent)
+    """
+    sent = []
+    sender = HighlightSender()
+    sender.set_library("Test Library")
+    sender.set_vault("Test Vault")
+    sender.set_book_titles_authors({i: {"title": f"Book {i}", "authors": f"Author {i}"} for i in range(1, 21)})
+    # the default header has the current time, which could change between sends
+    sender.set_header_format("\n{booksent} highlights from \"{title}\" ({totalsent} total)\n\n---\n")
+    sender.set_body_format("\n{highlightsent}/{booksent} [Highlighted]({url}) on {date} at {time} UTC:\n"
+                           "{blockquote}\n\n{notes}\n\n---\n")
+    sender.set_max_file_size(max_file_size)
+    sender.set_sleep_time(0)
+    sender.set_annotations_list(annotations)
+    sender.set_transport(lambda data: sent.append((data["file"], data["content"])))
+    if memory_budget is not None:
+        sender.set_memory_budget(memory_budget)
+    return sender.send(), sent
+
+
+@pytest.mark.parametrize("memory_budget", [0, 1, 5000, 50000])
+def test_spilled_send_matches_unspilled_send(memory_budget, monkeypatch):
+    spills = []
+    spill = BookData.spill
+    monkeypatch.setattr(BookData, "spill", lambda self, path: spills.append(spill(self, path)) or spills[-1])
+
+    annotations = make_annotations(600, 20)
+    spilled = send(annotations, memory_budget)
+    assert sum(spills) > 0  # make sure the budget was small enough to spill something
+    assert spilled == send(annotations)
+
+
+@pytest.mark.parametrize("memory_budget", [0, 5000])
+def test_spilled_send_matches_without_max_file_size(memory_budget):
+    annotations = make_annotations(300, 20, seed=1)
+    assert send(annotations, memory_budget, -1) == send(annotations, max_file_size=-1)
@@ -0,0 +1,61 @@
+import collections
+import re
+
+from calibre_plugins.highlights_to_obsidian.highlight_sender import HighlightSender, VaultTarget
+from calibre_plugins.highlights_to_obsidian.memory_profile import make_annotations
+from calibre_plugins.highlights_to_obsidian.vault_index import VaultIndex
+from calibre_plugins.highlights_to_obsidian.vault_writer import VaultFileWriter
+from test_vault_writer import read_notes
+
+
+def send(annotations, targets):
+    sender = HighlightSender()
+    sender.set_book_titles_authors({i: {"title": f"Book {i}", "authors": "A"} for i in range(1, 6)})
+    sender.set_body_format("{uuidmarker}\n{highlight}\n")
+    sender.set_no_notes_format("{uuidmarker}\n{highlight}\n")
+    sender.set_annotations_list(annotations)
+    sender.set_sleep_time(0)
+    sender.set_targets(targets)
+    return sender.send(), sender.stats
+
+
+def uuid_counts(vault_path):
+    counts = collections.Counter()
+    for text in read_notes(vault_path).values():
+        counts.update(re.findall(r"%%h2o:([A-Za-z0-9_\-]+)%%", text))
+    return counts
+
+
+def test_each_target_skips_only_highlights_in_its_own_vault(tmp_path):
+    vault_a, vault_b = tmp_path / "a", tmp_path / "b"
+    vault_a.mkdir()
+    vault_b.mkdir()
+    annotations = make_annotations(120, 5)
+
+    def targets():
+        uri_notes = []
+        return [VaultTarget("A", transport=VaultFileWriter(str(vault_a)),
+                            vault_index=VaultIndex(str(vault_a), str(tmp_path / "a.json"))),
+                VaultTarget("B", transport=VaultFileWriter(str(vault_b)),
+                            vault_index=VaultIndex(str(vault_b), str(tmp_path / "b.json"))),
+                # a vault without a folder can't be checked, so it gets every highlight
+                VaultTarget("C", transport=uri_notes.append)]
+
+    first = targets()
+    send(annotations[:60], first[:1])
+    second = targets()
+    amt, stats = send(annotations, second)
+
+    assert amt == 120
+    assert [target.sent for target in second] == [60, 120, 120]
+    assert stats["in_vault"] == 0  # every highlight was sent to at least one vault
+    uuids = sorted([a["annotation"]["uuid"] for a in annotations])
+    for vault in (vault_a, vault_b):
+        counts = uuid_counts(str(vault))
+        assert sorted(counts) == uuids
+        assert max(counts.values()) == 1
+
+    # nothing is new to A or B, and C isn't sent to
+    amt, stats = send(annotations, targets()[:2])
+    assert amt == 0
+    assert stats["in_vault"] == 120
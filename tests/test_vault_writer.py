@@ -0,0 +1,55 @@
+import collections
+import os
+import re
+
+import pytest
+
+from calibre_plugins.highlights_to_obsidian.highlight_sender import HighlightSender
+from calibre_plugins.highlights_to_obsidian.memory_profile import make_annotations
+from calibre_plugins.highlights_to_obsidian.vault_writer import VaultFileWriter
+
+
+def send_to_files(annotations, vault_path, max_file_size, copy_header=False):
+    sender = HighlightSender()
+    sender.set_book_titles_authors({i: {"title": f"Book {i}", "authors": "A"} for i in range(1, 6)})
+    sender.set_header_format("\n{booksent} highlights from \"{title}\"\n\n---\n")
+    sender.set_annotations_list(annotations)
+    sender.set_max_file_size(max_file_size, copy_header)
+    sender.set_sleep_time(0)
+    sender.set_section_markers(True)
+    sender.set_transport(VaultFileWriter(vault_path, True, 4))
+    amt = sender.send()
+    assert not sender.failures
+    return amt
+
+
+def read_notes(vault_path):
+    """
+    :return: {note path relative to the vault: note contents}
+    """
+    ret = {}
+    for root, _, files in os.walk(vault_path):
+        for file in files:
+            path = os.path.join(root, file)
+            with open(path, "r", encoding="utf-8", newline="") as f:
+                ret[os.path.relpath(path, vault_path)] = f.read()
+    return ret
+
+
+@pytest.mark.parametrize("copy_header", [False, True])
+def test_updated_split_notes_keep_one_copy_of_each_section(tmp_path, copy_header):
+    annotations = make_annotations(120, 5)
+    send_to_files(annotations[:60], str(tmp_path), 3000, copy_header)
+    assert send_to_files(annotations, str(tmp_path), 3000, copy_header) == 120
+
+    notes = read_notes(str(tmp_path))
+    sections = collections.Counter()
+    for text in notes.values():
+        sections.update(re.findall(r"%%h2o:([A-Za-z0-9_\-]+)%%", text))
+    assert sorted(sections) == sorted([a["annotation"]["uuid"] for a in annotations])
+    assert max(sections.values()) == 1
+    assert max([len(text) for text in notes.values()]) <= 3000
+
+    # sending the same highlights again doesn't change anything
+    send_to_files(annotations, str(tmp_path), 3000, copy_header)
+    assert read_notes(str(tmp_path)) == notes